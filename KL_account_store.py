@@ -0,0 +1,184 @@
+import hashlib
+import mmap
+import os
+import struct
+from KL_wal import fsync_directory
+
+MAGIC = b"KLACCT01"
+HEADER = struct.Struct("<8sQQQ") # Magic, capacity (slots), number of accounts, number of deleted slots
+HEADER_SIZE = 64
+SLOT = struct.Struct("<B23sq") # Flags, account ID, balance in cents
+EMPTY, USED, DELETED = 0, 1, 2
+MAX_LOAD = 0.7 # Fraction of used and deleted slots before the table is rehashed
+
+def to_cents(amount):
+    """Convert an amount in currency units (as sent over RPC) to integer cents."""
+    return int(round(float(amount) * 100))
+
+def from_cents(cents):
+    """Convert integer cents back to currency units for RPC replies."""
+    return cents / 100
+
+class AccountStore:
+    """Fixed-width, memory-mapped hash table of account balances in int64 cents.
+
+    Each account occupies one 32-byte slot located by hashing its ID (open
+    addressing with linear probing), so lookups and updates are O(1) and done in
+    place. A deleted account leaves a tombstone that inserts reuse; tombstones
+    count toward the load, so a probe always reaches an empty slot, and a rehash
+    clears them. Opening the store maps the file without reading it, and no per-account
+    state is held in Python memory. Changes reach the disk when the OS writes
+    pages back or on flush(); durability comes from the write-ahead log.
+
+    A page can reach the disk at any time, so a logged change is staged with the
+    LSN of its log record and only written to the table by apply() once the log
+    is durable up to it. Reads see staged changes. The table then never holds a
+    balance the log could lose in a crash.
+    """
+
+    def __init__(self, path, initial_capacity=1024):
+        self.path = path
+        self.created = not os.path.exists(path) # True if the store file was just created
+        if self.created:
+            self._create(path, initial_capacity)
+        self._open()
+        self.staged = {} # Logged changes not yet durable: {account: (cents or None if deleted, LSN)}
+
+    def _create(self, path, capacity):
+        capacity = 1 << max(capacity - 1, 1).bit_length() # Round up to a power of two
+        with open(path, "wb") as f:
+            f.write(HEADER.pack(MAGIC, capacity, 0, 0).ljust(HEADER_SIZE, b"\0"))
+            f.truncate(HEADER_SIZE + capacity * SLOT.size)
+
+    def _open(self):
+        self.file = open(self.path, "r+b")
+        self.mm = mmap.mmap(self.file.fileno(), 0)
+        magic, self.capacity, self.count, self.deleted = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{self.path} is not an account store")
+
+    def _key(self, account):
+        key = account.encode()
+        if len(key) > 23:
+            raise ValueError(f"Account ID {account!r} is longer than 23 bytes")
+        return key
+
+    def _find(self, key):
+        """Return (offset of the slot holding key or None, offset of the first reusable slot)."""
+        mask = self.capacity - 1
+        index = int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "little") & mask
+        reusable = None
+        for _ in range(self.capacity):
+            offset = HEADER_SIZE + index * SLOT.size
+            flags = self.mm[offset]
+            if flags == EMPTY:
+                return None, reusable if reusable is not None else offset
+            if flags == USED and self.mm[offset + 1:offset + 24].rstrip(b"\0") == key:
+                return offset, None
+            if flags == DELETED and reusable is None:
+                reusable = offset
+            index = (index + 1) & mask
+        return None, reusable # Every slot probed
+
+    def get(self, account):
+        """Return the balance in cents, or None if the account does not exist."""
+        if account in self.staged:
+            return self.staged[account][0]
+        offset, _ = self._find(self._key(account))
+        if offset is None:
+            return None
+        return SLOT.unpack_from(self.mm, offset)[2]
+
+    def set(self, account, cents):
+        """Set the balance in cents in the table, creating the account if needed."""
+        key = self._key(account)
+        offset, free = self._find(key)
+        if offset is None:
+            if free is None or (self.mm[free] == EMPTY and self.count + self.deleted + 1 > self.capacity * MAX_LOAD):
+                # Double the table if accounts fill it, or just clear the tombstones
+                self._rehash(self.capacity * 2 if self.count + 1 > self.capacity * MAX_LOAD / 2 else self.capacity)
+                offset, free = self._find(key)
+            offset = free
+            if self.mm[offset] == DELETED:
+                self.deleted -= 1
+            self.count += 1
+            self._write_header()
+        SLOT.pack_into(self.mm, offset, USED, key, cents)
+
+    def delete(self, account):
+        """Remove an account from the table. Returns its last balance in cents, or None if it did not exist."""
+        offset, _ = self._find(self._key(account))
+        if offset is None:
+            return None
+        cents = SLOT.unpack_from(self.mm, offset)[2]
+        SLOT.pack_into(self.mm, offset, DELETED, b"", 0)
+        self.count -= 1
+        self.deleted += 1
+        self._write_header()
+        return cents
+
+    def _write_header(self):
+        HEADER.pack_into(self.mm, 0, MAGIC, self.capacity, self.count, self.deleted)
+
+    def stage(self, balances, lsn):
+        """Stage logged changes {account: cents, or None to delete} until the log is durable up to lsn."""
+        for account, cents in balances.items():
+            self._key(account) # Reject an invalid ID now rather than in apply()
+            self.staged[account] = (cents, lsn)
+
+    def apply(self, durable_lsn=None):
+        """Write the staged changes whose log record is durable (default: all of them) to the table."""
+        for account, (cents, lsn) in list(self.staged.items()):
+            if durable_lsn is None or lsn <= durable_lsn:
+                if cents is None:
+                    self.delete(account)
+                else:
+                    self.set(account, cents)
+                del self.staged[account]
+
+    def __contains__(self, account):
+        if account in self.staged:
+            return self.staged[account][0] is not None
+        return self._find(self._key(account))[0] is not None
+
+    def __len__(self):
+        return self.count + sum((cents is not None) - (self._find(self._key(account))[0] is not None) for account, (cents, _) in self.staged.items())
+
+    def items(self):
+        """Yield (account, cents) for every account by scanning the table, with the staged changes."""
+        for account, cents in self._table_items():
+            if account not in self.staged:
+                yield account, cents
+        for account, (cents, _) in list(self.staged.items()):
+            if cents is not None:
+                yield account, cents
+
+    def _table_items(self):
+        for index in range(self.capacity):
+            flags, key, cents = SLOT.unpack_from(self.mm, HEADER_SIZE + index * SLOT.size)
+            if flags == USED:
+                yield key.rstrip(b"\0").decode(), cents
+
+    def _rehash(self, capacity):
+        """Rehash into a table of capacity slots, without tombstones, and atomically replace the file."""
+        tmp_path = self.path + ".tmp"
+        self._create(tmp_path, capacity)
+        bigger = AccountStore(tmp_path)
+        for account, cents in self._table_items():
+            bigger.set(account, cents)
+        bigger.close()
+        self.close()
+        os.replace(tmp_path, self.path)
+        fsync_directory(self.path)
+        self._open()
+
+    def flush(self):
+        """Write every changed page to disk."""
+        self.mm.flush()
+
+    def close(self, flush=True):
+        """Unmap the store; with flush False, as in a crash, staged changes are lost and pages are not forced to disk."""
+        if flush:
+            self.mm.flush()
+        self.mm.close()
+        self.file.close()
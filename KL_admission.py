@@ -0,0 +1,130 @@
+from collections import deque
+from contextlib import contextmanager
+import math
+import re
+import threading
+import time
+
+OVERLOADED = "Coordinator overloaded. Retry after {:.3f}s." # Reply to a transaction refused for lack of capacity
+EXPIRED = "Transaction deadline expired." # Reply to a transaction dropped before prepare
+UNKNOWN = "Transaction outcome unknown." # Reply to a one-phase transaction whose node could not be reached to learn its outcome
+
+def retry_after(result):
+    """Return the retry-after hint in seconds of an overloaded coordinator's reply, or None."""
+    match = re.fullmatch(r"Coordinator overloaded\. Retry after ([0-9.]+)s\.", result) if isinstance(result, str) else None
+    return float(match.group(1)) if match else None
+
+class AdmissionController:
+    """Bounds the transactions a coordinator runs at once and sheds the excess.
+
+    At most limit transactions run; up to max_queued more wait in arrival order
+    for a slot, each no longer than its remaining time. Anything beyond that is
+    refused at once, so a burst is turned away instead of piling up behind the
+    participants until every transaction times out.
+
+    The limit follows participant latency, like a gradient limiter: every
+    window replies, the median latency is compared with a slow moving average
+    of it. While latency stays within tolerance of the average the limit grows
+    by about its square root; when participants slow down because they are
+    queueing, it shrinks in proportion. It stays between min_limit and max_limit.
+    """
+
+    def __init__(self, max_limit=64, min_limit=2, initial_limit=None, max_queued=256, window=100, tolerance=1.5, smoothing=0.2):
+        self.lock = threading.Lock()
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.limit = float(initial_limit or max_limit)
+        self.max_queued = max_queued
+        self.window = window # Replies per limit update
+        self.tolerance = tolerance # Latency increase over the average that still counts as unloaded
+        self.smoothing = smoothing # Weight of each update in the limit
+        self.running = 0
+        self.queue = deque() # Events of the waiting transactions, oldest first
+        self.samples = [] # Participant latencies since the last update
+        self.average_latency = None # Slow moving average of the median latency
+        self.service_time = 0.0 # Moving average of the seconds a transaction holds its slot
+        self.admitted = 0
+        self.rejected = 0 # Refused because the queue was full
+        self.timeouts = 0 # Gave up waiting in the queue
+
+    @contextmanager
+    def admit(self, wait):
+        """Run the with body once a slot is free. Yields False if the queue is full or that takes longer than wait seconds."""
+        ready = threading.Event()
+        with self.lock:
+            if self.running < int(self.limit) and not self.queue:
+                self.running += 1
+                ready.set()
+            elif len(self.queue) >= self.max_queued or wait <= 0:
+                self.rejected += 1
+            else:
+                self.queue.append(ready)
+            queued = bool(self.queue) and self.queue[-1] is ready
+        if not ready.is_set():
+            admitted = queued and ready.wait(wait)
+            if not admitted:
+                with self.lock:
+                    admitted = ready.is_set() # Handed a slot while we were timing out
+                    if not admitted and queued:
+                        self.queue.remove(ready)
+                        self.timeouts += 1
+            if not admitted:
+                yield False
+                return
+        start = time.perf_counter()
+        with self.lock:
+            self.admitted += 1
+        try:
+            yield True
+        finally:
+            with self.lock:
+                self.service_time += (time.perf_counter() - start - self.service_time) * 0.1
+                self._release()
+
+    def _release(self):
+        """Hand the slot to the oldest waiting transaction, or free it. Caller holds self.lock."""
+        if self.queue and self.running <= int(self.limit):
+            self.queue.popleft().set()
+        else:
+            self.running -= 1
+
+    def observe(self, latency):
+        """Record the latency of a participant reply and adjust the limit every window replies."""
+        with self.lock:
+            self.samples.append(latency)
+            if len(self.samples) < self.window:
+                return
+            samples, self.samples = sorted(self.samples), []
+            median = samples[len(samples) // 2]
+            if self.average_latency is None:
+                self.average_latency = median
+            self.average_latency += (median - self.average_latency) * 0.05
+            if self.average_latency > 2 * median: # Load dropped for good: forget the slow past sooner
+                self.average_latency = (self.average_latency + median) / 2
+            gradient = max(0.5, min(1.0, self.tolerance * self.average_latency / max(median, 1e-9)))
+            target = self.limit * gradient + math.sqrt(self.limit)
+            if self.running < self.limit / 2: # Too little load to tell whether more would help
+                target = min(target, self.limit)
+            self.limit = min(max(self.limit + (target - self.limit) * self.smoothing, self.min_limit), self.max_limit)
+            while self.queue and self.running < int(self.limit): # A raised limit frees slots for waiting transactions
+                self.running += 1
+                self.queue.popleft().set()
+
+    def retry_after(self):
+        """Return the seconds a refused transaction should wait before it is resent."""
+        with self.lock:
+            return min(max((len(self.queue) + 1) * self.service_time / max(int(self.limit), 1), 0.01), 5.0)
+
+    def stats(self):
+        """Return the limit, the occupancy and the admission counters."""
+        with self.lock:
+            return {
+                "limit": int(self.limit),
+                "running": self.running,
+                "queued": len(self.queue),
+                "admitted": self.admitted,
+                "rejected": self.rejected,
+                "timeouts": self.timeouts,
+                "average_latency_ms": round(self.average_latency * 1000, 3) if self.average_latency is not None else None,
+                "service_time_ms": round(self.service_time * 1000, 3),
+            }
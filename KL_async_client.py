@@ -0,0 +1,222 @@
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+from xmlrpc.client import Fault
+from KL_binary_rpc import FRAME, REQUEST, ERROR, encode, decode
+from KL_rpc_server import make_proxy
+import asyncio
+import itertools
+import random
+import socket
+import sys
+import threading
+import time
+import uuid
+
+class TransactionIds:
+    """Generates globally unique transaction IDs that sort in creation order.
+
+    An ID is "<milliseconds>-<sequence>-<client ID>": a 13-digit wall-clock
+    timestamp, a 6-digit sequence within that millisecond and the ID of the
+    generating client, which keeps concurrent clients apart. The timestamp
+    comes first so IDs from one client sort by creation time, and IDs from
+    different clients sort by time to the millisecond. The timestamp never
+    goes backwards, even if the clock does.
+    """
+
+    def __init__(self, client_id=None):
+        self.client_id = client_id or uuid.uuid4().hex[:8] # Random by default, so client processes never collide
+        self.lock = threading.Lock()
+        self.last_ms = 0
+        self.sequence = 0
+
+    def next(self):
+        """Return a new transaction ID."""
+        with self.lock:
+            now_ms = int(time.time() * 1000)
+            if now_ms > self.last_ms:
+                self.last_ms, self.sequence = now_ms, 0
+            else: # Same millisecond, or the clock moved back
+                self.sequence += 1
+                if self.sequence > 999999: # Borrow the next millisecond
+                    self.last_ms, self.sequence = self.last_ms + 1, 0
+            return f"{self.last_ms:013d}-{self.sequence:06d}-{self.client_id}"
+
+class _AsyncConnection:
+    """One asyncio binary-protocol connection with pipelined, correlated requests."""
+
+    def __init__(self):
+        self.pending = {} # Correlation ID -> Future
+        self.ids = itertools.count(1)
+        self.alive = False
+
+    async def open(self, host, port):
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        self.writer.get_extra_info("socket").setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.alive = True
+        self.read_task = asyncio.ensure_future(self._read_loop())
+
+    async def call(self, method, args):
+        if not self.alive:
+            raise ConnectionError("Connection closed")
+        correlation_id = next(self.ids)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[correlation_id] = future
+        payload = bytes(encode([method, list(args)]))
+        self.writer.write(FRAME.pack(len(payload), correlation_id, REQUEST) + payload)
+        try:
+            await self.writer.drain() # Waits while the socket buffer is full
+        except OSError:
+            self._close()
+        return await future
+
+    async def _read_loop(self):
+        try:
+            while True:
+                length, correlation_id, kind = FRAME.unpack(await self.reader.readexactly(FRAME.size))
+                payload = await self.reader.readexactly(length)
+                future = self.pending.pop(correlation_id, None)
+                if future is None or future.done():
+                    continue
+                if kind == ERROR:
+                    future.set_exception(Fault(1, decode(payload)))
+                else:
+                    future.set_result(decode(payload))
+        except (OSError, asyncio.IncompleteReadError, ValueError):
+            pass
+        self._close()
+
+    def _close(self):
+        """Mark the connection dead and fail its outstanding requests."""
+        self.alive = False
+        self.writer.close()
+        pending, self.pending = self.pending, {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError("Connection lost"))
+
+    async def close(self):
+        self.read_task.cancel()
+        self._close()
+
+class AsyncClient:
+    """Asyncio client for the coordinator that keeps many transactions in flight.
+
+    For tcp:// endpoints requests are pipelined over a few binary-protocol
+    connections, so in-flight transactions are bounded only by max_in_flight.
+    XML-RPC cannot pipeline, so http:// endpoints run at most connections
+    calls at once on a thread pool. Either way callers that exceed
+    max_in_flight wait for a slot: this is the client-side backpressure.
+
+        async with AsyncClient("tcp://localhost:8000") as client:
+            result = await client.execute_transaction({"A": -10, "B": 10})
+    """
+
+    def __init__(self, endpoint, max_in_flight=64, connections=4, client_id=None, timeout=5):
+        self.endpoint = endpoint
+        self.binary = endpoint.startswith("tcp://")
+        self.connections = connections
+        self.timeout = timeout # Transaction timeout passed to the coordinator
+        self.ids = TransactionIds(client_id)
+        self.slots = asyncio.Semaphore(max_in_flight)
+        self.max_in_flight = max_in_flight
+        self.open_connections = [] # Binary connections
+        self.connecting = None # Lock serializing connection setup
+        self.proxy = None if self.binary else make_proxy(endpoint, connections)
+        self.executor = None if self.binary else ThreadPoolExecutor(max_workers=connections, thread_name_prefix="client")
+        self.in_flight = 0 # Calls holding a slot
+        self.completed = 0
+        self.failed = 0
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def _connection(self):
+        """Return the least busy live connection, opening one while all are busy and there is room."""
+        if self.connecting is None:
+            self.connecting = asyncio.Lock()
+        async with self.connecting:
+            self.open_connections = [c for c in self.open_connections if c.alive]
+            least_busy = min(self.open_connections, key=lambda c: len(c.pending), default=None)
+            if least_busy is not None and (not least_busy.pending or len(self.open_connections) >= self.connections):
+                return least_busy
+            parsed = urlparse(self.endpoint)
+            connection = _AsyncConnection()
+            await connection.open(parsed.hostname, parsed.port)
+            self.open_connections.append(connection)
+            return connection
+
+    async def call(self, method, *args):
+        """Call a coordinator RPC and return its reply."""
+        async with self.slots:
+            self.in_flight += 1
+            try:
+                if self.binary:
+                    return await (await self._connection()).call(method, args)
+                return await asyncio.get_running_loop().run_in_executor(self.executor, lambda: getattr(self.proxy, method)(*args))
+            finally:
+                self.in_flight -= 1
+
+    async def execute_transaction(self, legs, transaction_id=None, timeout=None):
+        """Run a transaction {account: amount} and return the coordinator's result.
+
+        A new transaction ID is generated unless one is given. The coordinator
+        drops the transaction if it cannot start it within timeout seconds.
+        """
+        transaction_id = transaction_id or self.ids.next()
+        timeout = timeout or self.timeout
+        try:
+            result = await self.call("execute_transaction", transaction_id, legs, timeout, time.time() + timeout) # The deadline includes the wait for a slot
+        except Exception:
+            self.failed += 1
+            raise
+        self.completed += 1
+        return result
+
+    async def execute_many(self, transfers, timeout=None):
+        """Run every {account: amount} transfer concurrently. Returns {txn ID: result or exception}."""
+        transaction_ids = [self.ids.next() for _ in transfers]
+        results = await asyncio.gather(*(self.execute_transaction(legs, t, timeout) for t, legs in zip(transaction_ids, transfers)), return_exceptions=True)
+        return dict(zip(transaction_ids, results))
+
+    def stats(self):
+        """Return the client counters."""
+        return {
+            "in_flight": self.in_flight,
+            "max_in_flight": self.max_in_flight,
+            "connections": len(self.open_connections) if self.binary else self.proxy.pool.stats()["size"],
+            "completed": self.completed,
+            "failed": self.failed,
+        }
+
+    async def close(self):
+        for connection in self.open_connections:
+            await connection.close()
+        self.open_connections = []
+        if self.executor:
+            self.executor.shutdown(wait=False)
+
+async def _saturate(endpoint, count, max_in_flight, accounts=200):
+    """Run count transfers between random accounts, keeping max_in_flight outstanding."""
+    rng = random.Random(1)
+    async with AsyncClient(endpoint, max_in_flight) as client:
+        names = [f"async{i}" for i in range(accounts)]
+        await asyncio.gather(*(client.call("initialize_node", name, 1000000) for name in names))
+        transfers = []
+        for _ in range(count):
+            source, target = rng.sample(names, 2)
+            transfers.append({source: -1, target: 1})
+        start = time.perf_counter()
+        results = await client.execute_many(transfers)
+        elapsed = time.perf_counter() - start
+        committed = sum(1 for result in results.values() if result == "Transaction Committed")
+        print(f"Client: {committed} of {count} transactions committed in {elapsed:.2f}s ({count / elapsed:.0f} txn/s, {max_in_flight} in flight).")
+
+if __name__ == "__main__":
+    # Usage: python KL_async_client.py [endpoint] [transactions] [max in flight]
+    endpoint = sys.argv[1] if len(sys.argv) > 1 else "http://localhost:8000"
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    max_in_flight = int(sys.argv[3]) if len(sys.argv) > 3 else 64
+    asyncio.run(_saturate(endpoint, count, max_in_flight))
@@ -0,0 +1,82 @@
+from concurrent.futures import ThreadPoolExecutor
+from KL_rpc_server import make_server, make_proxy
+import json
+import sys
+import threading
+import time
+
+class EchoParticipant:
+    """Stand-in participant whose RPCs do no work, so only transport cost is measured."""
+
+    def prepare_legs(self, transaction_id, legs):
+        return True
+
+    def commit(self, transaction_id):
+        return True
+
+def _percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+def _start_server(protocol, port):
+    server = make_server(("localhost", port), protocol, max_workers=16)
+    server.register_instance(EchoParticipant())
+    server.timeout = 0.2
+    running = threading.Event()
+    running.set()
+
+    def serve():
+        while running.is_set():
+            server.handle_request()
+        server.server_close()
+
+    threading.Thread(target=serve, daemon=True).start()
+    return running
+
+def bench_transport(protocol, port, messages=5000, concurrency=16):
+    """Measure one transport: sequential latency, CPU per message and concurrent throughput.
+
+    Client and server run in this process, so CPU per message covers both ends.
+    """
+    running = _start_server(protocol, port)
+    scheme = "tcp" if protocol == "binary" else "http"
+    proxy = make_proxy(f"{scheme}://localhost:{port}", concurrency)
+    legs = {"A": -100, "B": 100}
+    for i in range(200): # Warm up connections
+        proxy.prepare_legs(f"warmup{i}", legs)
+
+    latencies = []
+    cpu_start = time.process_time()
+    for i in range(messages):
+        start = time.perf_counter()
+        proxy.prepare_legs(f"txn{i}", legs)
+        latencies.append(time.perf_counter() - start)
+    cpu_per_message = (time.process_time() - cpu_start) / messages
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        start = time.perf_counter()
+        list(executor.map(lambda i: proxy.commit(f"txn{i}"), range(messages)))
+        elapsed = time.perf_counter() - start
+
+    running.clear()
+    return {
+        "protocol": protocol,
+        "messages": messages,
+        "cpu_us_per_message": round(cpu_per_message * 1e6, 1),
+        "p50_us": round(_percentile(latencies, 0.5) * 1e6, 1),
+        "p99_us": round(_percentile(latencies, 0.99) * 1e6, 1),
+        "concurrent_msgs_per_sec": round(messages / elapsed),
+        "pool": proxy.pool.stats(),
+    }
+
+def main(messages=5000):
+    results = [bench_transport("xmlrpc", 8100, messages), bench_transport("binary", 8101, messages)]
+    print(f"{'protocol':<8} {'CPU us/msg':>11} {'p50 us':>8} {'p99 us':>8} {'msgs/s (16 threads)':>20}")
+    for r in results:
+        print(f"{r['protocol']:<8} {r['cpu_us_per_message']:>11} {r['p50_us']:>8} {r['p99_us']:>8} {r['concurrent_msgs_per_sec']:>20}")
+    with open("bench_transport.json", "w") as f:
+        json.dump(results, f, indent=2)
+    print("Results written to bench_transport.json")
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5000)
@@ -0,0 +1,216 @@
+from concurrent.futures import ThreadPoolExecutor
+from KL_admission import EXPIRED, retry_after
+from KL_cluster import Cluster, connect, load_config
+import argparse
+import bisect
+import json
+import os
+import random
+import subprocess
+import threading
+import time
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+class Workload:
+    """Generates transfers between benchmark accounts.
+
+    Accounts are drawn uniformly or from a Zipf distribution with exponent
+    zipf_s (rank 1 is the hottest). With probability conflict_rate one side of a
+    transfer is the single hot account, which makes transactions contend on it.
+    """
+
+    def __init__(self, accounts, distribution="uniform", zipf_s=1.0, conflict_rate=0.0, min_amount=1, max_amount=10, seed=None):
+        self.accounts = accounts
+        self.distribution = distribution
+        self.conflict_rate = conflict_rate
+        self.min_amount = min_amount
+        self.max_amount = max_amount
+        self.random = random.Random(seed)
+        self.lock = threading.Lock() # random.Random is shared by every client thread
+        self.cumulative = [] # Zipf CDF over account ranks
+        total = 0.0
+        for rank in range(1, len(accounts) + 1):
+            total += 1 / rank ** zipf_s
+            self.cumulative.append(total)
+
+    def _pick(self):
+        if self.distribution == "zipf":
+            return bisect.bisect_left(self.cumulative, self.random.random() * self.cumulative[-1])
+        return self.random.randrange(len(self.accounts))
+
+    def next_transfer(self):
+        """Return {account: amount} legs of a transfer between two distinct accounts."""
+        with self.lock:
+            source = self._pick()
+            target = self._pick()
+            while target == source:
+                target = self._pick()
+            if self.random.random() < self.conflict_rate:
+                if self.random.random() < 0.5:
+                    source = 0 if target != 0 else source
+                else:
+                    target = 0 if source != 0 else target
+            amount = self.random.randint(self.min_amount, self.max_amount)
+        return {self.accounts[source]: -amount, self.accounts[target]: amount}
+
+def percentiles(latencies):
+    """Return count, mean and p50/p99/p999 of latencies given in seconds, in milliseconds."""
+    if not latencies:
+        return {"count": 0}
+    ordered = sorted(latencies)
+    pick = lambda q: round(ordered[min(len(ordered) - 1, int(len(ordered) * q))] * 1000, 3)
+    return {
+        "count": len(ordered),
+        "mean": round(sum(ordered) / len(ordered) * 1000, 3),
+        "p50": pick(0.5),
+        "p99": pick(0.99),
+        "p999": pick(0.999),
+        "max": round(ordered[-1] * 1000, 3),
+    }
+
+class Benchmark:
+    """Drives a coordinator with concurrent clients and collects per-outcome latencies.
+
+    Closed loop: each client sends its next transaction when the previous one
+    returns. Open loop: transactions arrive as a Poisson process at rate per
+    second regardless of completions, and latency is measured from the scheduled
+    arrival so queueing delay is included.
+    """
+
+    def __init__(self, coordinator_endpoint, workload, clients=8, mode="closed", rate=100, duration=10, warmup=1, timeout=5):
+        self.coordinator = connect(coordinator_endpoint, clients)
+        self.workload = workload
+        self.clients = clients
+        self.mode = mode
+        self.rate = rate
+        self.duration = duration
+        self.warmup = warmup
+        self.timeout = timeout
+        self.run_id = f"bench-{int(time.time())}-{os.getpid()}"
+        self.sequence = iter(range(1 << 62)) # next() on a range iterator is atomic in CPython
+        self.samples = [] # (outcome, latency in seconds, completed at)
+
+    def _transact(self, scheduled):
+        transaction_id = f"{self.run_id}-{next(self.sequence)}"
+        try:
+            result = self.coordinator.execute_transaction(transaction_id, self.workload.next_transfer(), self.timeout)
+            outcome = {"Transaction Committed": "commit", "Transaction Aborted": "abort", EXPIRED: "shed"}.get(result, "shed" if retry_after(result) is not None else "error")
+        except Exception:
+            outcome = "error"
+        now = time.perf_counter()
+        self.samples.append((outcome, now - scheduled, now))
+
+    def _closed_loop(self, deadline):
+        while time.perf_counter() < deadline:
+            self._transact(time.perf_counter())
+
+    def run(self):
+        """Run the load and return the measured results."""
+        start = time.perf_counter()
+        deadline = start + self.warmup + self.duration
+        if self.mode == "closed":
+            threads = [threading.Thread(target=self._closed_loop, args=(deadline,)) for _ in range(self.clients)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        else:
+            rng = random.Random()
+            with ThreadPoolExecutor(max_workers=self.clients) as executor:
+                scheduled = start
+                while scheduled < deadline:
+                    scheduled += rng.expovariate(self.rate)
+                    delay = scheduled - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+                    executor.submit(self._transact, scheduled)
+        measured = [s for s in self.samples if start + self.warmup <= s[2] <= deadline]
+        by_outcome = {outcome: [latency for o, latency, _ in measured if o == outcome] for outcome in ("commit", "abort", "shed", "error")}
+        return {
+            "throughput": {
+                "transactions_per_sec": round(len(measured) / self.duration, 2),
+                "commits_per_sec": round(len(by_outcome["commit"]) / self.duration, 2),
+            },
+            "counts": {outcome: len(latencies) for outcome, latencies in by_outcome.items()},
+            "latency_ms": {
+                "all": percentiles([latency for _, latency, _ in measured]),
+                **{outcome: percentiles(latencies) for outcome, latencies in by_outcome.items() if outcome not in ("shed", "error")},
+            },
+        }
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load generator and benchmark for the 2PC cluster.")
+    parser.add_argument("--coordinator", help="Endpoint of a running coordinator, or comma-separated endpoints of its partitions; by default a local cluster is started")
+    parser.add_argument("--coordinators", type=int, default=1, help="Coordinator partitions in the local cluster")
+    parser.add_argument("--in-process", action="store_true", help="Run the local cluster in this process; implied by --protocol local")
+    parser.add_argument("--nodes", type=int, default=2, help="Participants in the local cluster")
+    parser.add_argument("--base-port", type=int, default=9000, help="First coordinator port of the local cluster; participants use the ports after the coordinators")
+    parser.add_argument("--protocol", choices=["xmlrpc", "binary", "local"], default="xmlrpc", help="local calls in-process members directly, without sockets or serialization")
+    parser.add_argument("--escrow", action="store_true", help="Run the local participants in escrow mode")
+    parser.add_argument("--accounts", type=int, default=1000)
+    parser.add_argument("--initial-balance", type=int, default=1000000)
+    parser.add_argument("--distribution", choices=["uniform", "zipf"], default="uniform")
+    parser.add_argument("--zipf-s", type=float, default=1.0, help="Zipf exponent")
+    parser.add_argument("--conflict-rate", type=float, default=0.0, help="Fraction of transfers that touch the hot account")
+    parser.add_argument("--min-amount", type=int, default=1)
+    parser.add_argument("--max-amount", type=int, default=10)
+    parser.add_argument("--clients", type=int, default=8, help="Concurrent clients (closed loop) or maximum outstanding requests (open loop)")
+    parser.add_argument("--mode", choices=["closed", "open"], default="closed")
+    parser.add_argument("--rate", type=float, default=100, help="Arrivals per second in open-loop mode")
+    parser.add_argument("--duration", type=float, default=10, help="Measured seconds")
+    parser.add_argument("--warmup", type=float, default=1, help="Seconds excluded from the results")
+    parser.add_argument("--timeout", type=float, default=5, help="Transaction timeout passed to the coordinator")
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--output", default="bench_results.json", help="JSON results file")
+    args = parser.parse_args(argv)
+
+    cluster = None
+    endpoint = args.coordinator.split(",") if args.coordinator else None
+    if endpoint is None:
+        cluster = Cluster(load_config(
+            protocol=args.protocol,
+            mode="inprocess" if args.in_process or args.protocol == "local" else "processes",
+            base_port=args.base_port,
+            coordinators=args.coordinators,
+            nodes=args.nodes,
+            coordinator={"max_concurrency": 16, "log_level": "WARNING", "schedule_conflicts": not args.escrow}, # Escrow participants need no conflict scheduling
+            node={"log_level": "WARNING", "escrow": args.escrow},
+        ))
+        cluster.start()
+        endpoint = cluster.coordinator_routes()
+    try:
+        coordinator = connect(endpoint, 1)
+        accounts = [f"bench{i}" for i in range(args.accounts)]
+        for account in accounts:
+            coordinator.initialize_node(account, args.initial_balance)
+        workload = Workload(accounts, args.distribution, args.zipf_s, args.conflict_rate, args.min_amount, args.max_amount, args.seed)
+        print(f"Benchmark: {args.mode} loop, {args.clients} clients, {args.accounts} {args.distribution} accounts, {args.duration}s.")
+        results = Benchmark(endpoint, workload, args.clients, args.mode, args.rate, args.duration, args.warmup, args.timeout).run()
+        time.sleep(args.timeout) # Let late phase-2 cleanups finish before checking the totals
+        total = sum(coordinator.get_account_balance(account) for account in accounts)
+        results["conserved"] = abs(total - args.initial_balance * args.accounts) < 0.005
+    finally:
+        if cluster:
+            cluster.stop()
+
+    results = {"revision": git_revision(), "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"), "config": vars(args), **results}
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+
+    print(f"Throughput: {results['throughput']['transactions_per_sec']} txn/s ({results['throughput']['commits_per_sec']} commits/s)")
+    for outcome in ("all", "commit", "abort"):
+        stats = results["latency_ms"][outcome]
+        if stats["count"]:
+            print(f"  {outcome:<6} n={stats['count']:<7} p50={stats['p50']}ms p99={stats['p99']}ms p999={stats['p999']}ms")
+    print(f"Shed by the coordinator: {results['counts']['shed']}. Errors: {results['counts']['error']}. Money conserved: {results['conserved']}. Results written to {args.output}")
+    return results
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,317 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+from urllib.parse import urlparse
+from xmlrpc.client import Fault
+import itertools
+import socket
+import struct
+import threading
+import time
+
+# Frame: payload length, correlation ID, frame kind, then the encoded payload
+FRAME = struct.Struct("<IQB")
+REQUEST, REPLY, ERROR = 0, 1, 2
+
+_INT64 = struct.Struct("<q")
+_FLOAT = struct.Struct("<d")
+_LENGTH = struct.Struct("<I")
+
+def encode(value, out=None):
+    """Encode None, bool, int, float, str, bytes, list/tuple and dict values compactly."""
+    out = bytearray() if out is None else out
+    if value is None:
+        out += b"N"
+    elif value is True:
+        out += b"T"
+    elif value is False:
+        out += b"F"
+    elif isinstance(value, int):
+        if -2**63 <= value < 2**63:
+            out += b"i" + _INT64.pack(value)
+        else:
+            digits = str(value).encode()
+            out += b"I" + _LENGTH.pack(len(digits)) + digits
+    elif isinstance(value, float):
+        out += b"d" + _FLOAT.pack(value)
+    elif isinstance(value, str):
+        data = value.encode()
+        out += b"s" + _LENGTH.pack(len(data)) + data
+    elif isinstance(value, (bytes, bytearray)):
+        out += b"b" + _LENGTH.pack(len(value)) + value
+    elif isinstance(value, (list, tuple)):
+        out += b"l" + _LENGTH.pack(len(value))
+        for item in value:
+            encode(item, out)
+    elif isinstance(value, dict):
+        out += b"m" + _LENGTH.pack(len(value))
+        for key, item in value.items():
+            encode(key, out)
+            encode(item, out)
+    else:
+        raise TypeError(f"Cannot encode {type(value).__name__}")
+    return out
+
+def decode(data):
+    """Decode a value produced by encode()."""
+    value, _ = _decode(memoryview(data), 0)
+    return value
+
+def _decode(data, offset):
+    tag = data[offset]
+    offset += 1
+    if tag == 0x4E: # N
+        return None, offset
+    if tag == 0x54: # T
+        return True, offset
+    if tag == 0x46: # F
+        return False, offset
+    if tag == 0x69: # i
+        return _INT64.unpack_from(data, offset)[0], offset + 8
+    if tag == 0x64: # d
+        return _FLOAT.unpack_from(data, offset)[0], offset + 8
+    if tag in (0x73, 0x62, 0x49): # s, b, I
+        length = _LENGTH.unpack_from(data, offset)[0]
+        offset += 4
+        raw = bytes(data[offset:offset + length])
+        offset += length
+        if tag == 0x73:
+            return raw.decode(), offset
+        if tag == 0x62:
+            return raw, offset
+        return int(raw), offset
+    if tag == 0x6C: # l
+        count = _LENGTH.unpack_from(data, offset)[0]
+        offset += 4
+        items = []
+        for _ in range(count):
+            item, offset = _decode(data, offset)
+            items.append(item)
+        return items, offset
+    if tag == 0x6D: # m
+        count = _LENGTH.unpack_from(data, offset)[0]
+        offset += 4
+        mapping = {}
+        for _ in range(count):
+            key, offset = _decode(data, offset)
+            mapping[key], offset = _decode(data, offset)
+        return mapping, offset
+    raise ValueError(f"Unknown type tag {tag!r}")
+
+def _read_frame(rfile):
+    """Read one frame. Returns (correlation ID, kind, payload) or None at end of stream."""
+    header = rfile.read(FRAME.size)
+    if len(header) < FRAME.size:
+        return None
+    length, correlation_id, kind = FRAME.unpack(header)
+    payload = rfile.read(length)
+    if len(payload) < length:
+        return None
+    return correlation_id, kind, payload
+
+def _frame(correlation_id, kind, payload):
+    return FRAME.pack(len(payload), correlation_id, kind) + payload
+
+class BinaryRPCServer:
+    """RPC server for the binary protocol over persistent TCP connections.
+
+    Each connection has a reader thread; requests run on a bounded worker pool and
+    replies are sent as soon as they are ready, tagged with the request's
+    correlation ID, so a client can pipeline many requests on one connection.
+    Mirrors the parts of SimpleXMLRPCServer the nodes use.
+    """
+
+    def __init__(self, addr, max_workers=16, metrics=None):
+        self.socket = socket.create_server(addr, backlog=128)
+        self.metrics = metrics # Records the time requests wait for a worker
+        self.timeout = None # Seconds handle_request() waits for a connection
+        self.instance = None
+        self.max_workers = max_workers
+        self.slots = threading.BoundedSemaphore(max_workers) # Free worker slots
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="rpc")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.server_close()
+
+    def register_instance(self, instance):
+        self.instance = instance
+
+    def handle_request(self):
+        """Accept one connection and serve it on a background thread."""
+        self.socket.settimeout(self.timeout)
+        try:
+            sock, _ = self.socket.accept()
+        except (socket.timeout, OSError):
+            return
+        sock.settimeout(None)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        threading.Thread(target=self._serve_connection, args=(sock,), daemon=True).start()
+
+    def _serve_connection(self, sock):
+        """Read requests from one connection and hand them to the worker pool."""
+        rfile = sock.makefile("rb")
+        write_lock = threading.Lock()
+        try:
+            while True:
+                frame = _read_frame(rfile)
+                if frame is None:
+                    break
+                queued_at = time.perf_counter()
+                self.slots.acquire() # Stop reading while every worker is busy
+                self.pool.submit(self._handle, sock, write_lock, queued_at, *frame)
+        except OSError:
+            pass
+        finally:
+            rfile.close()
+            sock.close()
+
+    def _handle(self, sock, write_lock, queued_at, correlation_id, kind, payload):
+        """Run one request and send its reply."""
+        if self.metrics:
+            self.metrics.observe("kl_rpc_queue_wait_seconds", time.perf_counter() - queued_at)
+        try:
+            method, args = decode(payload)
+            if method.startswith("_"):
+                raise AttributeError(f"Method {method} is not supported")
+            reply = _frame(correlation_id, REPLY, bytes(encode(getattr(self.instance, method)(*args))))
+        except Exception as e:
+            reply = _frame(correlation_id, ERROR, bytes(encode(f"{type(e).__name__}: {e}")))
+        finally:
+            self.slots.release()
+        try:
+            with write_lock:
+                sock.sendall(reply)
+        except OSError:
+            pass # Client went away
+
+    def server_close(self):
+        self.socket.close()
+        self.pool.shutdown(wait=False)
+
+class _Connection:
+    """One persistent client connection with pipelined, correlated requests."""
+
+    def __init__(self, host, port):
+        self.sock = socket.create_connection((host, port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.rfile = self.sock.makefile("rb")
+        self.write_lock = threading.Lock()
+        self.pending = {} # Correlation ID -> Future
+        self.ids = itertools.count(1)
+        self.alive = True
+        threading.Thread(target=self._read_loop, daemon=True).start()
+
+    def send(self, method, args):
+        """Send a request and return a Future for its reply."""
+        future = Future()
+        payload = bytes(encode([method, list(args)]))
+        with self.write_lock:
+            if not self.alive:
+                raise ConnectionError("Connection closed")
+            correlation_id = next(self.ids)
+            self.pending[correlation_id] = future
+            try:
+                self.sock.sendall(_frame(correlation_id, REQUEST, payload))
+            except OSError:
+                self.pending.pop(correlation_id, None)
+                self._close()
+                raise
+        return future
+
+    def _read_loop(self):
+        try:
+            while True:
+                frame = _read_frame(self.rfile)
+                if frame is None:
+                    break
+                correlation_id, kind, payload = frame
+                future = self.pending.pop(correlation_id, None)
+                if future is None:
+                    continue
+                if kind == ERROR:
+                    future.set_exception(Fault(1, decode(payload)))
+                else:
+                    future.set_result(decode(payload))
+        except (OSError, ValueError):
+            pass
+        with self.write_lock:
+            self._close()
+
+    def _close(self):
+        """Mark the connection dead and fail its outstanding requests."""
+        self.alive = False
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+        pending, self.pending = self.pending, {}
+        for future in pending.values():
+            future.set_exception(ConnectionError("Connection lost"))
+
+class BinaryConnectionPool:
+    """A few persistent binary-protocol connections to one endpoint.
+
+    Requests are pipelined, so callers never wait for a free connection; each
+    call goes to the connection with the fewest outstanding requests. Dead
+    connections are replaced on the next call.
+    """
+
+    def __init__(self, endpoint, max_size=2):
+        parsed = urlparse(endpoint)
+        self.endpoint = endpoint
+        self.host, self.port = parsed.hostname, parsed.port
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.connections = []
+        self.calls = 0
+        self.reconnects = 0 # Connections replaced after a failure
+
+    def _connection(self):
+        with self.lock:
+            self.calls += 1
+            dead = [c for c in self.connections if not c.alive]
+            if dead:
+                self.connections = [c for c in self.connections if c.alive]
+                self.reconnects += len(dead)
+            least_busy = min(self.connections, key=lambda c: len(c.pending), default=None)
+            if least_busy is not None and (not least_busy.pending or len(self.connections) >= self.max_size):
+                return least_busy
+            connection = _Connection(self.host, self.port) # Every connection is busy and the pool has room
+            self.connections.append(connection)
+            return connection
+
+    def call_async(self, method, *args):
+        """Send a request and return a Future for its reply."""
+        return self._connection().send(method, args)
+
+    def call(self, method, *args):
+        """Call a remote method and wait for its reply."""
+        return self.call_async(method, *args).result()
+
+    def stats(self):
+        """Return the pool counters."""
+        with self.lock:
+            in_flight = sum(len(c.pending) for c in self.connections)
+            return {
+                "endpoint": self.endpoint,
+                "size": len(self.connections),
+                "idle": sum(1 for c in self.connections if not c.pending),
+                "in_use": sum(1 for c in self.connections if c.pending),
+                "max_size": self.max_size,
+                "calls": self.calls,
+                "waits": 0, # Pipelined calls never wait for a connection
+                "reconnects": self.reconnects,
+                "in_flight": in_flight,
+            }
+
+class BinaryProxy:
+    """Thread-safe proxy for a tcp:// endpoint; proxy.method(*args) calls the remote method."""
+
+    def __init__(self, endpoint, max_size=2):
+        self.pool = BinaryConnectionPool(endpoint, max_size)
+
+    def __getattr__(self, method):
+        if method.startswith("__"):
+            raise AttributeError(method)
+        return lambda *args: self.pool.call(method, *args)
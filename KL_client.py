@@ -1,9 +1,10 @@
-import xmlrpc.client
+from KL_rpc_server import make_proxy
+from KL_async_client import TransactionIds
 import time
 
 # Connect to the coordinator and nodes
-coordinator = xmlrpc.client.ServerProxy("http://localhost:8000")
-transaction_id = 0
+coordinator = make_proxy("http://localhost:8000") # Use tcp://localhost:8000 when the cluster runs the binary protocol
+transaction_ids = TransactionIds() # Unique across client processes, unlike a per-process counter
 
 def initialize_nodes(account_a=200, account_b=300):
     """Initialize node balances via the Coordinator."""
@@ -31,9 +32,7 @@ def set_simulation_case(case_number):
 
 def execute_transaction(txn_a, txn_b):
     """Execute a transaction via the Coordinator."""
-    global transaction_id
-    transaction_id = transaction_id + 1
-    txn_id = "txn" + str(transaction_id)
+    txn_id = transaction_ids.next()
     print(f"\nClient: Executing transaction {txn_id}:")
     txn_details = {"A": txn_a, "B": txn_b}  # Transfer 100 from A to B
     print(f"  A: {txn_a}\n  B: {txn_b}")
@@ -45,6 +44,19 @@ def execute_transaction(txn_a, txn_b):
         print(f"Failed to contact coordinator: {e}.")
         return False
 
+def execute_batch(transfers):
+    """Execute a list of (txn_a, txn_b) transfers as one batch via the Coordinator."""
+    batch = [[transaction_ids.next(), {"A": txn_a, "B": txn_b}] for txn_a, txn_b in transfers]
+    print(f"\nClient: Executing batch of {len(batch)} transactions.")
+    try:
+        results = coordinator.execute_batch(batch)
+        committed = sum(1 for result in results.values() if result == "Transaction Committed")
+        print(f"Client: Batch result: {committed} committed, {len(results) - committed} aborted")
+        return results
+    except Exception as e:
+        print(f"Failed to contact coordinator: {e}.")
+        return None
+
 def scenarios(accout_a, account_b, case_number=0):
     """Sets up the scenarios for each test case."""
     if not initialize_nodes(accout_a, account_b):
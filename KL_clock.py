@@ -0,0 +1,26 @@
+import threading
+import time
+
+class SystemClock:
+    """Wall-clock time. The clock of every node unless a simulation passes its own."""
+
+    def time(self):
+        return time.time()
+
+class VirtualClock:
+    """Clock that only moves when advanced, so a simulation decides when timeouts expire."""
+
+    def __init__(self, start=1_000_000_000.0):
+        self.now = start
+        self.lock = threading.Lock()
+
+    def time(self):
+        return self.now
+
+    def advance(self, seconds):
+        """Move the clock forward and return the new time."""
+        with self.lock:
+            self.now += seconds
+            return self.now
+
+SYSTEM_CLOCK = SystemClock()
@@ -0,0 +1,244 @@
+from KL_rpc_server import SCHEMES, make_proxy
+from KL_routing import CoordinatorRouter
+import argparse
+import json
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# The lab cluster of KL_node1.py, KL_node2.py and KL_node3.py
+DEFAULT_CONFIG = {
+    "protocol": "xmlrpc", # xmlrpc, binary, or local (in-process only)
+    "mode": "processes", # processes, or inprocess: every member in this process
+    "host": "localhost",
+    "base_port": 8000, # Coordinators, then standbys, then participants take consecutive ports
+    "workdir": None, # Directory of the logs and account files; a scratch directory by default
+    "coordinators": 1, # Partitions of the transaction IDs, one coordinator each
+    "standbys": False, # Start a standby for every coordinator
+    "coordinator": {"pins": {"A": "Node-2", "B": "Node-3"}}, # Coordinator keyword arguments
+    "nodes": [ # NodeBase keyword arguments, by node; or a number of default nodes
+        {"node_name": "Node-2", "account": "A", "initial_balance": 200},
+        {"node_name": "Node-3", "account": "B", "initial_balance": 300},
+    ],
+    "node": {}, # Keyword arguments for every node
+}
+
+def load_config(path=None, **overrides):
+    """Return the default config updated with a JSON config file and overrides."""
+    config = json.loads(json.dumps(DEFAULT_CONFIG)) # Deep copy
+    if path:
+        with open(path) as f:
+            config.update(json.load(f))
+    config.update({key: value for key, value in overrides.items() if value is not None})
+    if isinstance(config["nodes"], int):
+        config["nodes"] = [{"node_name": f"Node-{i + 2}"} for i in range(config["nodes"])]
+    if config["protocol"] == "local" and config["mode"] != "inprocess":
+        raise ValueError("The local protocol only works with mode inprocess")
+    return config
+
+def connect(endpoints, max_size=8):
+    """Return a proxy for one coordinator, or a router for a list of coordinator partitions."""
+    if isinstance(endpoints, list) and len(endpoints) > 1:
+        return CoordinatorRouter(endpoints, max_size)
+    return make_proxy(endpoints[0] if isinstance(endpoints, list) else endpoints, max_size)
+
+class Cluster:
+    """Coordinators and participants started from one config, as processes or in this process.
+
+    In process, members run on threads and, with the local protocol, call each
+    other directly, so no time goes to sockets or serialization. Comparing a
+    local cluster with an xmlrpc or binary one separates the cost of the
+    protocol from the cost of the network.
+
+        with Cluster(load_config(protocol="local", mode="inprocess")) as cluster:
+            cluster.client().execute_transaction("t1", {"A": -10, "B": 10})
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.workdir = config["workdir"] or tempfile.mkdtemp(prefix="kl_cluster_")
+        self.scratch = config["workdir"] is None # Removed on stop
+        os.makedirs(self.workdir, exist_ok=True)
+        scheme, host, port = SCHEMES[config["protocol"]], config["host"], config["base_port"]
+        partitions = config["coordinators"]
+        self.coordinator_endpoints = [f"{scheme}://{host}:{port + p}" for p in range(partitions)]
+        self.standby_endpoints = [f"{scheme}://{host}:{port + partitions + p}" for p in range(partitions)] if config["standbys"] else []
+        first_node = port + partitions * (2 if config["standbys"] else 1)
+        self.node_endpoints = {node["node_name"]: f"{scheme}://{host}:{first_node + i}" for i, node in enumerate(config["nodes"])}
+        self.processes = {} # Member name -> Popen
+        self.threads = {} # Member name -> server thread, in process
+        self.members = {} # Member name -> Coordinator or NodeBase, in process
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def member_names(self):
+        """Return every member in start order: the node names, coordinator-<p> and standby-<p>."""
+        names = list(self.node_endpoints) + [f"coordinator-{p}" for p in range(len(self.coordinator_endpoints))]
+        return names + [f"standby-{p}" for p in range(len(self.standby_endpoints))]
+
+    def coordinator_routes(self):
+        """Return the endpoint, or primary and standby endpoints, of every partition."""
+        if not self.standby_endpoints:
+            return list(self.coordinator_endpoints)
+        return [[primary, standby] for primary, standby in zip(self.coordinator_endpoints, self.standby_endpoints)]
+
+    def build(self, name):
+        """Create one member in this process and return (object, serve function)."""
+        from KL_node1 import Coordinator, serve_coordinator
+        from KL_node_base import NodeBase
+        config = self.config
+        host = config["host"]
+        if name in self.node_endpoints:
+            settings = next(node for node in config["nodes"] if node["node_name"] == name)
+            kwargs = {
+                "account_file": os.path.join(self.workdir, f"account_{name}.db"),
+                "initial_balance": 0,
+                "port": int(self.node_endpoints[name].rsplit(":", 1)[1]),
+                "host": host,
+                "coordinator_endpoint": self.coordinator_routes() if len(self.coordinator_endpoints) > 1 or self.standby_endpoints else self.coordinator_endpoints[0],
+                "peer_endpoints": {peer: endpoint for peer, endpoint in self.node_endpoints.items() if peer != name},
+                "protocol": config["protocol"],
+                "inactivity_threshold": None, # The launcher decides when the cluster stops
+                **config["node"],
+                **settings,
+            }
+            node = NodeBase(**kwargs)
+            return node, node.run_server
+        role, partition = name.rsplit("-", 1)
+        partition = int(partition)
+        endpoint = (self.coordinator_endpoints if role == "coordinator" else self.standby_endpoints)[partition]
+        kwargs = {
+            "log_file": os.path.join(self.workdir, "coordinator.wal" if len(self.coordinator_endpoints) == 1 else f"coordinator-{partition}.wal"),
+            "inactivity_threshold": None,
+            "partition": partition,
+            "coordinator_endpoints": self.coordinator_routes() if len(self.coordinator_endpoints) > 1 else None,
+            "standby": role == "standby",
+            **config["coordinator"],
+        }
+        coordinator = Coordinator(self.node_endpoints, **kwargs)
+        return coordinator, lambda: serve_coordinator(coordinator, host, int(endpoint.rsplit(":", 1)[1]), config["protocol"])
+
+    def start(self, timeout=15):
+        """Start every member and wait until the nodes and coordinators answer."""
+        if self.config["mode"] == "inprocess":
+            names = self.member_names()
+            standbys = [name for name in names if name.startswith("standby-")]
+            for name in [name for name in names if name not in standbys]:
+                if name.startswith("coordinator-"):
+                    self._wait_for(self.node_endpoints.values(), "heartbeat", timeout) # Or the coordinator suspects them
+                member, serve = self.build(name)
+                self.members[name] = member
+                self._serve(name, serve)
+            for name in standbys: # Blocks in its constructor until the primary's log is free
+                self._serve(name, lambda name=name: self._run_standby(name))
+        else:
+            config_path = os.path.join(self.workdir, "cluster.json")
+            with open(config_path, "w") as f:
+                json.dump({**self.config, "workdir": os.path.abspath(self.workdir)}, f, indent=2)
+            env = dict(os.environ, PYTHONPATH=REPO_DIR)
+            names = self.member_names()
+            nodes = [name for name in names if name in self.node_endpoints]
+            for name in nodes:
+                self._spawn(name, config_path, env)
+            self._wait_for(self.node_endpoints.values(), "heartbeat", timeout) # Or the coordinators suspect them
+            for name in names:
+                if name not in nodes:
+                    self._spawn(name, config_path, env)
+        self._wait_for(self.coordinator_endpoints, "is_alive", timeout)
+
+    def _spawn(self, name, config_path, env):
+        """Start one member in its own process, logging to <workdir>/<name>.log."""
+        log = open(os.path.join(self.workdir, f"{name}.log"), "w")
+        command = [sys.executable, "-u", os.path.join(REPO_DIR, "KL_cluster.py"), config_path, "--member", name]
+        self.processes[name] = subprocess.Popen(command, cwd=self.workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+    def _wait_for(self, endpoints, method, timeout):
+        """Call method on every endpoint until all of them answer."""
+        deadline = time.time() + timeout
+        while True:
+            try:
+                for endpoint in endpoints:
+                    getattr(make_proxy(endpoint, 1), method)()
+                return
+            except Exception:
+                if time.time() > deadline:
+                    self.stop(keep_files=True)
+                    raise RuntimeError(f"Cluster did not start; see the logs in {self.workdir}")
+                time.sleep(0.1)
+
+    def _serve(self, name, serve):
+        self.threads[name] = threading.Thread(target=serve, daemon=True)
+        self.threads[name].start()
+
+    def _run_standby(self, name):
+        member, serve = self.build(name)
+        self.members[name] = member
+        serve()
+
+    def client(self, max_size=8):
+        """Return a proxy for the coordinators that routes transactions by partition."""
+        return connect(self.coordinator_routes(), max_size)
+
+    def kill(self, name):
+        """Kill one member process, as a crash would."""
+        process = self.processes.pop(name)
+        process.kill()
+        process.wait()
+
+    def stop(self, keep_files=False):
+        """Stop every member, and remove a scratch workdir unless keep_files."""
+        for process in self.processes.values():
+            process.kill()
+            process.wait()
+        self.processes = {}
+        for name, member in self.members.items():
+            if hasattr(member, "shutdown_event"): # Coordinator: serve_coordinator shuts it down
+                member.shutdown_event.set()
+            else:
+                member.server_running = False
+        for name in self.members: # A standby still waiting for its log has nothing to stop
+            self.threads[name].join(timeout=5)
+        self.members, self.threads = {}, {}
+        if self.scratch and not keep_files:
+            shutil.rmtree(self.workdir, ignore_errors=True)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Start a 2PC cluster from a config.")
+    parser.add_argument("config", nargs="?", help="JSON config file; the lab cluster by default")
+    parser.add_argument("--protocol", choices=sorted(SCHEMES))
+    parser.add_argument("--mode", choices=["processes", "inprocess"])
+    parser.add_argument("--member", help="Run only this member in the foreground (used by mode processes)")
+    args = parser.parse_args(argv)
+    config = load_config(args.config, protocol=args.protocol, mode=args.mode)
+
+    cluster = Cluster(config)
+    if args.member:
+        os.chdir(cluster.workdir)
+        member, serve = cluster.build(args.member)
+        serve()
+        return
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0)) # Stop the members on kill too
+    cluster.start()
+    print(f"Cluster running in {cluster.workdir}: coordinators {cluster.coordinator_routes()}, nodes {cluster.node_endpoints}. Ctrl-C stops it.")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        cluster.stop()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+from collections import deque
+from KL_clock import SYSTEM_CLOCK
+import math
+import threading
+
+class PhiAccrualDetector:
+    """Phi-accrual failure detector for one monitored process.
+
+    Keeps a sliding window of intervals between heartbeats and models them as a
+    normal distribution. phi is -log10 of the probability that a heartbeat is
+    still this late, so it grows continuously while the process stays silent
+    instead of flipping at a fixed timeout. A failed call marks the process as
+    failed until its next heartbeat.
+    """
+
+    def __init__(self, window=100, min_std=0.2, clock=SYSTEM_CLOCK):
+        self.clock = clock
+        self.intervals = deque(maxlen=window) # Seconds between heartbeats
+        self.min_std = min_std # Floor on the interval deviation, so a steady process is not suspected over jitter
+        self.last = None # Time of the last heartbeat
+        self.failed = False # True after a call failed outright
+
+    def heartbeat(self, now=None):
+        """Record a heartbeat (or any reply) from the process."""
+        now = self.clock.time() if now is None else now
+        if self.last is not None:
+            self.intervals.append(now - self.last)
+        self.last = now
+        self.failed = False
+
+    def fail(self):
+        """Record a failed call, such as a refused connection."""
+        self.failed = True
+
+    def phi(self, now=None):
+        """Return the suspicion level: 0 right after a heartbeat, infinite after a failure."""
+        if self.failed:
+            return math.inf
+        if self.last is None or not self.intervals:
+            return 0.0
+        now = self.clock.time() if now is None else now
+        mean = sum(self.intervals) / len(self.intervals)
+        std = max(math.sqrt(sum((i - mean) ** 2 for i in self.intervals) / len(self.intervals)), self.min_std)
+        p_later = 0.5 * math.erfc((now - self.last - mean) / (std * math.sqrt(2)))
+        return -math.log10(max(p_later, 1e-300))
+
+class FailureDetector:
+    """Heartbeat failure detector and RPC latency tracker for a set of nodes.
+
+    A node is suspected when its phi exceeds threshold. Call timeouts are sized
+    from a sliding window of observed RPC latencies: twice the 99th percentile,
+    kept between min_timeout and max_timeout.
+    """
+
+    def __init__(self, threshold=8, window=100, min_std=0.2, min_timeout=1.5, max_timeout=5, clock=SYSTEM_CLOCK):
+        self.clock = clock # Heartbeat times; latencies are always measured in real time
+        self.threshold = threshold
+        self.window = window
+        self.min_std = min_std
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.lock = threading.Lock()
+        self.detectors = {} # {node: PhiAccrualDetector}
+        self.latencies = {} # Recent RPC latencies in seconds: {node: deque}
+
+    def _detector(self, node):
+        if node not in self.detectors:
+            self.detectors[node] = PhiAccrualDetector(self.window, self.min_std, self.clock)
+            self.latencies[node] = deque(maxlen=self.window)
+        return self.detectors[node]
+
+    def heartbeat(self, node, latency=None):
+        """Record a reply from node, and its round-trip time if known."""
+        with self.lock:
+            self._detector(node).heartbeat()
+            if latency is not None:
+                self.latencies[node].append(latency)
+
+    def fail(self, node):
+        """Record that a call to node failed outright."""
+        with self.lock:
+            self._detector(node).fail()
+
+    def phi(self, node):
+        with self.lock:
+            return self._detector(node).phi()
+
+    def is_suspected(self, node):
+        """Return True if node is probably down."""
+        return self.phi(node) > self.threshold
+
+    def suspected(self, nodes):
+        """Return the suspected nodes among nodes."""
+        return [node for node in nodes if self.is_suspected(node)]
+
+    def timeout_for(self, nodes, limit=None):
+        """Return a call timeout for a phase that waits on every node in nodes."""
+        with self.lock:
+            samples = sorted(latency for node in nodes for latency in self.latencies.get(node, ()))
+        if not samples:
+            timeout = self.max_timeout # Nothing observed yet
+        else:
+            p99 = samples[min(len(samples) - 1, int(len(samples) * 0.99))]
+            timeout = min(max(2 * p99, self.min_timeout), self.max_timeout)
+        return min(timeout, limit) if limit is not None else timeout
+
+    def stats(self):
+        """Return {node: suspicion and latency figures}."""
+        with self.lock:
+            nodes = list(self.detectors)
+        stats = {}
+        for node in nodes:
+            phi = self.phi(node)
+            with self.lock:
+                samples = sorted(self.latencies[node])
+            stats[node] = {
+                "phi": round(phi, 3) if math.isfinite(phi) else "inf",
+                "suspected": phi > self.threshold,
+                "rtt_p50_ms": round(samples[len(samples) // 2] * 1000, 3) if samples else None,
+                "timeout": round(self.timeout_for([node]), 3),
+            }
+        return stats
@@ -0,0 +1,295 @@
+from xmlrpc.client import Fault
+from KL_admission import EXPIRED, UNKNOWN, retry_after
+from KL_async_client import AsyncClient
+from KL_routing import partition_for
+from KL_wal import write_file_atomically
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+import uuid
+
+RESULTS = {"Transaction Committed": "COMMITTED", "Transaction Aborted": "ABORTED"}
+
+def parse_record(raw):
+    """Return (id or None, legs {account: amount}) of a JSONL transfer record.
+
+    A record is either {"legs": {account: amount}} or {"from": account, "to":
+    account, "amount": amount}, optionally with an "id" to use as transaction ID.
+    Raises ValueError for anything else.
+    """
+    record = json.loads(raw)
+    if not isinstance(record, dict):
+        raise ValueError("Record is not a JSON object")
+    if "legs" in record:
+        legs = record["legs"]
+    else:
+        amount = record.get("amount")
+        if record.get("from") == record.get("to"):
+            raise ValueError("Transfer needs different from and to accounts")
+        if not isinstance(amount, (int, float)) or isinstance(amount, bool) or amount <= 0:
+            raise ValueError(f"Invalid amount {amount!r}")
+        legs = {record["from"]: -amount, record["to"]: amount}
+    if not isinstance(legs, dict) or not legs:
+        raise ValueError("Record has no legs")
+    for account, amount in legs.items():
+        if not isinstance(account, str) or not isinstance(amount, (int, float)) or isinstance(amount, bool):
+            raise ValueError(f"Invalid leg {account!r}: {amount!r}")
+    if "id" in record and not isinstance(record["id"], str):
+        raise ValueError(f"Invalid id {record['id']!r}")
+    return record.get("id"), legs
+
+class Ingestor:
+    """Streams a JSONL file of transfers through the coordinator.
+
+    Lines are read in small batches and only while fewer than max_in_flight
+    transfers are outstanding, so memory stays constant however large the file
+    is. Each record's outcome is appended to the output as a JSON line with its
+    line number and byte offset; outcomes are written as transfers finish, not
+    in file order.
+
+    The checkpoint holds the offset below which every record has its outcome
+    written, advanced only after the output is synced, and the offset below
+    which records may have been sent, made durable before a batch is sent.
+    Transaction IDs are the record's "id" or "<run ID>-<line>", so they are the
+    same on resume. Resuming skips records whose outcome is already in the
+    output. A transfer that may have reached the coordinator, after a crash or
+    a failed call, is never sent again: the coordinator forgets acknowledged
+    outcomes and presumes an abort, so only a COMMITTED answer is trusted and
+    anything else is reported UNKNOWN.
+    """
+
+    def __init__(self, path, endpoints, output="-", checkpoint=None, max_in_flight=128, connections=4,
+                 checkpoint_every=5000, retries=3, timeout=5):
+        self.path = os.path.abspath(path)
+        self.endpoints = [endpoints] if isinstance(endpoints, str) else list(endpoints) # One per coordinator partition
+        self.output_path = output
+        self.checkpoint_path = checkpoint
+        self.max_in_flight = max_in_flight
+        self.connections = connections
+        self.checkpoint_every = checkpoint_every # Outcomes between checkpoints
+        self.retries = retries # Resends of a transfer that surely never ran
+        self.timeout = timeout # Transaction timeout passed to the coordinator
+        self.run_id = uuid.uuid4().hex[:8]
+        self.offset = 0 # Byte offset of the next line to read
+        self.line = 0 # Lines read
+        self.in_flight = {} # Offset of each unfinished record -> its line number, in file order
+        self.done = set() # Offsets past the checkpoint whose outcome is already in the output
+        self.checkpointed = (0, 0) # Offset and line below which every outcome is synced
+        self.sent = 0 # Offset below which records may have been sent, as last made durable
+        self.maybe_sent = 0 # Offset below which records may have been sent before the restart
+        self.since_checkpoint = 0
+        self.stats = {"records": 0, "committed": 0, "aborted": 0, "rejected": 0, "invalid": 0, "failed": 0, "unknown": 0, "skipped": 0, "in_doubt": 0}
+
+    def _resume(self):
+        """Load the checkpoint, if any, and the outcomes already written past it."""
+        if not self.checkpoint_path or not os.path.exists(self.checkpoint_path):
+            return
+        with open(self.checkpoint_path) as f:
+            checkpoint = json.load(f)
+        if checkpoint["input"] != self.path:
+            raise ValueError(f"Checkpoint {self.checkpoint_path} belongs to {checkpoint['input']}")
+        self.run_id, self.offset, self.line = checkpoint["run_id"], checkpoint["offset"], checkpoint["line"]
+        self.checkpointed = (self.offset, self.line)
+        self.sent = self.maybe_sent = checkpoint["sent"]
+        if self.output_path == "-" or not os.path.exists(self.output_path):
+            return
+        with open(self.output_path, "rb+") as f:
+            end = f.seek(0, os.SEEK_END)
+            position = end
+            while position > 0: # Cut a line torn by the crash
+                f.seek(position - 1)
+                if f.read(1) == b"\n":
+                    break
+                position -= 1
+            if position < end:
+                f.truncate(position)
+            f.seek(0)
+            for raw in f:
+                outcome = json.loads(raw)
+                if outcome["offset"] >= self.offset:
+                    self.done.add(outcome["offset"])
+
+    def _client(self, transaction_id):
+        return self.clients[partition_for(transaction_id, len(self.clients)) if len(self.clients) > 1 else 0]
+
+    async def _outcome(self, client, transaction_id):
+        """Return the coordinator's outcome of a transaction that may have run already."""
+        outcomes = await client.call("query_outcomes", [transaction_id], "ingest")
+        return outcomes[transaction_id]
+
+    async def _submit(self, transaction_id, legs, maybe_sent):
+        """Run one transfer, resending it only while it surely never ran. Returns (result, error)."""
+        client = self._client(transaction_id)
+        if maybe_sent:
+            return await self._resolve(client, transaction_id)
+        attempt = 0
+        while True:
+            try:
+                result = await client.execute_transaction(legs, transaction_id)
+            except ConnectionRefusedError as e: # Never reached the coordinator
+                attempt += 1
+                if attempt > self.retries:
+                    return "FAILED", str(e)
+                await asyncio.sleep(min(0.1 * 2 ** attempt, 2))
+                continue
+            except (OSError, Fault, asyncio.TimeoutError): # May have run
+                return await self._resolve(client, transaction_id)
+            if result in RESULTS:
+                return RESULTS[result], None
+            if retry_after(result) is not None: # Shed before it started: back off without using up a retry
+                await asyncio.sleep(retry_after(result))
+                continue
+            if result == EXPIRED: # Dropped before prepare
+                attempt += 1
+                if attempt > self.retries:
+                    return "FAILED", result
+                continue
+            if result == UNKNOWN: # A one-phase commit the coordinator cannot resolve either
+                return "UNKNOWN", result
+            return "REJECTED", result
+
+    async def _resolve(self, client, transaction_id):
+        """Find out how a transfer that may have run ended, without sending it again. Returns (result, error)."""
+        error = None
+        deadline = time.perf_counter() + 2 * self.timeout # Long enough for the coordinator to decide
+        attempt = 0
+        while True:
+            try:
+                outcome = await self._outcome(client, transaction_id)
+                if outcome == "COMMITTED":
+                    return "COMMITTED", None
+                if outcome != "PENDING":
+                    return "UNKNOWN", "No outcome kept: aborted, never run, or committed and already forgotten"
+                error = "Transaction still pending"
+            except (OSError, Fault, asyncio.TimeoutError) as e:
+                error = str(e) or type(e).__name__
+            attempt += 1
+            if time.perf_counter() >= deadline:
+                return "UNKNOWN", error
+            await asyncio.sleep(min(0.1 * 2 ** attempt, 1))
+
+    async def _process(self, offset, line, raw, maybe_sent, slots):
+        try:
+            outcome = {"line": line, "offset": offset}
+            try:
+                record_id, legs = parse_record(raw)
+            except (ValueError, KeyError, TypeError) as e:
+                outcome.update(result="INVALID", error=str(e))
+            else:
+                outcome["txn"] = record_id or f"{self.run_id}-{line}"
+                result, error = await self._submit(outcome["txn"], legs, maybe_sent)
+                outcome["result"] = result
+                if error:
+                    outcome["error"] = error
+                if maybe_sent:
+                    outcome["in_doubt"] = True # Sent before the restart, or maybe sent
+                    self.stats["in_doubt"] += 1
+            self.stats[outcome["result"].lower()] += 1
+            self.output.write(json.dumps(outcome) + "\n")
+            del self.in_flight[offset]
+            self.since_checkpoint += 1
+            if self.since_checkpoint >= self.checkpoint_every:
+                self._checkpoint()
+        finally:
+            slots.release()
+
+    def _checkpoint(self):
+        """Sync the output, then record the offset below which every record is done."""
+        self.since_checkpoint = 0
+        self.output.flush()
+        if self.output is not sys.stdout:
+            os.fsync(self.output.fileno())
+        offset, line = next(iter(self.in_flight.items()), (self.offset, self.line + 1))
+        self.checkpointed = (offset, line - 1)
+        self._write_checkpoint()
+
+    def _mark_sent(self, offset):
+        """Make it durable that records below offset may have been sent."""
+        self.sent = offset
+        self._write_checkpoint()
+
+    def _write_checkpoint(self):
+        if self.checkpoint_path:
+            offset, line = self.checkpointed
+            write_file_atomically(self.checkpoint_path, json.dumps({"input": self.path, "run_id": self.run_id, "offset": offset, "line": line, "sent": self.sent}))
+
+    async def run(self):
+        """Ingest the file from the checkpoint on and return the counters."""
+        self._resume()
+        self.output = sys.stdout if self.output_path == "-" else open(self.output_path, "a")
+        self._checkpoint() # Fixes the run ID before anything is sent
+        self.clients = [AsyncClient(endpoint, self.max_in_flight, self.connections, timeout=self.timeout) for endpoint in self.endpoints]
+        slots = asyncio.Semaphore(self.max_in_flight) # Backpressure: lines are read only when slots free
+        batch_size = max(1, self.max_in_flight // 4) # Records per durable sent mark
+        tasks = set()
+        start = time.perf_counter()
+        try:
+            with open(self.path, "rb") as f:
+                f.seek(self.offset)
+                while True:
+                    for _ in range(batch_size):
+                        await slots.acquire()
+                    batch = []
+                    while len(batch) < batch_size:
+                        raw = f.readline()
+                        if not raw:
+                            break
+                        offset, self.offset = self.offset, self.offset + len(raw)
+                        self.line += 1
+                        if not raw.strip() or offset in self.done:
+                            self.stats["skipped"] += bool(raw.strip())
+                            self.done.discard(offset)
+                            continue
+                        batch.append((offset, self.line, raw))
+                    for _ in range(batch_size - len(batch)):
+                        slots.release()
+                    if not batch:
+                        break
+                    if self.offset > self.sent:
+                        self._mark_sent(self.offset) # Before any of the batch is sent
+                    for offset, line, raw in batch:
+                        self.stats["records"] += 1
+                        self.in_flight[offset] = line
+                        task = asyncio.ensure_future(self._process(offset, line, raw, offset < self.maybe_sent, slots))
+                        tasks.add(task)
+                        task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            self._checkpoint()
+            if self.output is not sys.stdout:
+                self.output.close()
+            for client in self.clients:
+                await client.close()
+        self.stats["seconds"] = round(time.perf_counter() - start, 3)
+        return self.stats
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Stream a JSONL file of transfers through the coordinator.")
+    parser.add_argument("input", help="JSONL file of {\"from\", \"to\", \"amount\"} or {\"legs\"} records")
+    parser.add_argument("--coordinator", default="http://localhost:8000", help="Coordinator endpoint, or comma-separated endpoints of its partitions")
+    parser.add_argument("--output", default="-", help="JSONL file the outcomes are appended to; - for stdout")
+    parser.add_argument("--checkpoint", help="Checkpoint file to resume from; defaults to <input>.checkpoint when --output is a file")
+    parser.add_argument("--max-in-flight", type=int, default=128, help="Transfers outstanding at once")
+    parser.add_argument("--connections", type=int, default=4)
+    parser.add_argument("--checkpoint-every", type=int, default=5000, help="Outcomes between checkpoints")
+    parser.add_argument("--retries", type=int, default=3, help="Resends of a transfer that surely never ran")
+    parser.add_argument("--timeout", type=float, default=5, help="Transaction timeout passed to the coordinator")
+    args = parser.parse_args(argv)
+
+    checkpoint = args.checkpoint or (args.input + ".checkpoint" if args.output != "-" else None)
+    ingestor = Ingestor(args.input, args.coordinator.split(","), args.output, checkpoint, args.max_in_flight,
+                        args.connections, args.checkpoint_every, args.retries, args.timeout)
+    stats = asyncio.run(ingestor.run())
+    print(f"Ingested {stats['records']} records in {stats['seconds']:.2f}s ({stats['records'] / max(stats['seconds'], 1e-9):.0f} records/s): "
+          f"{stats['committed']} committed, {stats['aborted']} aborted, {stats['rejected']} rejected, {stats['invalid']} invalid, "
+          f"{stats['failed']} failed, {stats['unknown']} unknown, {stats['skipped']} already done, {stats['in_doubt']} in doubt.", file=sys.stderr)
+    return 1 if stats["failed"] or stats["unknown"] else 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
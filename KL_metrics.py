@@ -0,0 +1,108 @@
+from contextlib import contextmanager
+import bisect
+import threading
+import time
+
+# Histogram bucket upper bounds in seconds: 100us doubling up to about 13s
+BUCKETS = [0.0001 * 2 ** i for i in range(18)]
+
+class Metrics:
+    """Registry of counters and latency histograms.
+
+    A series is a metric name plus keyword labels, e.g.
+    metrics.observe("kl_rpc_seconds", 0.002, phase="prepare", node="Node-2").
+    Histograms use fixed buckets, so recording is a lock, a bisect and two
+    additions, cheap enough to stay on under load.
+    """
+
+    def __init__(self, prefix_labels=None):
+        self.prefix_labels = tuple(sorted((prefix_labels or {}).items())) # Added to every series, e.g. the node name
+        self.lock = threading.Lock()
+        self.counters = {} # {(name, labels): value}
+        self.histograms = {} # {(name, labels): [bucket counts..., +Inf count, sum]}
+
+    def inc(self, name, value=1, **labels):
+        """Add value to a counter."""
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        """Record one duration in a histogram."""
+        key = (name, tuple(sorted(labels.items())))
+        index = bisect.bisect_left(BUCKETS, seconds)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [0] * (len(BUCKETS) + 2)
+            histogram[index] += 1
+            histogram[-1] += seconds
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Time the body of a with statement into a histogram."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def _series(self, name, labels):
+        labels = self.prefix_labels + labels
+        if not labels:
+            return name
+        return name + "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+    def snapshot(self):
+        """Return every counter and histogram as plain data: {"counters": {...}, "histograms": {...}}."""
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {key: list(h) for key, h in self.histograms.items()}
+        result = {"counters": {self._series(*key): value for key, value in counters.items()}, "histograms": {}}
+        for key, histogram in histograms.items():
+            count = sum(histogram[:-1])
+            result["histograms"][self._series(*key)] = {
+                "count": count,
+                "sum": round(histogram[-1], 6),
+                "p50": self._quantile(histogram, count, 0.5),
+                "p99": self._quantile(histogram, count, 0.99),
+                "p999": self._quantile(histogram, count, 0.999),
+            }
+        return result
+
+    def _quantile(self, histogram, count, q):
+        """Upper bound of the bucket holding quantile q, in seconds."""
+        if not count:
+            return 0
+        rank = q * count
+        seen = 0
+        for index, bucket_count in enumerate(histogram[:-1]):
+            seen += bucket_count
+            if seen >= rank:
+                return BUCKETS[index] if index < len(BUCKETS) else BUCKETS[-1]
+        return BUCKETS[-1]
+
+    def prometheus_text(self):
+        """Return every series in the Prometheus text exposition format."""
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, list(h)) for key, h in self.histograms.items())
+        lines = []
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                lines.append(f"# TYPE {name} counter")
+                typed.add(name)
+            lines.append(f"{self._series(name, labels)} {value}")
+        for (name, labels), histogram in histograms:
+            if name not in typed:
+                lines.append(f"# TYPE {name} histogram")
+                typed.add(name)
+            cumulative = 0
+            for bound, bucket_count in zip(BUCKETS + ["+Inf"], histogram[:-1]):
+                cumulative += bucket_count
+                le = bound if bound == "+Inf" else f"{bound:g}"
+                lines.append(f"{self._series(name + '_bucket', labels + (('le', le),))} {cumulative}")
+            lines.append(f"{self._series(name + '_sum', labels)} {histogram[-1]:.6f}")
+            lines.append(f"{self._series(name + '_count', labels)} {cumulative}")
+        return "\n".join(lines) + "\n"
@@ -1,220 +1,894 @@
-from concurrent.futures import ThreadPoolExecutor, TimeoutError
-from xmlrpc.server import SimpleXMLRPCServer
-from xmlrpc.client import ServerProxy
+from concurrent.futures import ThreadPoolExecutor, TimeoutError, as_completed, wait
+from contextlib import contextmanager
+from KL_rpc_server import make_server, make_proxy
+from KL_failure_detector import FailureDetector
+from KL_clock import SYSTEM_CLOCK
+from KL_metrics import Metrics
+from KL_trace import Tracer
+from KL_scheduler import ConflictScheduler
+from KL_admission import AdmissionController, OVERLOADED, EXPIRED, UNKNOWN
+from KL_outcome_store import OutcomeStore
+from KL_routing import HashRing, partition_for
+from KL_wal import WriteAheadLog, lock_file
+import sys
 import time
 import threading
+import uuid
 
 class Coordinator:
-    def __init__(self, account_to_node):
-        self.account_to_node = account_to_node
-        self.participants = {account: ServerProxy(endpoint) for account, endpoint in account_to_node.items()}
-        self.executor = ThreadPoolExecutor(max_workers=len(self.account_to_node))
+    def __init__(self, node_endpoints, max_concurrency=16, log_file="coordinator.wal", checkpoint_interval=30, checkpoint_records=10000, pins=None, vnodes=64, pool_size=8, outcome_max_entries=100000, outcome_max_age=24 * 3600, push_interval=1, heartbeat_interval=0.2, log_level="INFO", schedule_conflicts=True, inactivity_threshold=30, partition=0, coordinator_endpoints=None, standby=False, clock=None, background=True, max_in_flight=None, max_queued=None):
+        self.partition = partition # Partition of the transaction IDs this coordinator decides
+        self.partitions = len(coordinator_endpoints) if coordinator_endpoints else 1
+        self.name = "Coordinator" if self.partitions == 1 else f"Coordinator-{partition}"
+        self.trace = Tracer(self.name, log_level)  # Per-transaction event buffer, written to stdout off the request path
+        if standby:
+            self.trace.info(f"Standing by until the coordinator using {log_file} exits.")
+        self.log_owner = lock_file(log_file + ".lock", wait=standby) # Only one process writes a decision log
+        if self.log_owner is None:
+            raise RuntimeError(f"{log_file} is in use by another coordinator")
+        self.peers = {p: make_proxy(endpoint, pool_size) for p, endpoint in enumerate(coordinator_endpoints or []) if p != partition} # Coordinators of the other partitions
+        self.node_endpoints = dict(node_endpoints) # {node name: endpoint}
+        self.pool_size = pool_size # Keep-alive connections per participant
+        self.participants = {node: make_proxy(endpoint, pool_size) for node, endpoint in self.node_endpoints.items()}
+        self.ring = HashRing(self.node_endpoints, vnodes=vnodes, pins=pins) # Places accounts on nodes
+        self.routing_changed = threading.Condition() # Guards in_flight and rebalancing
+        self.in_flight = 0 # Transactions currently routed with self.ring
+        self.rebalancing = False # True while accounts are being moved between nodes
+        self.max_concurrency = max_concurrency # Maximum number of transactions served concurrently
+        self.executor = ThreadPoolExecutor(max_workers=len(self.node_endpoints) * max_concurrency)
+        max_in_flight = max_in_flight or len(self.node_endpoints) * max_concurrency
+        self.admission = AdmissionController(max_limit=max_in_flight, max_queued=max_queued or max_in_flight) # Sheds transactions beyond what the participants can take
+        self.rpc_workers = max_in_flight + self.admission.max_queued + max_concurrency # Server threads: refusals and other calls never wait behind transactions
         self.shutting_down = False
         self.shutdown_event = threading.Event()  # Event to signal thread shutdown
-        self.transaction_log = {}  # Dictionary to store transaction states
-        self.last_activity = time.time()  # Timestamp of the last activity
-        self.inactivity_threshold = 30  # Time in seconds before initiating recovery
-        self._start_inactivity_thread()  # Start inactivity monitoring
+        self.lock = threading.Lock()  # Guards the transaction log
+        self.transaction_log = OutcomeStore(outcome_max_entries, outcome_max_age, self.trace)  # Outcomes participants have not all acknowledged
+        self.wal = WriteAheadLog(log_file, self.trace)  # Durable decision records
+        self.active = set()  # Transactions still being decided
+        self.scheduler = ConflictScheduler() if schedule_conflicts else None  # Runs transactions on the same accounts one at a time
+        self.clock_lock = threading.Lock()  # Guards last_timestamp and committing
+        self.last_timestamp = 0  # Last commit or snapshot timestamp handed out, in microseconds
+        self.committing = {}  # Commits whose phase 2 has not finished: {txn ID: commit timestamp}
+        self.missed = {}  # Decisions participants missed, waiting to be pushed: {node: {txn ID: outcome}}
+        self.missed_changed = threading.Condition()  # Guards missed
+        self.push_interval = push_interval  # Time in seconds between attempts to push missed decisions
+        self.clock = clock or SYSTEM_CLOCK  # Times activity and heartbeats; a simulation passes a VirtualClock
+        self.background = background  # Run heartbeats, pushes and checkpoints on threads; otherwise the caller steps them
+        self.detector = FailureDetector(clock=self.clock)  # Suspects crashed participants and sizes call timeouts
+        self.metrics = Metrics({"node": "Node-1"} if self.partitions == 1 else {"node": "Node-1", "partition": str(partition)})  # Phase latencies, timeouts and abort reasons
+        self.heartbeat_interval = heartbeat_interval  # Time in seconds between heartbeats to each participant
+        self.checkpoint_interval = checkpoint_interval  # Time in seconds between checkpoints
+        self.checkpoint_records = checkpoint_records  # Log records that trigger an early checkpoint
+        self._replay_log()
+        self.last_activity = self.clock.time()  # Timestamp of the last activity
+        self.inactivity_threshold = inactivity_threshold  # Time in seconds without requests before shutting down; None runs until stopped
+        self.inactivity_thread = None
+        if background:
+            self._start_inactivity_thread()  # Start inactivity monitoring
 
     def _start_inactivity_thread(self):
         """Start a background thread to monitor inactivity."""
         def monitor_inactivity():
             while not self.shutdown_event.is_set():  # Check for shutdown signal
                 time.sleep(1)  # Sleep for a short interval
-                if time.time() - self.last_activity > self.inactivity_threshold:
-                    print(f"Coordinator: Inactivity detected. Signaling shutdown.")
-                    self.shutdown_event.set()  # Signal shutdown
+                if self._check_inactivity():
                     break  # Exit the loop after signaling
 
         self.inactivity_thread = threading.Thread(target=monitor_inactivity)
         self.inactivity_thread.start()  # Start the thread
+        threading.Thread(target=self._checkpoint_loop, daemon=True).start()
+        threading.Thread(target=self._push_loop, daemon=True).start()
+        for node, endpoint in self.node_endpoints.items():
+            self._start_heartbeat_thread(node, endpoint)
+
+    def _check_inactivity(self):
+        """Signal shutdown after inactivity_threshold seconds without requests. Returns True if it did."""
+        if self.inactivity_threshold is not None and self.clock.time() - self.last_activity > self.inactivity_threshold:
+            self.trace.warning("Inactivity detected. Signaling shutdown.")
+            self.shutdown_event.set()  # Signal shutdown
+            return True
+        return False
+
+    def _start_heartbeat_thread(self, node, endpoint):
+        """Start a background thread that heartbeats one participant."""
+        def heartbeat_loop():
+            proxy = make_proxy(endpoint, 1) # Own connection, so heartbeats never queue behind transactions
+            while not self.shutdown_event.is_set():
+                self._heartbeat(node, proxy)
+                self.shutdown_event.wait(self.heartbeat_interval)
+
+        threading.Thread(target=heartbeat_loop, daemon=True).start()
+
+    def _heartbeat(self, node, proxy=None):
+        """Heartbeat one participant once and feed the reply, or its absence, to the failure detector."""
+        start = time.time()
+        try:
+            (proxy or self.participants[node]).heartbeat()
+            self.detector.heartbeat(node, time.time() - start)
+        except Exception:
+            self.detector.fail(node)
+
+    def _checkpoint_loop(self):
+        """Checkpoint the decision log periodically."""
+        last_checkpoint = time.time()
+        while not self.shutdown_event.is_set():
+            time.sleep(1)
+            due = time.time() - last_checkpoint >= self.checkpoint_interval
+            self.transaction_log.evict()
+            if self.wal.records_since_checkpoint >= self.checkpoint_records or (due and self.wal.records_since_checkpoint):
+                self.checkpoint()
+                last_checkpoint = time.time()
+
+    def checkpoint(self):
+        """Restart the decision log from a snapshot of the transaction log."""
+        with self.lock:
+            self.wal.checkpoint({"transaction_log": self.transaction_log.snapshot()})
+        return True
+
+    def _replay_log(self):
+        """Rebuild the transaction log from the last checkpoint and the decisions after it."""
+        for record in self.wal.records:
+            if record["type"] == "checkpoint":
+                entries = record["state"]["transaction_log"]
+                self.transaction_log.restore({t: e if isinstance(e, list) else [e, time.time(), []] for t, e in entries.items()})
+            elif record["type"] == "decision":
+                self.transaction_log.record(record["txn"], record["outcome"], record.get("nodes", []), record.get("time"))
+        for node, transaction_ids in self.transaction_log.unacknowledged("COMMITTED").items(): # Commits that may not have reached them
+            self.missed.setdefault(node, {}).update(dict.fromkeys(transaction_ids, "COMMITTED"))
+        if self.wal.records:
+            self.trace.info(f"Replayed {len(self.wal.records)} log records with {len(self.transaction_log)} decisions.")
 
     def is_alive(self):
         """Returns True when Participant pings the Coordinator."""
         return True
 
-    def _call_with_timeout(self, func, *args, timeout=5):
-        """Call a function with a timeout."""
-        future = self.executor.submit(func, *args)
-        try:
-            return future.result(timeout=timeout)  # Wait for the result with a timeout
-        except TimeoutError:
-            print(f"Coordinator: Timeout during RPC call.")
-            return None
-        except Exception as e:
-            print(f"Coordinator: Error during RPC call: {e}")
-            return None
+    def get_outcome_stats(self):
+        """Return the retained-outcome metrics of the transaction log."""
+        return self.transaction_log.stats()
+
+    def acknowledge_outcomes(self, node, outcomes):
+        """Participant reports the outcomes it has applied: {txn ID: outcome}.
+
+        Outcomes every participant has acknowledged are dropped. Returns the
+        outcomes the node has wrong, {txn ID: outcome}, so it can correct them.
+        """
+        corrections = self.transaction_log.acknowledge(node, outcomes)
+        if corrections:
+            self.trace.warning(f"{node} has outdated outcomes for {sorted(corrections)}.", phase="recovery")
+        return corrections
+
+    def get_trace(self, transaction_id):
+        """Return the coordinator's buffered events for one transaction."""
+        return self.trace.trace(transaction_id)
+
+    def get_transaction_trace(self, transaction_id):
+        """Return the events of one transaction on the coordinator and every participant, in time order."""
+        events = self.trace.trace(transaction_id)
+        futures = {node: self.executor.submit(participant.get_trace, transaction_id) for node, participant in self.participants.items()}
+        for node, future in futures.items():
+            try:
+                events.extend(future.result(timeout=5))
+            except Exception as e:
+                self.trace.warning(f"Failed to get the trace of {transaction_id} from {node}: {e}")
+        return sorted(events, key=lambda event: event["time"])
+
+    def set_log_level(self, level):
+        """Change the lowest level the coordinator writes to stdout: DEBUG, INFO, WARNING or ERROR."""
+        self.trace.set_level(level)
+        return True
+
+    def get_metrics(self):
+        """Return the coordinator's counters and latency histograms."""
+        return self.metrics.snapshot()
+
+    def get_metrics_text(self):
+        """Return the coordinator's metrics in the Prometheus text format."""
+        return self.metrics.prometheus_text()
+
+    def get_failure_detector_stats(self):
+        """Return the suspicion level, latency and call timeout of every participant."""
+        return self.detector.stats()
+
+    def get_pool_stats(self):
+        """Return the connection pool counters for every participant."""
+        return {node: participant.pool.stats() for node, participant in self.participants.items()}
 
     def initialize_node(self, account, balance):
-        """Initialize a node's account balance."""
+        """Initialize an account's balance on the node that owns it."""
         # Used for test cases
-        self.last_activity = time.time()
-        participant = self.participants.get(account)
+        self.last_activity = self.clock.time()
+        node = self.ring.node_for(account)
+        participant = self.participants.get(node)
         if participant:
             try:
-                print(f"Coordinator: Initializing account {account} with balance {balance}.")
-                return participant.initialize_account(balance)
+                self.trace.info(f"Initializing account {account} on {node} with balance {balance}.")
+                return participant.initialize_account(balance, account)
             except Exception as e:
-                print(f"Coordinator: Failed to initialize account {account}: {e}")
+                self.trace.warning(f"Failed to initialize account {account}: {e}")
                 return False
         else:
-            print(f"Coordinator: No participant found for account {account}.")
+            self.trace.info(f"No participant found for account {account}.")
             return False
 
     def set_simulation_case(self, case_number):
         """Set a simulation case for all nodes."""
         # Used for test cases
-        self.last_activity = time.time()
+        self.last_activity = self.clock.time()
         results = {}
-        for account, participant in self.participants.items():
+        for node, participant in self.participants.items():
             try:
-                print(f"Coordinator: Setting case {case_number} for account {account}.")
-                results[account] = participant.simulation_case(case_number)
+                self.trace.info(f"Setting case {case_number} for {node}.")
+                results[node] = participant.simulation_case(case_number)
             except Exception as e:
-                print(f"Coordinator: Failed to set case for account {account}: {e}")
-                results[account] = False
+                self.trace.warning(f"Failed to set case for {node}: {e}")
+                results[node] = False
         return results
 
     def get_account_balance(self, account):
         """Get account balance."""
         # Used for test cases
-        self.last_activity = time.time()
-        participant = self.participants.get(account)
+        self.last_activity = self.clock.time()
+        participant = self.participants.get(self.ring.node_for(account))
         if participant:
             try:
-                return participant.get_balance()
+                balance = participant.get_balances_at([account], self._snapshot_timestamp())[account]
+                return balance if balance is not None else 0
             except Exception as e:
-                print(f"Coordinator: Failed to get account {account}: {e}")
+                self.trace.warning(f"Failed to get account {account}: {e}")
                 return False
         else:
-            print(f"Coordinator: No participant found for account {account}.")
+            self.trace.info(f"No participant found for account {account}.")
             return False
 
-    def execute_transaction(self, transaction_id, transactions, timeout=5):
-        """Recieve a transaction from the client. Entering 2PC."""
-        self.last_activity = time.time()
-        print(f"Coordinator: Starting transaction {transaction_id} for {transactions}.")
+    def get_snapshot(self, accounts):
+        """Return the balances of accounts as of the last finished commit: {"timestamp": ..., "balances": {account: balance}}.
+
+        The view is consistent across accounts and participants. It is read from
+        the participants' version chains, so it takes no locks and does not wait
+        for transactions in flight. Unknown accounts read as None.
+        """
+        self.last_activity = self.clock.time()
+        timestamp = self._snapshot_timestamp()
+        with self._routing() as ring:
+            node_accounts = ring.group_by_node({account: 0 for account in accounts})
+        if None in node_accounts:
+            raise ValueError(f"No participant found for accounts {sorted(node_accounts[None])}")
+        futures = {self.executor.submit(self.participants[node].get_balances_at, list(node_accounts[node]), timestamp): node for node in node_accounts}
+        balances = {}
+        for future in futures:
+            balances.update(future.result(timeout=5))
+        return {"timestamp": timestamp, "balances": balances}
+
+    @contextmanager
+    def _routing(self):
+        """Keep the account placement fixed while a transaction runs."""
+        with self.routing_changed:
+            while self.rebalancing:
+                self.routing_changed.wait()
+            self.in_flight += 1
+        try:
+            yield self.ring
+        finally:
+            with self.routing_changed:
+                self.in_flight -= 1
+                self.routing_changed.notify_all()
+
+    @contextmanager
+    def _deciding(self, transaction_ids):
+        """Mark transactions as in progress, so outcome queries answer PENDING instead of presuming abort."""
+        with self.lock:
+            self.active.update(transaction_ids)
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.active.difference_update(transaction_ids)
+            with self.clock_lock:
+                for transaction_id in transaction_ids:
+                    self.committing.pop(transaction_id, None)
+
+    def _commit_timestamp(self, transaction_ids):
+        """Give transactions about to commit a timestamp above every earlier commit and snapshot.
+
+        Timestamps are wall-clock microseconds, returned as floats because XML-RPC
+        integers are 32-bit (they are exact as doubles). The transactions count as
+        committing until _deciding ends, which holds snapshots below them.
+        """
+        with self.clock_lock:
+            self.last_timestamp = max(self.last_timestamp + 1, time.time_ns() // 1000)
+            for transaction_id in transaction_ids:
+                self.committing[transaction_id] = self.last_timestamp
+            return float(self.last_timestamp)
+
+    def _snapshot_timestamp(self):
+        """Return the latest timestamp at which every commit is finished on every participant.
+
+        With several coordinators this is the lowest of their safe timestamps. A
+        coordinator that cannot be reached is left out, so a read may then see
+        part of one of its transactions.
+        """
+        timestamp = self.get_safe_timestamp()
+        futures = {partition: self.executor.submit(peer.get_safe_timestamp) for partition, peer in self.peers.items()}
+        for partition, future in futures.items():
+            try:
+                timestamp = min(timestamp, future.result(timeout=1))
+            except Exception as e:
+                self.trace.warning(f"Failed to get the safe timestamp of coordinator partition {partition}: {e}")
+        return timestamp
+
+    def get_safe_timestamp(self):
+        """Return the latest timestamp at which every commit of this coordinator is finished; later ones get a higher timestamp."""
+        with self.clock_lock:
+            if self.committing:
+                return float(min(self.committing.values()) - 1)
+            self.last_timestamp = max(self.last_timestamp, time.time_ns() // 1000) # Later commits get a higher timestamp
+            return float(self.last_timestamp)
+
+    def add_node(self, node, endpoint):
+        """Add a participant node and move the accounts it now owns onto it.
+
+        New transactions wait while the accounts move. Only the accounts whose
+        ring position falls to the new node are copied, then dropped from their
+        old node. Returns the number of accounts moved.
+        """
+        self.last_activity = self.clock.time()
+        if self.peers:
+            self.trace.warning(f"Not adding {node}: the other coordinators would keep the old placement.")
+            return False
+        with self.routing_changed:
+            while self.rebalancing:
+                self.routing_changed.wait()
+            self.rebalancing = True
+            while self.in_flight: # Let routed transactions finish
+                self.routing_changed.wait()
+        try:
+            new_ring = HashRing(sorted(self.ring.nodes | {node}), vnodes=self.ring.vnodes, pins=self.ring.pins)
+            new_participant = make_proxy(endpoint, self.pool_size)
+            moved = 0
+            for source in sorted(self.ring.nodes):
+                balances = self.participants[source].export_accounts(sorted(new_ring.nodes), new_ring.vnodes, new_ring.pins, node)
+                if balances:
+                    new_participant.import_accounts(balances) # Durable on the new node before the old copy goes
+                    self.participants[source].drop_accounts(list(balances))
+                    moved += len(balances)
+                    self.trace.info(f"Moved {len(balances)} accounts from {source} to {node}.")
+            self.node_endpoints[node] = endpoint
+            self.participants[node] = new_participant
+            if self.background:
+                self._start_heartbeat_thread(node, endpoint)
+            self.ring = new_ring
+            self.trace.info(f"Added {node}. {moved} accounts moved.")
+            return moved
+        except Exception as e:
+            self.trace.warning(f"Failed to add {node}: {e}. Keeping the current placement.")
+            return False
+        finally:
+            with self.routing_changed:
+                self.rebalancing = False
+                self.routing_changed.notify_all()
+
+    def execute_transaction(self, transaction_id, transactions, timeout=5, deadline=None):
+        """Recieve a transaction from the client. Entering 2PC.
+
+        deadline is when the client gives up, in seconds since the epoch; by
+        default timeout seconds from now. Past it the transaction is dropped
+        before prepare, as its result would go unread.
+        """
+        self.last_activity = self.clock.time()
+        self.trace.debug(f"Starting transaction {transaction_id} for {transactions}.", txn=transaction_id, phase="begin")
         if self.shutting_down: # Rejects transaction if coordinator is already shutting down
-            print(f"Coordinator: Rejecting transaction {transaction_id} as the coordinator is shutting down.")
+            self.trace.warning(f"Rejecting transaction {transaction_id} as the coordinator is shutting down.", txn=transaction_id, phase="begin")
             return "Coordinator is shutting down. No new transactions are accepted."
+        if not self._owns(transaction_id):
+            self.trace.warning(f"Rejecting transaction {transaction_id} of another coordinator partition.", txn=transaction_id, phase="begin")
+            return f"Transaction {transaction_id} belongs to coordinator partition {partition_for(transaction_id, self.partitions)}."
+        deadline = deadline or self.clock.time() + timeout
+        start = time.perf_counter()
+        with self._admitted(transaction_id, deadline) as refusal:
+            if refusal:
+                return refusal
+            with self._scheduled(transaction_id, [transactions], min(timeout, deadline - self.clock.time())) as admitted:
+                if not admitted:
+                    result = "Transaction Aborted"
+                elif self._expired(transaction_id, deadline):
+                    result = EXPIRED
+                else:
+                    with self._routing() as ring, self._deciding([transaction_id]):
+                        result = self._two_phase_commit(transaction_id, ring.group_by_node(transactions), timeout)
+        outcome = {"Transaction Committed": "committed", EXPIRED: "expired", UNKNOWN: "unknown"}.get(result, "aborted")
+        self.metrics.observe("kl_transaction_seconds", time.perf_counter() - start, outcome=outcome)
+        return result
 
-        # Phase 1: Prepare
-        prepared_nodes = []  # Track nodes that successfully prepare
-        prepare_responses = {}
-        for account, amount in transactions.items():
-            participant = self.participants.get(account)
-            if not participant: # Node doesn't exist
-                print(f"Coordinator: No participant found for account {account}.")
-                prepare_responses[account] = False
-                continue
+    def _two_phase_commit(self, transaction_id, node_legs, timeout):
+        """Run 2PC for a transaction whose legs are grouped by node: {node: {account: amount}}.
 
-            response = self._call_with_timeout(participant.prepare, transaction_id, amount, timeout=timeout)
-            if response is None: # Node crashes
-                print(f"Coordinator: Timeout during prepare for account {account}.")
-                prepare_responses[account] = False
-            else: # Response is received
-                prepare_responses[account] = response
-                prepared_nodes.append(account)
-
-        if not all(prepare_responses.values()): # Abort transaction
-            print(f"Coordinator: Prepare phase failed for transaction {transaction_id}. Aborting.")
-            self._send_abort(transaction_id, prepared_nodes)
-            self.transaction_log[transaction_id] = "ABORTED"  # Log the result
+        Aborts are not logged (presumed abort). A logged commit is final: nodes that
+        do not confirm it are sent it again until they do. A transaction on a single
+        node uses one-phase commit, and nodes that vote read-only are left out of
+        phase 2.
+        """
+        if not node_legs or None in node_legs: # Node doesn't exist
+            self.trace.warning(f"No participant found for transaction {transaction_id}.", txn=transaction_id, phase="prepare")
+            self.metrics.inc("kl_aborts_total", reason="no_participant")
+            return "Transaction Aborted"
+        suspected = self.detector.suspected(node_legs)
+        if suspected: # Fail fast instead of waiting out a timeout
+            self.trace.warning(f"{suspected} suspected down. Aborting transaction {transaction_id}.", txn=transaction_id, phase="prepare")
+            self.metrics.inc("kl_aborts_total", reason="suspected")
             return "Transaction Aborted"
+        timeout = self.detector.timeout_for(node_legs, timeout)
+        if len(node_legs) == 1:
+            [(node, legs)] = node_legs.items()
+            return self._one_phase_commit(transaction_id, node, legs, timeout)
 
-        # Phase 2: Commit
-        print(f"Coordinator: All participants prepared. Sending commit requests.")
-        self.last_activity = time.time()
-        commit_nodes = [] # Track nodes that successfully commit
-        commit_responses = {}
-        for account in transactions.keys():
-            participant = self.participants.get(account)
-            response = self._call_with_timeout(participant.commit, transaction_id, timeout=timeout)
-            if response is None: # Node crashed
-                print(f"Coordinator: Timeout during commit for account {account}.")
-                commit_responses[account] = False
-            else: # Response is received
-                commit_responses[account] = response
-                commit_nodes.append(account)
-
-        if not all(commit_responses.values()): # Rollback phase - transaction is now aborted
-            print(f"Coordinator: Commit phase failed. Rolling back all participants.")
-            self._roll_back_all(transaction_id, commit_nodes)
-            self.transaction_log[transaction_id] = "ABORTED"  # Log the result
+        # Phase 1: Prepare (one request per node, sent to every node at once)
+        calls = {node: (self.participants[node].prepare_legs, (transaction_id, legs)) for node, legs in node_legs.items()}
+        votes, all_prepared = self._fan_out(calls, timeout, "prepare", self._abort_late)
+        if not all_prepared: # Abort transaction
+            self.trace.warning(f"Prepare phase failed for transaction {transaction_id}. Aborting.", txn=transaction_id, phase="prepare")
+            self.metrics.inc("kl_aborts_total", reason="prepare_failed")
+            self._send_abort(transaction_id, [node for node, vote in votes.items() if vote != "READ_ONLY"])
+            for node in node_legs.keys() - votes.keys(): # No reply: tell the node once it can be reached
+                self._push_outcomes(node, {transaction_id: "ABORTED"})
             return "Transaction Aborted"
+        update_nodes = [node for node in node_legs if votes[node] != "READ_ONLY"]
+        if not update_nodes: # Nothing to commit anywhere
+            self.trace.debug(f"All participants voted read-only for transaction {transaction_id}.", txn=transaction_id, phase="prepare")
+            self.metrics.inc("kl_commits_total", path="read_only")
+            return "Transaction Committed"
+
+        # Phase 2: Commit (sent to every participant that changes a balance, at once)
+        commit_ts = self._commit_timestamp([transaction_id])
+        self._log_outcome(transaction_id, "COMMITTED", update_nodes)  # The decision is durable before any commit is sent
+        self.trace.debug("All participants prepared. Sending commit requests.", txn=transaction_id, phase="commit")
+        self.last_activity = self.clock.time()
+        calls = {node: (self.participants[node].commit, (transaction_id, commit_ts)) for node in update_nodes}
+        commit_nodes, all_committed = self._fan_out(calls, timeout, "commit", None)
+
+        if not all_committed: # The decision stands: push it until every node has taken it
+            missed = [node for node in update_nodes if not commit_nodes.get(node)]
+            self.trace.warning(f"Commit not confirmed by {missed}. Resending it until they commit.", txn=transaction_id, phase="commit")
+            self.metrics.inc("kl_commit_retries_total", len(missed))
+            for node in missed:
+                self._push_outcomes(node, {transaction_id: "COMMITTED"})
 
         # Transaction successfully committed
-        print(f"Coordinator: Transaction {transaction_id} committed successfully.")
-        self.transaction_log[transaction_id] = "COMMITTED"  # Log the result
+        self.trace.info(f"Transaction {transaction_id} committed successfully.", txn=transaction_id, phase="commit")
+        self.metrics.inc("kl_commits_total", path="two_phase")
+        return "Transaction Committed"
+
+    def _one_phase_commit(self, transaction_id, node, legs, timeout):
+        """Commit a transaction held entirely by one node in a single round trip.
+
+        The node decides alone and the coordinator logs nothing. A failed call is
+        sent once more: the node answers an ID it knows with its outcome, so the
+        retry either runs the transaction or reports how it ended. If the retry
+        fails too, the outcome is unknown.
+        """
+        commit_ts = self._commit_timestamp([transaction_id])
+        for attempt in range(2):
+            start = time.time()
+            future = self.executor.submit(self.participants[node].commit_one_phase, transaction_id, legs, commit_ts)
+            try:
+                committed = future.result(timeout=timeout)
+            except Exception as e: # Node failed or crashed
+                if isinstance(e, OSError):
+                    self.detector.fail(node)
+                self.metrics.inc("kl_timeouts_total" if isinstance(e, TimeoutError) else "kl_rpc_errors_total", phase="one_phase", participant=node)
+                self.trace.warning(f"One-phase commit of {transaction_id} on {node} failed: {e or 'timeout'}.", txn=transaction_id, phase="one_phase")
+                if attempt == 0 and isinstance(e, ConnectionRefusedError): # Never reached the node
+                    self.metrics.inc("kl_aborts_total", reason="one_phase_failed")
+                    return "Transaction Aborted"
+                continue
+            self.detector.heartbeat(node, time.time() - start)
+            self.metrics.observe("kl_participant_rpc_seconds", time.time() - start, phase="one_phase", participant=node)
+            self.admission.observe(time.time() - start)
+            break
+        else:
+            self.metrics.inc("kl_unknown_outcomes_total", participant=node)
+            return UNKNOWN
+        if not committed:
+            self.trace.info(f"{node} aborted transaction {transaction_id}.", txn=transaction_id, phase="one_phase")
+            self.metrics.inc("kl_aborts_total", reason="one_phase_refused")
+            return "Transaction Aborted"
+        self.trace.info(f"Transaction {transaction_id} committed in one phase on {node}.", txn=transaction_id, phase="one_phase")
+        self.metrics.inc("kl_commits_total", path="one_phase")
         return "Transaction Committed"
 
-    def _send_abort(self, transaction_id, accounts):
+    def _fan_out(self, calls, timeout, phase, on_late_reply):
+        """Send one phase to all participants at once and stop at the first failure.
+
+        calls maps node -> (rpc, args). All calls share one deadline. Returns the
+        replies received as {node: reply} and whether every reply was positive. Calls
+        still outstanding when the phase fails are handed to on_late_reply, if given, when they finish.
+        """
+        start = time.time()
+        futures = {self.executor.submit(rpc, *args): node for node, (rpc, args) in calls.items()}
+        responded = {}
+        ok = True
+        try:
+            for future in as_completed(futures, timeout=timeout):
+                node = futures.pop(future)
+                try:
+                    response = future.result()
+                except Exception as e: # Node failed
+                    self.trace.warning(f"Error during {phase} for {node}: {e}", txn=calls[node][1][0], phase=phase)
+                    if isinstance(e, OSError): # Connection refused or lost, not a remote error
+                        self.detector.fail(node)
+                    self.metrics.inc("kl_rpc_errors_total", phase=phase, participant=node)
+                    ok = False
+                    break
+                self.detector.heartbeat(node, time.time() - start)
+                self.metrics.observe("kl_participant_rpc_seconds", time.time() - start, phase=phase, participant=node)
+                self.admission.observe(time.time() - start)
+                responded[node] = response # Response is received
+                if not response:
+                    self.trace.info(f"{node} failed {phase}.", txn=calls[node][1][0], phase=phase)
+                    ok = False
+                    break
+        except TimeoutError: # Node crashed
+            self.trace.warning(f"Timeout during {phase} for {sorted(futures.values())}.", txn=calls[next(iter(futures.values()))][1][0], phase=phase)
+            for node in futures.values():
+                self.metrics.inc("kl_timeouts_total", phase=phase, participant=node)
+            ok = False
+
+        # Participants that have not answered yet are cleaned up once they do
+        for future, node in futures.items() if on_late_reply else ():
+            transaction_id = calls[node][1][0]
+            future.add_done_callback(lambda f, n=node, t=transaction_id: on_late_reply(f, t, n))
+        return responded, ok
+
+    def _abort_late(self, future, transaction_id, node):
+        """Abort a participant whose prepare reply arrived after the transaction was aborted."""
+        if future.exception() is None:
+            self.trace.info(f"Late prepare reply from {node}. Aborting {transaction_id}.", txn=transaction_id, phase="abort")
+            try:
+                self._send_abort(transaction_id, [node])
+            except Exception as e:
+                self.trace.warning(f"Failed to abort {node}: {e}", txn=transaction_id, phase="abort")
+
+    def execute_batch(self, transactions, timeout=5, deadline=None):
+        """Run a list of [txn ID, {account: amount}] transactions as one batch.
+
+        Each participant receives a single prepare_batch and commit_batch request for
+        all of its legs. Every transaction still commits or aborts on its own. The
+        batch takes one admission slot and shares one deadline, as in
+        execute_transaction. Returns {txn ID: result}.
+        """
+        self.last_activity = self.clock.time()
+        self.trace.debug(f"Starting batch of {len(transactions)} transactions.", phase="begin")
+        if self.shutting_down: # Rejects batch if coordinator is already shutting down
+            self.trace.warning("Rejecting batch as the coordinator is shutting down.", phase="begin")
+            return {transaction_id: "Coordinator is shutting down. No new transactions are accepted." for transaction_id, _ in transactions}
+        results = {transaction_id: f"Transaction {transaction_id} belongs to coordinator partition {partition_for(transaction_id, self.partitions)}." for transaction_id, _ in transactions if not self._owns(transaction_id)}
+        if results:
+            self.trace.warning(f"Rejecting {len(results)} batch transactions of other coordinator partitions.", phase="begin")
+            transactions = [[transaction_id, legs] for transaction_id, legs in transactions if transaction_id not in results]
+        name = f"batch of {len(transactions)}"
+        deadline = deadline or self.clock.time() + timeout
+        with self._admitted(name, deadline) as refusal:
+            if refusal:
+                results.update({transaction_id: refusal for transaction_id, _ in transactions})
+                return results
+            with self._scheduled(name, [legs for _, legs in transactions], min(timeout, deadline - self.clock.time())) as admitted:
+                if not admitted or self._expired(name, deadline):
+                    results.update({transaction_id: "Transaction Aborted" if not admitted else EXPIRED for transaction_id, _ in transactions})
+                    return results
+                with self._routing() as ring, self._deciding([transaction_id for transaction_id, _ in transactions]):
+                    results.update(self._run_batch(transactions, ring, timeout))
+                    return results
+
+    def _owns(self, transaction_id):
+        """Return True if this coordinator decides the transaction."""
+        return self.partitions == 1 or partition_for(transaction_id, self.partitions) == self.partition
+
+    @contextmanager
+    def _admitted(self, name, deadline):
+        """Wait for an admission slot until the deadline. Yields None once admitted, or the reply refusing the transaction."""
+        if self._expired(name, deadline):
+            yield EXPIRED
+            return
+        start = time.perf_counter()
+        with self.admission.admit(deadline - self.clock.time()) as admitted:
+            self.metrics.observe("kl_admission_wait_seconds", time.perf_counter() - start)
+            if admitted:
+                yield None
+                return
+        if self._expired(name, deadline):
+            yield EXPIRED
+            return
+        retry_after = self.admission.retry_after()
+        self.trace.debug(f"Overloaded. Refusing {name}, retry after {retry_after:.3f}s.", txn=name, phase="admission")
+        self.metrics.inc("kl_shed_total", reason="overloaded")
+        yield OVERLOADED.format(retry_after)
+
+    def _expired(self, name, deadline):
+        """Return True, and count it, if the client has given up on the transaction."""
+        if self.clock.time() < deadline:
+            return False
+        self.trace.info(f"{name} passed its deadline before prepare. Dropping it.", txn=name, phase="admission")
+        self.metrics.inc("kl_shed_total", reason="expired")
+        return True
+
+    def get_admission_stats(self):
+        """Return the admission limit, occupancy and shedding counters."""
+        return self.admission.stats()
+
+    @contextmanager
+    def _scheduled(self, name, legs_list, timeout):
+        """Wait for earlier transactions on the same accounts to finish. Yields False if that takes longer than timeout.
+
+        Only accounts whose balance changes count: zero-amount legs take no locks.
+        """
+        if self.scheduler is None:
+            yield True
+            return
+        accounts = [account for legs in legs_list for account, amount in legs.items() if amount]
+        start = time.perf_counter()
+        with self.scheduler.schedule(name, accounts, timeout) as admitted:
+            self.metrics.observe("kl_scheduler_wait_seconds", time.perf_counter() - start)
+            if not admitted:
+                self.trace.warning(f"{name} waited over {timeout}s for conflicting transactions. Aborting.", txn=name, phase="schedule")
+                self.metrics.inc("kl_aborts_total", reason="scheduler_timeout")
+            yield admitted
+
+    def get_scheduler_stats(self):
+        """Return the scheduler's queue depth and conflict counters."""
+        return self.scheduler.stats() if self.scheduler else {}
+
+    def _run_batch(self, transactions, ring, timeout):
+        """Run 2PC for a batch with one request per node and phase."""
+        batch_id = "batch-" + uuid.uuid4().hex
+        results = {}
+        txn_nodes = {} # Nodes touched by each transaction still in the batch
+        items = {} # Legs sent to each node: {node: [[txn ID, {account: amount}]]}
+        for transaction_id, legs in transactions:
+            node_legs = ring.group_by_node(legs)
+            if not node_legs or None in node_legs: # Node doesn't exist
+                self.trace.warning(f"No participant found for transaction {transaction_id}.", txn=transaction_id, phase="prepare")
+                self.metrics.inc("kl_aborts_total", reason="no_participant")
+                results[transaction_id] = "Transaction Aborted"
+                continue
+            suspected = self.detector.suspected(node_legs)
+            if suspected: # Fail fast instead of waiting out a timeout
+                self.trace.warning(f"{suspected} suspected down. Aborting transaction {transaction_id}.", txn=transaction_id, phase="prepare")
+                self.metrics.inc("kl_aborts_total", reason="suspected")
+                results[transaction_id] = "Transaction Aborted"
+                continue
+            txn_nodes[transaction_id] = list(node_legs)
+            for node, node_leg in node_legs.items():
+                items.setdefault(node, []).append([transaction_id, node_leg])
+
+        # Phase 1: Prepare (one request per participant)
+        calls = {node: (self.participants[node].prepare_batch, (batch_id, batch)) for node, batch in items.items()}
+        replies = self._fan_out_batch(calls, timeout, "prepare", "abort_batch")
+        prepared = set() # (txn ID, node) pairs that voted yes
+        read_only = set() # (txn ID, node) pairs that need no phase 2
+        for node, votes in replies.items():
+            prepared.update((item[0], node) for item, vote in zip(items[node], votes) if vote)
+            read_only.update((item[0], node) for item, vote in zip(items[node], votes) if vote == "READ_ONLY")
+        to_commit = {t for t, nodes in txn_nodes.items() if all((t, n) in prepared for n in nodes)}
+
+        aborts = {node: [item[0] for item in batch if item[0] not in to_commit and (item[0], node) not in read_only] for node, batch in items.items() if node in replies}
+        for node in items.keys() - replies.keys(): # No reply: tell the node once it can be reached
+            self._push_outcomes(node, {item[0]: "ABORTED" for item in items[node]})
+        self._fan_out_batch({n: (self.participants[n].abort_batch, (ids,)) for n, ids in aborts.items() if ids}, timeout, "abort")
+        self.trace.debug(f"Batch {batch_id} prepared {len(to_commit)} of {len(txn_nodes)} transactions. Sending commit requests.", txn=batch_id, phase="commit")
+
+        # Phase 2: Commit (one request per participant)
+        commits = {node: [item[0] for item in batch if item[0] in to_commit and (item[0], node) not in read_only] for node, batch in items.items()}
+        commit_nodes = {} # Nodes that must learn each decision: {txn ID: [node]}
+        for node, ids in commits.items():
+            for transaction_id in ids:
+                commit_nodes.setdefault(transaction_id, []).append(node)
+        commit_ts = self._commit_timestamp(commit_nodes) # One timestamp: the batch's commits are decided together
+        for transaction_id, nodes in commit_nodes.items(): # Read-only transactions need no decision
+            self._log_outcome(transaction_id, "COMMITTED", nodes, sync=False)
+        self.wal.sync()  # One flush makes every commit decision of the batch durable
+        self.last_activity = self.clock.time()
+        calls = {node: (self.participants[node].commit_batch, (ids, commit_ts)) for node, ids in commits.items() if ids}
+        replies = self._fan_out_batch(calls, timeout, "commit")
+        for node, ids in commits.items(): # The decisions stand: push them until every node has taken them
+            missed = [transaction_id for transaction_id, ok in zip(ids, replies.get(node, [False] * len(ids))) if not ok]
+            if missed:
+                self.trace.warning(f"{node} did not confirm {len(missed)} commits of batch {batch_id}. Resending them until it commits.", txn=batch_id, phase="commit")
+                self.metrics.inc("kl_commit_retries_total", len(missed))
+                self._push_outcomes(node, dict.fromkeys(missed, "COMMITTED"))
+
+        for transaction_id in txn_nodes:
+            results[transaction_id] = "Transaction Committed" if transaction_id in to_commit else "Transaction Aborted"
+        self.metrics.inc("kl_commits_total", len(to_commit), path="batch")
+        self.metrics.inc("kl_aborts_total", len(txn_nodes) - len(to_commit), reason="batch_prepare_failed")
+        self.trace.info(f"Batch {batch_id} finished with {len(to_commit)} of {len(transactions)} transactions committed.", txn=batch_id, phase="commit")
+        return results
+
+    def _fan_out_batch(self, calls, timeout, phase, late_cleanup=None):
+        """Send one batch request to every participant at once and wait for all of them.
+
+        calls maps node -> (rpc, args) where args ends with the list of transaction IDs
+        or items. Returns {node: reply} for the participants that answered in time.
+        If late_cleanup names a batch RPC, it is sent for the whole batch to any
+        participant that answers after the deadline.
+        """
+        futures = {self.executor.submit(self._timed, rpc, *args): node for node, (rpc, args) in calls.items()}
+        done, not_done = wait(futures, timeout=timeout)
+        replies = {}
+        for future in done:
+            node = futures[future]
+            try:
+                replies[node], elapsed = future.result()
+                self.metrics.observe("kl_participant_rpc_seconds", elapsed, phase=phase + "_batch", participant=node)
+                self.admission.observe(elapsed)
+            except Exception as e: # Node failed
+                self.trace.warning(f"Error during {phase} for {node}: {e}", phase=phase)
+                self.metrics.inc("kl_rpc_errors_total", phase=phase + "_batch", participant=node)
+        for future in not_done: # Node crashed
+            node = futures[future]
+            self.trace.warning(f"Timeout during {phase} for {node}.", phase=phase)
+            self.metrics.inc("kl_timeouts_total", phase=phase + "_batch", participant=node)
+            if late_cleanup:
+                batch = next(arg for arg in calls[node][1] if isinstance(arg, list))
+                ids = [item[0] if isinstance(item, list) else item for item in batch]
+                future.add_done_callback(lambda f, n=node, ids=ids: self._clean_up_late_batch(f, n, late_cleanup, ids))
+        return replies
+
+    @staticmethod
+    def _timed(rpc, *args):
+        """Call rpc and return (reply, seconds taken)."""
+        start = time.perf_counter()
+        reply = rpc(*args)
+        return reply, time.perf_counter() - start
+
+    def _clean_up_late_batch(self, future, node, rpc_name, transaction_ids):
+        """Abort a batch whose prepare reply arrived after its phase had ended."""
+        if future.exception() is None and transaction_ids:
+            self.trace.info(f"Late batch reply from {node}. Sending {rpc_name}.", phase="cleanup")
+            try:
+                getattr(self.participants[node], rpc_name)(transaction_ids)
+            except Exception as e:
+                self.trace.warning(f"Failed to send {rpc_name} to {node}: {e}", phase="cleanup")
+
+    def _log_outcome(self, transaction_id, outcome, nodes, sync=True):
+        """Record the outcome of a transaction in the decision log, to be acknowledged by nodes."""
+        decided_at = time.time()
+        with self.lock:
+            self.transaction_log.record(transaction_id, outcome, nodes, decided_at)
+            self.wal.append({"type": "decision", "txn": transaction_id, "outcome": outcome, "nodes": list(nodes), "time": decided_at})
+        if sync:
+            with self.metrics.timer("kl_wal_sync_seconds"):
+                self.wal.sync()
+
+    def _send_abort(self, transaction_id, nodes):
         """Transaction is aborted."""
-        self.last_activity = time.time()
-        for account in accounts:
-            participant = self.participants.get(account)
+        self.last_activity = self.clock.time()
+        for node in nodes:
+            participant = self.participants.get(node)
             if participant:
-                participant.abort(transaction_id)
+                try:
+                    with self.metrics.timer("kl_participant_rpc_seconds", phase="abort", participant=node):
+                        participant.abort(transaction_id)
+                except Exception as e:
+                    self.metrics.inc("kl_rpc_errors_total", phase="abort", participant=node)
+                    self.trace.warning(f"Failed to abort {transaction_id} on {node}: {e}", txn=transaction_id, phase="abort")
+                    self._push_outcomes(node, {transaction_id: "ABORTED"})
 
-    def _roll_back_all(self, transaction_id, accounts):
-        """Transaction is rolled back to previous state."""
-        self.last_activity = time.time()
-        for account in accounts:    
-            participant = self.participants.get(account)
-            if participant:
-                participant.roll_back_state(transaction_id)
+    def _push_outcomes(self, node, outcomes):
+        """Queue decisions {txn ID: outcome} for a participant that missed them.
 
-    def handle_recovering_node(self, transaction_id, account):
+        ABORTED only goes to nodes that may be prepared, and COMMITTED to nodes
+        that did not confirm a logged commit; a participant never undoes a commit.
+        """
+        with self.missed_changed:
+            self.missed.setdefault(node, {}).update(outcomes)
+            self.missed_changed.notify()
+
+    def _push_loop(self):
+        """Deliver missed decisions to participants in bulk, retrying until they arrive."""
+        while not self.shutdown_event.is_set():
+            with self.missed_changed:
+                if not self.missed:
+                    self.missed_changed.wait(self.push_interval)
+            if not self._push_missed_outcomes():
+                self.shutdown_event.wait(self.push_interval)
+
+    def _push_missed_outcomes(self):
+        """Push every queued decision once. Returns False if some participant did not take its decisions."""
+        with self.missed_changed:
+            pending = {node: dict(outcomes) for node, outcomes in self.missed.items()}
+        delivered = True
+        for node, outcomes in pending.items():
+            if self.detector.is_suspected(node): # Wait for the node to come back
+                delivered = False
+                continue
+            try:
+                self.participants[node].apply_outcomes(outcomes)
+            except Exception as e:
+                self.trace.warning(f"Failed to push {len(outcomes)} outcomes to {node}: {e}", phase="recovery")
+                delivered = False
+                continue
+            self.trace.info(f"Pushed {len(outcomes)} missed outcomes to {node}.", phase="recovery")
+            with self.missed_changed:
+                remaining = self.missed.get(node, {})
+                for transaction_id, outcome in outcomes.items():
+                    if remaining.get(transaction_id) == outcome:
+                        del remaining[transaction_id]
+                if not remaining:
+                    self.missed.pop(node, None)
+        return delivered
+
+    def handle_recovering_node(self, transaction_id, node):
         """Handle a recovering node by sending the appropriate commit/abort."""
-        self.last_activity = time.time()
-        print(f"Coordinator: Handling recovery for account {account} on transaction {transaction_id}.")
-        final_result = self.transaction_log.get(transaction_id, "ABORTED")  # Default to ABORTED if unknown
-        return final_result
+        return self.query_outcomes([transaction_id], node)[transaction_id]
+
+    def query_outcomes(self, transaction_ids, node):
+        """Return {txn ID: outcome} for a recovering node's in-doubt transactions.
+
+        Outcomes are COMMITTED, ABORTED (also for unknown transactions, by presumed
+        abort) or PENDING while the coordinator is still deciding. Transactions of
+        another partition are PENDING too: presuming their abort could be wrong.
+        """
+        self.last_activity = self.clock.time()
+        self.trace.debug(f"Handling recovery for {node} on {len(transaction_ids)} transactions.", phase="recovery")
+        foreign = [transaction_id for transaction_id in transaction_ids if not self._owns(transaction_id)]
+        if foreign:
+            self.trace.warning(f"{node} asked about {len(foreign)} transactions of other coordinator partitions.", phase="recovery")
+        with self.lock:
+            return {transaction_id: self.transaction_log.get(transaction_id, "PENDING" if transaction_id in self.active or transaction_id in foreign else "ABORTED") for transaction_id in transaction_ids}
 
     def shutdown(self):
         """Gracefully shut down all participants."""
-        print("Coordinator: Initiating graceful shutdown of participants.")
+        self.trace.info("Initiating graceful shutdown of participants.")
         
         self.shutdown_event.set()  # Signal inactivity thread to exit
 
         # Wait for the inactivity thread to complete, but avoid self-join
-        if threading.current_thread() != self.inactivity_thread and self.inactivity_thread.is_alive():
-            print("Coordinator: Waiting for inactivity thread to complete...")
+        if self.inactivity_thread and threading.current_thread() != self.inactivity_thread and self.inactivity_thread.is_alive():
+            self.trace.info("Waiting for inactivity thread to complete...")
             self.inactivity_thread.join()
 
-        # Notify participants to shut down
-        for account, participant in self.participants.items():
+        # Notify participants to shut down, unless other coordinators still use them
+        for node, participant in (self.participants.items() if not self.peers else []):
             try:
-                print(f"Coordinator: Sending shutdown request to participant handling account {account}.")
+                self.trace.info(f"Sending shutdown request to {node}.")
                 participant.shutdown()
             except Exception as e:
-                print(f"Coordinator: Error during shutdown of account {account}: {e}")
+                self.trace.warning(f"Error during shutdown of {node}: {e}")
 
-        print("Coordinator: Finalizing shutdown.")
+        self.trace.info("Finalizing shutdown.")
         self.executor.shutdown(wait=True)  # Wait for ongoing threads to complete
-        print("Coordinator: Executor shut down.")
+        self.trace.info("Executor shut down.")
+        self.checkpoint()
+        self.wal.close()
+        self.log_owner.close() # Lets a standby take over
 
-def start_coordinator():
-    account_to_node = {
-        "A": "http://localhost:8001",
-        "B": "http://localhost:8002"
-    } # In the cloud, change 'localhost' to the internal IP of the participant
-    coordinator = Coordinator(account_to_node)
-    server = SimpleXMLRPCServer(("localhost", 8000), allow_none=True) # In the cloud, change 'localhost' to the internal IP of coordinator
+def serve_coordinator(coordinator, host="localhost", port=8000, protocol="xmlrpc"):
+    """Serve a coordinator's RPCs until it shuts down."""
+    server = make_server((host, port), protocol, max_workers=coordinator.rpc_workers, metrics=coordinator.metrics)
     server.register_instance(coordinator)
-    server.logRequests = False
 
     try:
-        print("Coordinator (Node-1) started and waiting for requests...")
+        coordinator.trace.info(f"{coordinator.name} started ({protocol}) with {coordinator.rpc_workers} workers and waiting for requests...")
         while not coordinator.shutdown_event.is_set():
             # Use a timeout to avoid indefinite blocking
             server.timeout = 1
             server.handle_request()  
     except KeyboardInterrupt:
-        print("\nCoordinator: Shutdown signal received.")
+        coordinator.trace.info("Shutdown signal received.")
     finally:
+        server.server_close()
         coordinator.shutdown()
-        print("Coordinator: Exiting.")
+        coordinator.trace.info("Exiting.")
+        coordinator.trace.flush()
+
+def start_coordinator(max_concurrency=16, protocol="xmlrpc"):
+    scheme = "tcp" if protocol == "binary" else "http" # Participants must serve the same protocol
+    node_endpoints = {
+        "Node-2": f"{scheme}://localhost:8001",
+        "Node-3": f"{scheme}://localhost:8002"
+    } # In the cloud, change 'localhost' to the internal IP of the participant
+    pins = {"A": "Node-2", "B": "Node-3"} # Test accounts stay on the nodes the simulation cases expect
+    coordinator = Coordinator(node_endpoints, max_concurrency=max_concurrency, pins=pins)
+    serve_coordinator(coordinator, "localhost", 8000, protocol) # In the cloud, change 'localhost' to the internal IP of coordinator
 
 if __name__ == "__main__":
-    start_coordinator()
\ No newline at end of file
+    start_coordinator(protocol=sys.argv[1] if len(sys.argv) > 1 else "xmlrpc")
\ No newline at end of file
@@ -1,16 +1,20 @@
 from KL_node_base import NodeBase
+import sys
 
-def start_node2():
+def start_node2(protocol="xmlrpc"):
+    scheme = "tcp" if protocol == "binary" else "http"
     node = NodeBase(
-        account_file="account_A.txt",
+        account_file="account_A.db",
         initial_balance=200,
         node_name="Node-2",
+        account="A",
         port=8001,
         host="localhost",
-        coordinator_endpoint="http://localhost:8000",
-        peer_endpoints={"Node 3": "http://localhost:8002"}
+        coordinator_endpoint=f"{scheme}://localhost:8000",
+        peer_endpoints={"Node 3": f"{scheme}://localhost:8002"},
+        protocol=protocol
     ) # In the cloud, update 'localhost' to the correct internal IP of participant/coordinator
     node.run_server()
 
 if __name__ == "__main__":
-    start_node2()
+    start_node2(protocol=sys.argv[1] if len(sys.argv) > 1 else "xmlrpc")
@@ -1,16 +1,20 @@
 from KL_node_base import NodeBase
+import sys
 
-def start_node3():
+def start_node3(protocol="xmlrpc"):
+    scheme = "tcp" if protocol == "binary" else "http"
     node = NodeBase(
-        account_file="account_B.txt",
+        account_file="account_B.db",
         initial_balance=300,
         node_name="Node-3",
+        account="B",
         port=8002,
         host="localhost",
-        coordinator_endpoint="http://localhost:8000",
-        peer_endpoints={"Node 2": "http://localhost:8001"}
+        coordinator_endpoint=f"{scheme}://localhost:8000",
+        peer_endpoints={"Node 2": f"{scheme}://localhost:8001"},
+        protocol=protocol
     ) # In the cloud, update 'localhost' to the correct internal IP of participant/coordinator
     node.run_server()
 
 if __name__ == "__main__":
-    start_node3()
+    start_node3(protocol=sys.argv[1] if len(sys.argv) > 1 else "xmlrpc")
@@ -1,278 +1,912 @@
+import bisect
+import heapq
 import time
-import xmlrpc.client
-from xmlrpc.server import SimpleXMLRPCServer
 import threading
+from KL_rpc_server import make_server, make_proxy
+from KL_wal import WriteAheadLog
+from KL_account_store import AccountStore, to_cents, from_cents
+from KL_routing import HashRing, partition_for
+from KL_failure_detector import FailureDetector
+from KL_metrics import Metrics
+from KL_trace import Tracer
+from KL_clock import SYSTEM_CLOCK
 
 class NodeBase:
-    def __init__(self, account_file, initial_balance, node_name, port, host="localhost", coordinator_endpoint=None, peer_endpoints=None):
+    def __init__(self, account_file, initial_balance, node_name, port, host="localhost", coordinator_endpoint=None, peer_endpoints=None, max_workers=16, account=None, log_file=None, checkpoint_interval=30, checkpoint_records=10000, pool_size=4, protocol="xmlrpc", ack_interval=5, max_finished_transactions=10000, phase2_timeout=5, log_level="INFO", snapshot_retention=60, escrow=False, inactivity_threshold=15, clock=None, background=True):
         self.host = host
-        self.account_file = account_file
+        self.account_file = account_file # Path of the account store
+        self.account = account or node_name # Account used by requests that do not name one
         self.initial_balance = initial_balance
         self.node_name = node_name
         self.port = port
-        self.coordinator = xmlrpc.client.ServerProxy(coordinator_endpoint) if coordinator_endpoint else None
-        self.peers = {name: xmlrpc.client.ServerProxy(endpoint) for name, endpoint in (peer_endpoints or {}).items()}
+        # One coordinator endpoint, or a list with one per partition of the transaction IDs; each may be a list of a primary and its standbys
+        endpoints = coordinator_endpoint if isinstance(coordinator_endpoint, list) else [coordinator_endpoint] if coordinator_endpoint else []
+        self.coordinators = [make_proxy(endpoint, pool_size) for endpoint in endpoints]
+        self.peers = {name: make_proxy(endpoint, pool_size) for name, endpoint in (peer_endpoints or {}).items()}
+        self.max_workers = max_workers # Maximum number of requests served concurrently
+        self.protocol = protocol # RPC protocol this node serves: "xmlrpc" or "binary"
+        self.lock = threading.RLock() # Guards the account store and transaction state
+        self.lock_released = threading.Condition(self.lock) # Signalled when account locks are released
         self.server_running = True
-        self.state = None # PREPARE, COMMITTED, or ABORTED
-        self.pending_transaction = None # Current transaction ID
+        self.transactions = {} # Transaction state table: {txn ID: {"state": PREPARED, COMMITTED or ABORTED, "legs": {account: cents}, "reserved": {account: cents}, "locks": [account]}}
+        self.account_locks = {} # Exclusive account locks: {account: [owner, number of owner's transactions]}
+        self.reserved = {} # Funds held back by prepared withdrawals: {account: cents}
+        self.lock_timeout = 1 # Time in seconds a prepare waits for a locked account before voting no
+        self.escrow = escrow # Prepare without account locks; see _acquire_accounts
         self.case = 0 # Used for simulating crashed nodes
-        self.roll_back = None # Transaction ID, amount in account before transaction
-        self.last_activity = time.time()  # Timestamp of the last activity
-        self.inactivity_threshold = 15  # Time in seconds before initiating recovery
-        self._start_inactivity_thread()  # Start inactivity monitoring
-        self.log = {} # Log of all transactions: {txn ID: result, verified}
+        self.log = {} # Outcomes not yet acknowledged to the coordinator, plus prev_txn: {txn ID: result, verified}
+        self.ack_interval = ack_interval # Time in seconds between outcome reports to the coordinator
+        self.max_finished_transactions = max_finished_transactions # Finished transactions kept in the table
+        self.acknowledged = 0 # Outcomes acknowledged to the coordinator
+        self.dropped_transactions = 0 # Finished transactions removed from the table
         self.prev_txn = None # Previous transaction ID
+        self.clock = clock or SYSTEM_CLOCK # Times activity, phase 2 deadlines and heartbeats; a simulation passes a VirtualClock
+        self.metrics = Metrics({"node": node_name}) # Handler, lock wait, storage and log latencies
+        self.trace = Tracer(node_name, log_level) # Per-transaction event buffer, written to stdout off the request path
+        self.store = AccountStore(account_file) # Committed balances in cents
+        self.versions = {} # Committed balances by commit timestamp, oldest first: {account: [(timestamp, cents)]}
+        self.snapshot_retention = snapshot_retention # Time in seconds old versions are kept for snapshot reads
+        self.prune_due = [] # Heap of (version timestamp, account): the accounts a prune past that timestamp must look at
+        self.wal = WriteAheadLog(log_file or account_file + ".wal", self.trace) # Durable prepare/commit/abort records
+        self.checkpoint_interval = checkpoint_interval # Time in seconds between checkpoints
+        self.checkpoint_records = checkpoint_records # Log records that trigger an early checkpoint
+        self._replay_log() # Version history starts at the restart; chains are created on the first commit
+        self.last_activity = self.clock.time()  # Timestamp of the last activity
+        self.inactivity_threshold = inactivity_threshold  # Time in seconds without requests before checking the coordinator is alive; None never checks
+        self.phase2_timeout = phase2_timeout # Time in seconds a prepared transaction waits for phase 2 before recovery
+        self.recovery_requested = threading.Event() # Set to run recovery now: the coordinator is back, or shutdown
+        self.detector = FailureDetector(clock=self.clock) # Suspects the coordinator when its heartbeats stop
+        if background: # Otherwise the caller runs recover(), report_outcomes() and _check_inactivity() itself
+            self._start_inactivity_thread()  # Start inactivity monitoring
+            self._start_checkpoint_thread()  # Start periodic checkpoints
+            self._start_recovery_thread()  # Resolve in-doubt transactions now and as they time out
 
     def _start_inactivity_thread(self):
         """Start a background thread to monitor inactivity."""
         def monitor_inactivity():
-            while self.server_running:
-                time.sleep(5)  # Check inactivity every 5 seconds
-                if time.time() - self.last_activity > self.inactivity_threshold:
-                    print(f"{self.node_name}: Inactivity detected. Initiating recovery.")
-                    self.ping_coordinator() # Check if coordinator is still active, shutdown if not
-                    self.recover()  # Trigger recovery
-                    self.last_activity = time.time()  # Reset inactivity after recovery
+            while self.server_running and self.inactivity_threshold is not None:
+                time.sleep(1)
+                self._check_inactivity()
 
         thread = threading.Thread(target=monitor_inactivity, daemon=True)
         thread.start()
 
+    def _check_inactivity(self):
+        """Ping the coordinator when idle or when its heartbeats stopped, and shut down if none answers."""
+        idle = self.inactivity_threshold is not None and self.clock.time() - self.last_activity > self.inactivity_threshold
+        if idle or self.detector.is_suspected("coordinator"):
+            self.ping_coordinator() # Check if coordinator is still active, shutdown if not
+            self.last_activity = self.clock.time()  # Reset inactivity after the check
+
     def _update_last_activity(self):
         """Update the timestamp for the last activity."""
-        self.last_activity = time.time()
+        self.last_activity = self.clock.time()
+
+    def heartbeat(self):
+        """Answer the coordinator's heartbeat. One from a coordinator that was suspected runs recovery now."""
+        suspected = self.detector.is_suspected("coordinator")
+        self.detector.heartbeat("coordinator")
+        if suspected: # Back up: resolve what it left in doubt without waiting out the timeouts
+            self.recovery_requested.set()
+        return True
 
     def ping_coordinator(self):
-        """Check if coordinator is still alive."""
-        try:
-            self.coordinator.is_alive()
-        except Exception as e:
-            print(f"{self.node_name}: Failed to contact coordinator. Shutting down")
-            self.shutdown()
-
-    def initialize_account(self, initial_balance=0):
-        """Initialize the account file with a specified starting balance."""
+        """Check if coordinator is still alive, and shut down if no coordinator is."""
+        for coordinator in self.coordinators:
+            try:
+                coordinator.is_alive()
+                return
+            except Exception:
+                pass
+        self.trace.warning("Failed to contact coordinator. Shutting down")
+        self.shutdown()
+
+    def _by_coordinator(self, transaction_ids):
+        """Group transaction IDs by the partition of the coordinator that decides them: {partition: [txn ID]}."""
+        grouped = {}
+        for transaction_id in transaction_ids:
+            grouped.setdefault(partition_for(transaction_id, len(self.coordinators)), []).append(transaction_id)
+        return grouped
+
+    def initialize_account(self, initial_balance=0, account=None):
+        """Initialize an account with a specified starting balance."""
         self._update_last_activity()  # Mark activity
-        if self._read_account() == initial_balance:
-            print(f"{self.node_name}: Account already initialized with balance {initial_balance}.")
-            return initial_balance
-        print(f"{self.node_name}: Account initialized with balance {initial_balance}.")
-        return self._write_account(initial_balance)
+        account = account or self.account
+        cents = to_cents(initial_balance)
+        with self.lock:
+            if self.store.get(account) == cents:
+                self.trace.info(f"Account {account} already initialized with balance {initial_balance}.")
+                return initial_balance
+            self.trace.info(f"Account {account} initialized with balance {initial_balance}.")
+            timestamp = max(time.time_ns() // 1000, self._latest_version([account]) + 1)
+            self.versions.setdefault(account, [(0, self.store.get(account))]).append((timestamp, cents))
+            heapq.heappush(self.prune_due, (timestamp, account))
+            lsn = self.wal.append({"type": "balance", "balances": {account: cents}})
+            self.store.stage({account: cents}, lsn)
+        self._sync()
+        return True
 
-    def get_balance(self):
+    def get_balance(self, account=None):
         """Public method to expose the current account balance.""" 
-        balance = self._read_account()
-        return balance if balance is not None else 0
+        with self.lock:
+            balance = self.store.get(account or self.account)
+        return from_cents(balance) if balance is not None else 0
+
+    def get_balances_at(self, accounts, timestamp):
+        """Snapshot read: return {account: balance} as of a commit timestamp, None for accounts that did not exist.
+
+        Reads the version chains, so it never waits for transactions in flight. An
+        account with no chain has not changed since the restart or the retention
+        horizon and is read from the store. Timestamps are microseconds, sent as floats because XML-RPC
+        integers are 32-bit.
+        """
+        timestamp = int(timestamp)
+        balances = {}
+        for account in accounts:
+            chain = self.versions.get(account)
+            if chain is None:
+                with self.lock:
+                    chain = self.versions.get(account) or [(0, self.store.get(account))]
+            index = bisect.bisect_right(chain, timestamp, key=lambda version: version[0]) - 1
+            if index < 0:
+                raise ValueError(f"Snapshot {timestamp} is older than the versions kept for {account}")
+            cents = chain[index][1]
+            balances[account] = from_cents(cents) if cents is not None else None
+        return balances
+
+    def _add_version(self, account, amount, timestamp):
+        """Add a committed change of amount cents to the account's version chain and return the new balance. Caller holds self.lock.
+
+        Commits can arrive out of timestamp order (a one-phase timestamp is issued
+        before its lock wait, and escrow takes no locks), so the change goes in at
+        its timestamp and is added to every later version: changes commute. The
+        later versions belong to transactions still in phase 2, which no snapshot
+        can see yet. A batch commits under one timestamp, so its changes share
+        one version.
+        """
+        chain = self.versions.get(account)
+        if chain is None:
+            chain = self.versions[account] = [(0, self.store.get(account))]
+        index = bisect.bisect_right(chain, timestamp, key=lambda version: version[0])
+        if chain[index - 1][0] != timestamp:
+            chain.insert(index, (timestamp, chain[index - 1][1]))
+            heapq.heappush(self.prune_due, (timestamp, account))
+        self._shift_versions(account, amount, timestamp)
+        return self.store.get(account) + amount
+
+    def _shift_versions(self, account, amount, timestamp):
+        """Add amount cents to every version of account at or after timestamp. Caller holds self.lock."""
+        chain = self.versions.get(account, [])
+        for index in range(bisect.bisect_left(chain, timestamp, key=lambda version: version[0]), len(chain)):
+            if chain[index][1] is not None:
+                chain[index] = (chain[index][0], chain[index][1] + amount)
+
+    def _latest_version(self, accounts):
+        """Return the newest version timestamp of any of accounts."""
+        return max((self.versions[account][-1][0] for account in accounts if account in self.versions), default=0)
+
+    def _prune_versions(self):
+        """Drop versions older than snapshot_retention, keeping the one a snapshot at the horizon reads.
+
+        Only accounts with a version that has aged past the horizon are looked at.
+        A chain left with just that version is dropped, as the store holds it.
+        """
+        horizon = time.time_ns() // 1000 - self.snapshot_retention * 1000000
+        with self.lock:
+            while self.prune_due and self.prune_due[0][0] <= horizon:
+                account = heapq.heappop(self.prune_due)[1]
+                chain = self.versions.get(account)
+                if chain is None: # Already dropped
+                    continue
+                index = bisect.bisect_right(chain, horizon, key=lambda version: version[0]) - 1
+                if index == len(chain) - 1:
+                    del self.versions[account]
+                elif index > 0:
+                    self.versions[account] = chain[index:] # Readers keep the list they already hold
+
+    def export_accounts(self, nodes, vnodes, pins, target):
+        """Return {account: balance} for the accounts that move to target when the ring becomes nodes."""
+        ring = HashRing(nodes, vnodes=vnodes, pins=pins)
+        with self.lock:
+            moving = {account: from_cents(cents) for account, cents in self.store.items() if ring.node_for(account) == target}
+            prepared = {account for txn in self.transactions.values() if txn["state"] == "PREPARED" for account in txn["legs"]} # Escrow takes no locks
+            locked = [account for account in moving if account in self.account_locks or account in prepared or self.reserved.get(account)]
+        if locked:
+            raise ValueError(f"{self.node_name}: Accounts {locked} have transactions in progress")
+        self.trace.info(f"Exporting {len(moving)} accounts to {target}.")
+        return moving
+
+    def import_accounts(self, balances):
+        """Take ownership of accounts moved from another node: {account: balance}."""
+        self._update_last_activity()  # Mark activity
+        cents = {account: to_cents(balance) for account, balance in balances.items()}
+        with self.lock:
+            for account in cents: # The store holds the balance; a snapshot reads it from there
+                self.versions.pop(account, None)
+            lsn = self.wal.append({"type": "balance", "balances": cents})
+            self.store.stage(cents, lsn)
+        self._sync()
+        self.trace.info(f"Imported {len(cents)} accounts.")
+        return len(cents)
+
+    def drop_accounts(self, accounts):
+        """Delete accounts that now belong to another node."""
+        self._update_last_activity()  # Mark activity
+        with self.lock:
+            for account in accounts:
+                self.versions.pop(account, None)
+            lsn = self.wal.append({"type": "drop", "accounts": accounts})
+            self.store.stage(dict.fromkeys(accounts), lsn)
+        self._sync()
+        self.trace.info(f"Dropped {len(accounts)} accounts.")
+        return len(accounts)
+
+    def get_trace(self, transaction_id):
+        """Return this node's buffered events for one transaction."""
+        return self.trace.trace(transaction_id)
+
+    def set_log_level(self, level):
+        """Change the lowest level this node writes to stdout: DEBUG, INFO, WARNING or ERROR."""
+        self.trace.set_level(level)
+        return True
+
+    def get_metrics(self):
+        """Return this node's counters and latency histograms."""
+        return self.metrics.snapshot()
+
+    def get_metrics_text(self):
+        """Return this node's metrics in the Prometheus text format."""
+        return self.metrics.prometheus_text()
+
+    def get_pool_stats(self):
+        """Return the connection pool counters for the coordinator and peers."""
+        stats = {name: peer.pool.stats() for name, peer in self.peers.items()}
+        for partition, coordinator in enumerate(self.coordinators):
+            stats["coordinator" if len(self.coordinators) == 1 else f"coordinator-{partition}"] = coordinator.pool.stats()
+        return stats
 
     def simulation_case(self, case):
         """Set simulation case for testing."""
         self.case = case
         return True
 
-    def _read_account(self):
-        """Read account balance from the file."""
-        try:
-            with open(self.account_file, "r") as f:
-                return float(f.read().strip())  
-        except FileNotFoundError:
-            return None  # Account does not exist
-
+    def _start_checkpoint_thread(self):
+        """Start a background thread that checkpoints the log periodically."""
+        def checkpoint_loop():
+            last_checkpoint = last_report = time.time()
+            while self.server_running:
+                time.sleep(1)
+                if time.time() - last_report >= self.ack_interval:
+                    self.report_outcomes()
+                    self._prune_versions()
+                    last_report = time.time()
+                due = time.time() - last_checkpoint >= self.checkpoint_interval
+                if self.wal.records_since_checkpoint >= self.checkpoint_records or (due and self.wal.records_since_checkpoint):
+                    self.checkpoint()
+                    last_checkpoint = time.time()
+
+        thread = threading.Thread(target=checkpoint_loop, daemon=True)
+        thread.start()
 
-    def _write_account(self, balance):
-        """Write account balance to the file."""
-        try:
-            with open(self.account_file, "w") as f:
-                f.write(f"{balance:.2f}")  # Write as float with 2 decimal places
-        except IOError as e:
-            print(f"{self.node_name}: Error writing account balance. {e}")
-            return False
+    def report_outcomes(self):
+        """Acknowledge finished transactions to the coordinator and forget the acknowledged ones.
+
+        The coordinator answers with the outcomes this node has wrong, which are
+        corrected as in recovery.
+        """
+        with self.lock:
+            outcomes = {txn_id: result for txn_id, (result, _) in self.log.items() if self.transactions.get(txn_id, {}).get("state", result) == result}
+        if not outcomes or not self.coordinators:
+            return 0
+        corrections = {}
+        for partition, transaction_ids in self._by_coordinator(list(outcomes)).items():
+            try:
+                corrections.update(self.coordinators[partition].acknowledge_outcomes(self.node_name, {t: outcomes[t] for t in transaction_ids}))
+            except Exception as e:
+                self.trace.warning(f"Failed to report outcomes to coordinator: {e}", phase="recovery")
+                for transaction_id in transaction_ids:
+                    del outcomes[transaction_id] # Reported again next time
+        for transaction_id, outcome in corrections.items():
+            self.trace.debug(f"Coordinator outcome for transaction {transaction_id}: {outcome}", txn=transaction_id, phase="recovery")
+            self._finalize_recovery(transaction_id, self.transactions.get(transaction_id, {}).get("state"), outcome)
+        with self.lock:
+            for transaction_id, result in outcomes.items():
+                if transaction_id in corrections or self.log.get(transaction_id, (None,))[0] != result:
+                    continue # Corrected, or changed since it was reported
+                if transaction_id == self.prev_txn:
+                    self.log[transaction_id] = (result, True) # Keep the last outcome for recovery
+                else:
+                    del self.log[transaction_id]
+                self.acknowledged += 1
+            self._trim_transactions()
+        return len(outcomes) - len(corrections)
+
+    def _trim_transactions(self):
+        """Drop the oldest finished transactions beyond max_finished_transactions."""
+        excess = len(self.transactions) - self.max_finished_transactions
+        for transaction_id in list(self.transactions):
+            if excess <= 0:
+                break
+            if self.transactions[transaction_id]["state"] != "PREPARED" and transaction_id not in self.log:
+                del self.transactions[transaction_id]
+                self.dropped_transactions += 1
+                excess -= 1
+
+    def get_log_stats(self):
+        """Return the number of retained log and transaction entries."""
+        with self.lock:
+            return {
+                "log_entries": len(self.log),
+                "transactions": len(self.transactions),
+                "prepared": sum(1 for txn in self.transactions.values() if txn["state"] == "PREPARED"),
+                "acknowledged": self.acknowledged,
+                "dropped_transactions": self.dropped_transactions,
+            }
+
+    def checkpoint(self):
+        """Flush the account store and restart the log from a snapshot of the transaction state."""
+        with self.lock:
+            self.wal.sync() # Every staged change is durable, so the store can take them all
+            self.store.apply()
+            self.store.flush() # Balances are on disk before the log records behind them are dropped
+            state = {
+                "transactions": {txn_id: {k: v for k, v in txn.items() if k not in ("locks", "commit_ts")} for txn_id, txn in self.transactions.items()},
+                "log": self.log,
+                "prev_txn": self.prev_txn,
+            }
+            self.wal.checkpoint(state)
         return True
 
-    def prepare(self, transaction_id, amount):
-        """Prepare phase: validate the transaction."""
+    def _replay_log(self):
+        """Rebuild balances and the transaction table from the last checkpoint and the log after it."""
+        if not self.wal.records and self.account not in self.store: # First start: seed the node's account
+            self.trace.info(f"Creating account {self.account} with balance {self.initial_balance}.")
+            self.store.set(self.account, to_cents(self.initial_balance))
+            self.checkpoint()
+            return
+        with self.lock:
+            self._apply_log_records(self.wal.records)
+        prepared = sum(1 for txn in self.transactions.values() if txn["state"] == "PREPARED")
+        self.trace.info(f"Replayed {len(self.wal.records)} log records. {len(self.store)} accounts, {prepared} prepared transactions.")
+
+    def _apply_log_records(self, records):
+        """Apply logged records to the in-memory state, in order.
+
+        Balance changes are logged as the resulting balances rather than as deltas,
+        and reach the store only once their record is durable (see AccountStore),
+        so the store on disk never runs ahead of the log and replaying the records
+        over it is correct whichever of its pages were written back before a crash.
+        """
+        for record in records:
+            kind = record["type"]
+            if kind == "checkpoint":
+                state = record["state"]
+                self.log = {txn_id: tuple(entry) for txn_id, entry in state["log"].items()}
+                self.prev_txn = state["prev_txn"]
+                for transaction_id, txn in state["transactions"].items():
+                    self._restore_transaction(transaction_id, txn)
+            elif kind == "balance":
+                self._set_balances(record["balances"])
+            elif kind == "prepare":
+                self._restore_transaction(record["txn"], {"state": "PREPARED", "legs": record["legs"], "reserved": record["reserved"], "owner": record["owner"]})
+            elif kind == "commit":
+                self._set_balances(record["balances"])
+                if record.get("one_phase"):
+                    self.transactions[record["txn"]] = {"state": "COMMITTED", "legs": record["legs"]}
+                else:
+                    self._finish_transaction(record["txn"], "COMMITTED")
+                self.log[record["txn"]] = ("COMMITTED", record.get("one_phase", False))
+                self.prev_txn = record["txn"]
+            elif kind == "abort":
+                self._finish_transaction(record["txn"], "ABORTED")
+                self.log[record["txn"]] = ("ABORTED", False)
+                self.prev_txn = record["txn"]
+            elif kind == "rollback":
+                self._set_balances(record["balances"])
+                self._finish_transaction(record["txn"], "ABORTED")
+                self.log[record["txn"]] = ("ABORTED", False)
+            elif kind == "drop":
+                for account in record["accounts"]:
+                    self.store.delete(account)
+
+    def _set_balances(self, balances):
+        """Write logged balances in cents to the store."""
+        for account, cents in balances.items():
+            self.store.set(account, cents)
+
+    def _restore_transaction(self, transaction_id, txn):
+        """Put a logged transaction back in the table, retaking the locks and funds of a prepared one."""
+        self.transactions[transaction_id] = txn
+        if txn["state"] == "PREPARED":
+            txn["recover_at"] = self.clock.time() # In doubt since the restart: resolve right away
+            for account, amount in txn.get("reserved", {}).items():
+                self.reserved[account] = self.reserved.get(account, 0) + amount
+            self._acquire_accounts(transaction_id, txn["owner"], list(txn["legs"]))
+
+    def prepare(self, transaction_id, amount, account=None):
+        """Prepare phase: lock the account, validate the transaction and reserve funds."""
         self._update_last_activity()  # Mark activity
-        print(f"{self.node_name}: Received prepare request for transaction {transaction_id} with amount {amount}.")
-        # Check for unclean state
-        if self.state is not None:
-            print(f"{self.node_name}: Unclean state detected! Current state: {self.state}")
-
-            # If the previous transaction was PREPARED but unresolved, roll it back
-            if self.state == "PREPARED" and self.pending_transaction:
-                prev_transaction_id, prev_balance = self.roll_back
-                print(f"{self.node_name}: Rolling back previous transaction {prev_transaction_id}.")
-                self._write_account(prev_balance)  # Restore the previous balance
-                self.state = None
-                self.pending_transaction = None
-                self.roll_back = None
-                print(f"{self.node_name}: Previous transaction rolled back successfully.")
-
-            # If the previous transaction is COMMITTED or ABORTED, do not roll back
-            elif self.state in ["COMMITTED", "ABORTED"]:
-                print(f"{self.node_name}: Transaction {transaction_id} rejected. Previous transaction already finalized.")
-                return False
-        self.state = "PREPARED"
-        self.pending_transaction = (transaction_id, amount)
-        balance = self._read_account()
-        self.roll_back = (transaction_id, balance)
+        self.trace.debug(f"Received prepare request for transaction {transaction_id} with amount {amount}.", txn=transaction_id, phase="prepare")
+        start = time.perf_counter()
+        vote = self._prepare(transaction_id, {account or self.account: amount}, transaction_id)
+        self._sync() # A yes vote must be durable before it is sent
+        self.metrics.observe("kl_handler_seconds", time.perf_counter() - start, op="prepare")
 
         if self.case == 1 and self.node_name == "Node-2":
             time.sleep(20) # Node-2 crashes (does not respond to coordinator)
+        return vote
 
-        if balance is None:
-            print(f"{self.node_name}: Account does not exist for transaction {transaction_id}.")
-            return False
-        elif amount < 0 and balance < abs(amount):  # Check for sufficient balance for withdrawal
-            print(f"{self.node_name}: Insufficient funds for transaction {transaction_id}.")
-            return False
-        print(f"{self.node_name}: Prepared for transaction {transaction_id}.")
+    def prepare_legs(self, transaction_id, legs):
+        """Prepare phase for a transaction with several legs on this node: {account: amount}."""
+        self._update_last_activity()  # Mark activity
+        self.trace.debug(f"Received prepare request for transaction {transaction_id} with legs {legs}.", txn=transaction_id, phase="prepare")
+        start = time.perf_counter()
+        vote = self._prepare(transaction_id, legs, transaction_id)
+        self._sync() # A yes vote must be durable before it is sent
+        self.metrics.observe("kl_handler_seconds", time.perf_counter() - start, op="prepare")
+
+        if self.case == 1 and self.node_name == "Node-2":
+            time.sleep(20) # Node-2 crashes (does not respond to coordinator)
+        return vote
+
+    def prepare_batch(self, batch_id, items):
+        """Prepare a batch of [txn ID, {account: amount}] items. Returns one vote per item.
+
+        [txn ID, amount] and [txn ID, amount, account] items are accepted for single-leg transactions.
+        """
+        self._update_last_activity()  # Mark activity
+        self.trace.debug(f"Received prepare request for batch {batch_id} with {len(items)} transactions.", txn=batch_id, phase="prepare")
+        start = time.perf_counter()
+        # Transactions of one batch share their account locks, so they never wait on each other
+        votes = [self._prepare(item[0], self._item_legs(item), batch_id) for item in items]
+        self._sync() # One flush covers the whole batch
+        self.metrics.observe("kl_handler_seconds", time.perf_counter() - start, op="prepare_batch")
+
+        if self.case == 1 and self.node_name == "Node-2":
+            time.sleep(20) # Node-2 crashes (does not respond to coordinator)
+        return votes
+
+    def commit_one_phase(self, transaction_id, legs, commit_ts=None):
+        """One-phase commit for a transaction whose legs are all on this node.
+
+        The node prepares and commits under one hold of its lock, with a single
+        forced log write, and decides the outcome itself: the coordinator logs
+        nothing and the transaction is never in doubt.
+        """
+        self._update_last_activity()  # Mark activity
+        self.trace.debug(f"Received one-phase commit request for transaction {transaction_id} with legs {legs}.", txn=transaction_id, phase="one_phase")
+        start = time.perf_counter()
+        with self.lock:
+            txn = self.transactions.get(transaction_id)
+            if txn is not None: # Retried request, or the coordinator already gave up on it
+                self.trace.debug(f"Transaction {transaction_id} is already {txn['state']}.", txn=transaction_id, phase="one_phase")
+                return txn["state"] == "COMMITTED"
+            vote = self._prepare(transaction_id, legs, transaction_id, log=False)
+            committed = vote == "READ_ONLY" or (vote and self._commit(transaction_id, one_phase=True, commit_ts=commit_ts))
+        self._sync()
+        self.metrics.observe("kl_handler_seconds", time.perf_counter() - start, op="commit_one_phase")
+        return committed
+
+    def _sync(self):
+        """Force the log to disk, timing the flush, then write the changes it made durable to the store."""
+        with self.metrics.timer("kl_wal_sync_seconds"):
+            self.wal.sync()
+        with self.lock:
+            self.store.apply(self.wal.durable_lsn)
+
+    def _item_legs(self, item):
+        """Return the {account: amount} legs of a prepare_batch item."""
+        if isinstance(item[1], dict):
+            return item[1]
+        return {item[2] if len(item) > 2 else self.account: item[1]}
+
+    def _prepare(self, transaction_id, legs, owner, log=True):
+        """Lock the accounts for owner, check the funds and reserve them.
+
+        Returns the vote: True, False, or "READ_ONLY" when no leg changes a balance.
+        A read-only transaction takes no locks, is not logged and needs no phase 2.
+        """
+        legs = {account: to_cents(amount) for account, amount in legs.items()}
+        with self.lock:
+            txn = self.transactions.get(transaction_id)
+            if txn is not None: # Duplicate prepare, or the transaction was already aborted
+                self.trace.debug(f"Transaction {transaction_id} is already {txn['state']}.", txn=transaction_id, phase="prepare")
+                self.metrics.inc("kl_votes_total", vote="duplicate")
+                return txn["state"] == "PREPARED"
+
+            missing = [account for account, amount in legs.items() if amount == 0 and account not in self.store]
+            if missing:
+                self.trace.info(f"Accounts {missing} do not exist for transaction {transaction_id}.", txn=transaction_id, phase="prepare")
+                self.metrics.inc("kl_votes_total", vote="no", reason="missing_account")
+                return False
+            legs = {account: amount for account, amount in legs.items() if amount != 0} # Zero legs need no lock
+            if not legs:
+                self.trace.debug(f"Transaction {transaction_id} changes nothing here. Voting read-only.", txn=transaction_id, phase="prepare")
+                self.metrics.inc("kl_votes_total", vote="read_only")
+                return "READ_ONLY"
+
+            txn = self.transactions[transaction_id] = {"state": "PREPARED", "legs": legs, "owner": owner, "recover_at": self.clock.time() + self.phase2_timeout}
+            if not self._acquire_accounts(transaction_id, owner, list(legs)):
+                locked = [f"{a} (held by {self.account_locks[a][0]})" for a in legs if self.account_locks.get(a, [owner])[0] != owner]
+                self.trace.info(f"Accounts {locked} are locked. Voting no on {transaction_id}.", txn=transaction_id, phase="prepare")
+                self._finish_transaction(transaction_id, "ABORTED")
+                self.metrics.inc("kl_votes_total", vote="no", reason="locked")
+                return False
+
+            read_start = time.perf_counter()
+            for account, amount in legs.items():
+                balance = self.store.get(account)
+                if balance is None:
+                    self.trace.info(f"Account {account} does not exist for transaction {transaction_id}.", txn=transaction_id, phase="prepare")
+                    self._finish_transaction(transaction_id, "ABORTED")
+                    self.metrics.inc("kl_votes_total", vote="no", reason="missing_account")
+                    return False
+                available = balance - self.reserved.get(account, 0)
+                if amount < 0 and available < abs(amount):  # Check for sufficient unreserved balance for withdrawal
+                    self.trace.info(f"Insufficient funds in account {account} for transaction {transaction_id}.", txn=transaction_id, phase="prepare")
+                    self._finish_transaction(transaction_id, "ABORTED")
+                    self.metrics.inc("kl_votes_total", vote="no", reason="insufficient_funds")
+                    return False
+            self.metrics.observe("kl_storage_seconds", time.perf_counter() - read_start, op="read")
+            for account, amount in legs.items():
+                if amount < 0: # Hold the funds until commit or abort
+                    self.reserved[account] = self.reserved.get(account, 0) + abs(amount)
+                    txn.setdefault("reserved", {})[account] = abs(amount)
+            if log:
+                self.wal.append({"type": "prepare", "txn": transaction_id, "legs": txn["legs"], "reserved": txn.get("reserved", {}), "owner": owner})
+
+        self.trace.debug(f"Prepared for transaction {transaction_id}.", txn=transaction_id, phase="prepare")
+        self.metrics.inc("kl_votes_total", vote="yes")
         return True
 
-    def commit(self, transaction_id):
-        """Commit the transaction."""
-        self.prev_txn = transaction_id
+    def commit(self, transaction_id, commit_ts=None):
+        """Commit the transaction. commit_ts orders it for snapshot reads; recovery commits use the local clock."""
         self._update_last_activity()  # Mark activity
-        print(f"{self.node_name}: Received commit request for transaction {transaction_id}.")
-        self.log[transaction_id] = ("COMMITTED", False)
+        self.trace.debug(f"Received commit request for transaction {transaction_id}.", txn=transaction_id, phase="commit")
         if self.case == 2 and self.node_name == "Node-2":
             time.sleep(20) # Node-2 crashes (does not respond to coordinator)
-
-        if self.state == "PREPARED" and self.pending_transaction and self.pending_transaction[0] == transaction_id:
-            _, amount = self.pending_transaction
-            balance = self._read_account()
-            if balance is None:
-                print(f"{self.node_name}: Cannot commit transaction {transaction_id}. Failed to read account.")
+        start = time.perf_counter()
+        result = self._commit(transaction_id, commit_ts=commit_ts)
+        self._sync()
+        self.metrics.observe("kl_handler_seconds", time.perf_counter() - start, op="commit")
+        return result
+
+    def commit_batch(self, transaction_ids, commit_ts=None):
+        """Commit a batch of transactions with one commit timestamp. Returns one result per transaction."""
+        self._update_last_activity()  # Mark activity
+        self.trace.debug(f"Received commit request for {len(transaction_ids)} transactions.", phase="commit")
+        if self.case == 2 and self.node_name == "Node-2":
+            time.sleep(20) # Node-2 crashes (does not respond to coordinator)
+        start = time.perf_counter()
+        results = [self._commit(transaction_id, commit_ts=commit_ts) for transaction_id in transaction_ids]
+        self._sync() # One flush covers the whole batch
+        self.metrics.observe("kl_handler_seconds", time.perf_counter() - start, op="commit_batch")
+        return results
+
+    def _commit(self, transaction_id, one_phase=False, commit_ts=None):
+        """Apply a prepared transaction to the account."""
+        with self.lock:
+            txn = self.transactions.get(transaction_id)
+            if txn is not None and txn["state"] == "COMMITTED": # Duplicate: its log entry stays as it was
+                self.trace.debug(f"Transaction {transaction_id} already committed.", txn=transaction_id, phase="commit")
+                return True
+            if txn is None or txn["state"] != "PREPARED":
+                self.trace.warning(f"Cannot commit transaction {transaction_id}. Not in prepared state.", txn=transaction_id, phase="commit")
+                return False
+            if any(account not in self.store for account in txn["legs"]):
+                self.trace.warning(f"Cannot commit transaction {transaction_id}. Failed to read account.", txn=transaction_id, phase="commit")
                 return False
-            new_balance = balance + amount
-            self._write_account(new_balance)
-            self.state = "COMMITTED"
-            self.pending_transaction = None
-            print(f"{self.node_name}: Transaction {transaction_id} committed successfully.")
-            self.state = None  # Reset state after commit
+            if commit_ts is None: # Recovery: after every version the accounts already have
+                commit_ts = max(time.time_ns() // 1000, self._latest_version(txn["legs"]) + 1)
+            txn["commit_ts"] = int(commit_ts)
+            balances = self._apply_commit(transaction_id)
+            record = {"type": "commit", "txn": transaction_id, "balances": balances}
+            if one_phase: # No prepare record precedes it, so it carries the legs itself
+                record.update(one_phase=True, legs=txn["legs"])
+            self.store.stage(balances, self.wal.append(record))
+            self.prev_txn = transaction_id
+            self.log[transaction_id] = ("COMMITTED", one_phase) # A one-phase outcome was decided here and needs no check
+            self.trace.info(f"Transaction {transaction_id} committed successfully.", txn=transaction_id, phase="commit")
             return True
-        print(f"{self.node_name}: Cannot commit transaction {transaction_id}. Not in prepared state.")
-        self.state = None  # Reset state after commit
-        return False
+
+    def _apply_commit(self, transaction_id):
+        """Add every leg of a prepared transaction to its version chain. Returns the new balances, for the caller to log and stage."""
+        balances = {}
+        txn = self.transactions[transaction_id]
+        with self.metrics.timer("kl_storage_seconds", op="write"):
+            for account, amount in txn["legs"].items():
+                balances[account] = self._add_version(account, amount, txn["commit_ts"])
+        self._finish_transaction(transaction_id, "COMMITTED")
+        return balances
 
     def abort(self, transaction_id):
         """Abort the transaction."""
-        self.prev_txn = transaction_id
-        self.log[transaction_id] = ("ABORTED", False)
         self._update_last_activity()  # Mark activity
+        self.trace.debug(f"Received abort request for transaction {transaction_id}.", txn=transaction_id, phase="abort")
+        with self.metrics.timer("kl_handler_seconds", op="abort"):
+            return self._abort(transaction_id)
 
-        print(f"{self.node_name}: Received abort request for transaction {transaction_id}.")
-        if self.state == "PREPARED" and self.pending_transaction and self.pending_transaction[0] == transaction_id:
-            self.state = "ABORTED"
-            self.pending_transaction = None
-            print(f"{self.node_name}: Transaction {transaction_id} aborted.")
-        else:
-            print(f"{self.state} {self.pending_transaction}")
-            print(f"{self.node_name}: Cannot abort transaction {transaction_id}. Not in prepared state or transaction does not match.")
-            self.state = None  # Reset state after abort
+    def abort_batch(self, transaction_ids):
+        """Abort a batch of transactions. Returns one result per transaction."""
+        self._update_last_activity()  # Mark activity
+        self.trace.debug(f"Received abort request for {len(transaction_ids)} transactions.", phase="abort")
+        with self.metrics.timer("kl_handler_seconds", op="abort_batch"):
+            return [self._abort(transaction_id) for transaction_id in transaction_ids]
+
+    def _abort(self, transaction_id):
+        """Release a prepared transaction without applying it."""
+        with self.lock:
+            txn = self.transactions.get(transaction_id)
+            if txn is None: # Remember the abort so a late prepare is rejected
+                self.transactions[transaction_id] = {"state": "ABORTED", "legs": {}}
+                self.prev_txn = transaction_id
+                self.log[transaction_id] = ("ABORTED", False)
+                self.trace.debug(f"Cannot abort transaction {transaction_id}. Transaction is unknown.", txn=transaction_id, phase="abort")
+                return False
+            if txn["state"] == "PREPARED":
+                self._finish_transaction(transaction_id, "ABORTED")
+                self.wal.append({"type": "abort", "txn": transaction_id}) # Not forced: an unknown transaction is presumed aborted
+                self.prev_txn = transaction_id
+                self.log[transaction_id] = ("ABORTED", False)
+                self.trace.info(f"Transaction {transaction_id} aborted.", txn=transaction_id, phase="abort")
+                return True
+            if txn["state"] == "ABORTED": # Duplicate: its log entry stays as it was
+                self.trace.debug(f"Transaction {transaction_id} already aborted.", txn=transaction_id, phase="abort")
+                return True
+            self.trace.debug(f"Cannot abort transaction {transaction_id}. Transaction is {txn['state']}.", txn=transaction_id, phase="abort")
             return False
-        self.state = None  # Reset state after abort
-        return True
 
     def roll_back_state(self, transaction_id):
-        """Roll back the account to its state before the transaction."""
+        """Undo the transaction's changes to the account."""
         self._update_last_activity()  # Mark activity
-        if not self.roll_back:
-            print(f"{self.node_name}: No rollback state available. Nothing to roll back.")
-            return False
+        with self.metrics.timer("kl_handler_seconds", op="rollback"):
+            result = self._roll_back(transaction_id)
+            self._sync()
+        return result
 
-        if self.roll_back[0] != transaction_id:
-            print(f"{self.node_name}: Rollback skipped. Transaction ID {transaction_id} does not match rollback state.")
-            return False
+    def roll_back_batch(self, transaction_ids):
+        """Roll back a batch of transactions. Returns one result per transaction."""
+        self._update_last_activity()  # Mark activity
+        with self.metrics.timer("kl_handler_seconds", op="rollback_batch"):
+            results = [self._roll_back(transaction_id) for transaction_id in transaction_ids]
+            self._sync() # One flush covers the whole batch
+        return results
+
+    def _roll_back(self, transaction_id):
+        """Abort a prepared transaction or apply the inverse of a committed one."""
+        with self.lock:
+            txn = self.transactions.get(transaction_id)
+            if txn is None:
+                self.trace.debug(f"No rollback state available for transaction {transaction_id}. Nothing to roll back.", txn=transaction_id, phase="rollback")
+                return False
+            if txn["state"] == "ABORTED":
+                self.trace.debug(f"Transaction {transaction_id} already aborted. Nothing to roll back.", txn=transaction_id, phase="rollback")
+                return True
+
+            self.trace.info(f"Rolling back transaction {transaction_id}.", txn=transaction_id, phase="rollback")
+            balances = self._apply_roll_back(transaction_id)
+            self.store.stage(balances, self.wal.append({"type": "rollback", "txn": transaction_id, "balances": balances}))
+            self.log[transaction_id] = ("ABORTED", False)
+            self.trace.debug(f"Rollback completed for transaction {transaction_id}.", txn=transaction_id, phase="rollback")
+            return True
 
-        print(f"{self.node_name}: Rolling back transaction {transaction_id}.")
-        self._write_account(self.roll_back[1])  # Restore the previous balance
-        self.state = None  # Reset state
-        self.pending_transaction = None
-        self.roll_back = None  # Clear rollback state
-        print(f"{self.node_name}: Rollback completed for transaction {transaction_id}.")
+    def _apply_roll_back(self, transaction_id):
+        """Release a prepared transaction or subtract every leg of a committed one. Returns the new balances."""
+        balances = {}
+        txn = self.transactions[transaction_id]
+        if txn["state"] == "COMMITTED": # Apply the inverse of every committed leg
+            commit_ts = txn.get("commit_ts", 0) # Committed before a restart: in every version since
+            for account, amount in txn["legs"].items():
+                balances[account] = self.store.get(account) - amount
+                self._shift_versions(account, -amount, commit_ts) # As if it never committed
+        self._finish_transaction(transaction_id, "ABORTED")
+        return balances
+
+    def _acquire_accounts(self, transaction_id, owner, accounts):
+        """Lock accounts for owner (a transaction or a batch), waiting up to lock_timeout.
+
+        In escrow mode nothing is locked. Commits add their legs to the balance,
+        so deposits commute, and a withdrawal is checked against the balance less
+        every reserved withdrawal, which is the lowest the balance can fall
+        whatever the prepared transactions decide. Any number of transactions on
+        a hot account can then be prepared at once. Only rolling back a commit
+        can break the bound.
+        """
+        if self.escrow:
+            return True
+        txn = self.transactions[transaction_id]
+        start = time.time()
+        deadline = start + self.lock_timeout
+        for account in sorted(accounts): # Fixed order avoids deadlocks between local transactions
+            while account in self.account_locks and self.account_locks[account][0] != owner:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self.metrics.observe("kl_lock_wait_seconds", time.time() - start, result="timeout")
+                    return False
+                self.lock_released.wait(remaining)
+            holder = self.account_locks.setdefault(account, [owner, 0])
+            holder[1] += 1 # Count of owner's transactions using the lock
+            txn.setdefault("locks", []).append(account)
+        self.metrics.observe("kl_lock_wait_seconds", time.time() - start, result="acquired")
         return True
 
-    def recover(self):
-        """Recover the node's state after inactivity or crash."""
-        print(f"{self.node_name}: Starting recovery process.")
+    def _release_accounts(self, transaction_id):
+        """Release every account lock held by a transaction."""
+        for account in self.transactions[transaction_id].pop("locks", []):
+            holder = self.account_locks[account]
+            holder[1] -= 1
+            if holder[1] == 0:
+                del self.account_locks[account]
+        self.lock_released.notify_all()
+
+    def _finish_transaction(self, transaction_id, state):
+        """Move a transaction to its final state and free its locks and reserved funds."""
+        txn = self.transactions[transaction_id]
+        for account, amount in txn.pop("reserved", {}).items():
+            self.reserved[account] -= amount
+        txn["state"] = state
+        self._release_accounts(transaction_id)
+
+    def apply_outcomes(self, outcomes):
+        """Apply decisions the coordinator pushes for transactions whose phase 2 this node missed: {txn ID: outcome}."""
+        self._update_last_activity()  # Mark activity
+        self.trace.debug(f"Received {len(outcomes)} missed outcomes from coordinator.", phase="recovery")
+        for transaction_id, outcome in outcomes.items():
+            with self.lock:
+                state = self.transactions.get(transaction_id, {}).get("state")
+            if state is None and outcome == "ABORTED": # Not prepared yet: reject the prepare if it arrives
+                self._abort(transaction_id)
+            elif state is None: # Committed and already trimmed
+                self.trace.debug(f"Transaction {transaction_id} already finished.", txn=transaction_id, phase="recovery")
+            elif self._is_recovery_needed(state, outcome):
+                self._finalize_recovery(transaction_id, state, outcome)
+        self._sync()
+        return True
 
-        # Determine the transaction to recover
-        transaction_id, state = self._get_transaction_to_recover()
-        if not transaction_id:
-            print(f"{self.node_name}: No recovery needed. State is clean.")
-            return
+    def _start_recovery_thread(self):
+        """Start a background thread that resolves in-doubt transactions.
 
-        try:
-            # Query the coordinator for the transaction outcome
-            outcome = self.coordinator.handle_recovering_node(transaction_id, self.node_name)
-            print(f"{self.node_name}: Coordinator outcome for transaction {transaction_id}: {outcome}")
-            print(f"{self.node_name}: Current state: {state}")
+        Recovery runs once at startup for everything a restart left in doubt, then
+        whenever a prepared transaction has waited phase2_timeout seconds for its
+        phase 2, or when heartbeat finds the coordinator back and sets
+        recovery_requested.
+        """
+        def recovery_loop():
+            self.recover(overdue_only=False)
+            while self.server_running:
+                with self.lock:
+                    due = [txn["recover_at"] for txn in self.transactions.values() if txn["state"] == "PREPARED"]
+                delay = min(due) - self.clock.time() if due else self.phase2_timeout
+                self.recovery_requested.wait(max(delay, 0.05))
+                self.recovery_requested.clear()
+                if self.server_running:
+                    self.recover()
+
+        thread = threading.Thread(target=recovery_loop, daemon=True)
+        thread.start()
 
-            if self._is_recovery_needed(state, outcome):
+    def recover(self, overdue_only=True):
+        """Resolve in-doubt transactions with one bulk outcome query to the coordinator.
+
+        Transactions the coordinator is still deciding, or that cannot be resolved
+        because the coordinator is unreachable, are retried after phase2_timeout.
+        """
+        # Determine the transactions to recover
+        with self.lock:
+            to_recover = self._get_transactions_to_recover(self.clock.time() if overdue_only else None)
+        if any(state != "PREPARED" for _, state in to_recover):
+            # A finished transaction is checked by reporting it: once every participant
+            # acknowledged it the coordinator forgets it, and a query would presume an abort
+            to_recover = [(transaction_id, state) for transaction_id, state in to_recover if state == "PREPARED"]
+            self.report_outcomes()
+        if not to_recover or not self.coordinators:
+            return
+        self.trace.info(f"Starting recovery of {len(to_recover)} transactions.", phase="recovery")
+
+        outcomes = {}
+        for partition, transaction_ids in self._by_coordinator([transaction_id for transaction_id, _ in to_recover]).items():
+            try:
+                # Query each coordinator for all of its outcomes at once
+                outcomes.update(self.coordinators[partition].query_outcomes(transaction_ids, self.node_name))
+            except Exception as e:
+                self.trace.warning(f"Failed to contact coordinator: {e}. Retrying later.", phase="recovery")
+                self._postpone_recovery(transaction_ids)
+
+        for transaction_id, state in to_recover:
+            if transaction_id not in outcomes: # Postponed
+                continue
+            outcome = outcomes[transaction_id]
+            self.trace.debug(f"Coordinator outcome for transaction {transaction_id}: {outcome}", txn=transaction_id, phase="recovery")
+            self.trace.debug(f"Current state: {state}", txn=transaction_id, phase="recovery")
+            if outcome == "PENDING": # Phase 2 is still on its way
+                self._postpone_recovery([transaction_id])
+            elif self._is_recovery_needed(state, outcome):
                 self._finalize_recovery(transaction_id, state, outcome)
             else:
-                print(f"{self.node_name}: Transaction {transaction_id} already consistent. No recovery needed.")
-                self.log[transaction_id] = (outcome, True)  # Mark as verified
-
-        except Exception as e:
-            print(f"{self.node_name}: Failed to contact coordinator: {e}. Assuming abort.")
-            self.abort(transaction_id)
-
-    def _get_transaction_to_recover(self):
-        """Identify the transaction and state for recovery."""
-        if self.pending_transaction:
-            return self.pending_transaction[0], self.state
-        if self.prev_txn:
-            transaction_id = self.prev_txn
+                self.trace.debug(f"Transaction {transaction_id} already consistent. No recovery needed.", txn=transaction_id, phase="recovery")
+                with self.lock:
+                    self.log[transaction_id] = (outcome, True)  # Mark as verified
+
+    def _postpone_recovery(self, transaction_ids):
+        """Check these transactions again after phase2_timeout."""
+        with self.lock:
+            for transaction_id in transaction_ids:
+                txn = self.transactions.get(transaction_id)
+                if txn is not None and txn["state"] == "PREPARED":
+                    txn["recover_at"] = self.clock.time() + self.phase2_timeout
+
+    def _get_transactions_to_recover(self, now=None):
+        """Identify the in-doubt transactions and their states for recovery.
+
+        With now, only prepared transactions whose phase 2 is overdue are included.
+        Otherwise (at startup) the last finished transaction is checked as well;
+        later outcomes are verified by report_outcomes().
+        """
+        to_recover = [(txn_id, txn["state"]) for txn_id, txn in self.transactions.items() if txn["state"] == "PREPARED" and (now is None or txn["recover_at"] <= now)]
+        transaction_id = self.prev_txn
+        if now is None and transaction_id and self.transactions.get(transaction_id, {}).get("state") != "PREPARED":
             state, checked = self.log.get(transaction_id, (None, False))
             if checked:
-                print(f"{self.node_name}: Transaction {transaction_id} already verified. Skipping recovery.")
-                return None, None
-            return transaction_id, state
-        return None, None
+                self.trace.info(f"Transaction {transaction_id} already verified. Skipping recovery.", txn=transaction_id, phase="recovery")
+            else:
+                state = self.transactions.get(transaction_id, {}).get("state", state)
+                to_recover.append((transaction_id, state))
+        return to_recover
 
     def _is_recovery_needed(self, state, outcome):
         """Determine if recovery is needed based on state and outcome."""
         return state != outcome
 
     def _finalize_recovery(self, transaction_id, state, outcome):
-        """Resolve inconsistencies during recovery."""
+        """Resolve inconsistencies during recovery.
+
+        A commit is never undone. An ABORTED answer may be a presumed abort for
+        an outcome the coordinator has forgotten, or a late abort of a duplicate,
+        so it is logged as a conflict and ignored.
+        """
         if state == "PREPARED":
             if outcome == "COMMITTED":
-                print(f"{self.node_name}: Commit confirmed. Finalizing transaction.")
+                self.trace.debug("Commit confirmed. Finalizing transaction.", txn=transaction_id, phase="recovery")
                 self.commit(transaction_id)
             elif outcome == "ABORTED":
-                print(f"{self.node_name}: Abort confirmed. Rolling back transaction.")
+                self.trace.info("Abort confirmed. Rolling back transaction.", txn=transaction_id, phase="recovery")
                 self.abort(transaction_id)
         elif state == "COMMITTED" and outcome == "ABORTED":
-            print(f"{self.node_name}: Coordinator indicates abort. Rolling back transaction.")
-            self.roll_back_state(transaction_id)
+            self.trace.warning(f"Coordinator reports abort of committed transaction {transaction_id}. Keeping the commit.", txn=transaction_id, phase="recovery")
+            self.metrics.inc("kl_outcome_conflicts_total")
+            outcome = state
         elif state == "ABORTED":
-            print(f"{self.node_name}: Transaction already aborted. No recovery needed.")
+            self.trace.debug("Transaction already aborted. No recovery needed.", txn=transaction_id, phase="recovery")
         else:
-            print(f"{self.node_name}: Unexpected state {state}. Assuming abort for safety.")
+            self.trace.warning(f"Unexpected state {state}. Assuming abort for safety.", txn=transaction_id, phase="recovery")
             self.abort(transaction_id)
 
-        # Mark the transaction as verified
-        self.log[transaction_id] = (outcome, True)
+        # Mark the transaction as verified, under the state it actually reached
+        with self.lock:
+            state = self.transactions.get(transaction_id, {}).get("state")
+            if state in ("COMMITTED", "ABORTED"):
+                self.log[transaction_id] = (state, True)
 
     def shutdown(self):
         """Stop the server gracefully."""
-        print(f"{self.node_name}: Remote shutdown requested.")
+        self.trace.info("Remote shutdown requested.")
         self.server_running = False
-        print(f"{self.node_name}: Server stopping gracefully.")
+        self.recovery_requested.set() # Ends the recovery loop
+        self.checkpoint()
+        self.trace.info("Server stopping gracefully.")
         return "Shutdown initiated"
 
     def run_server(self):
-        """Run the XML-RPC server."""
+        """Run the RPC server."""
         def server_thread():
-            with SimpleXMLRPCServer((self.host, self.port), allow_none=True) as server:
+            with make_server((self.host, self.port), self.protocol, max_workers=self.max_workers, metrics=self.metrics) as server:
                 server.register_instance(self)  # Expose all methods in this class
-                server.logRequests = False
-                print(f"{self.node_name} started on port {self.port} and waiting for requests...")
+                self.trace.info(f"Started on port {self.port} ({self.protocol}) with {self.max_workers} workers and waiting for requests...")
 
                 while self.server_running:
-                    server.handle_request()  # Process one request at a time
+                    server.handle_request()  # Hand each request to a worker thread
 
-                print(f"{self.node_name}: Server has stopped.")
+                self.trace.info("Server has stopped.")
 
         thread = threading.Thread(target=server_thread, daemon=True)
         thread.start()
@@ -281,5 +915,5 @@ class NodeBase:
             while self.server_running:
                 time.sleep(1)
         except KeyboardInterrupt:
-            print(f"\n{self.node_name}: Shutdown signal received. Exiting...")
+            self.trace.info("Shutdown signal received. Exiting...")
             self.shutdown()
@@ -0,0 +1,142 @@
+from collections import OrderedDict
+import threading
+import time
+
+class OutcomeStore:
+    """Bounded store of transaction outcomes kept by the coordinator for recovery.
+
+    Each outcome remembers the participants that have not yet acknowledged it.
+    Once every one of them has, no node can ask about the transaction again and
+    the entry is dropped. Entries are kept in decision order, so the oldest
+    unacknowledged decision is the low-watermark.
+
+    An unacknowledged outcome is never evicted: a node that asked about it
+    later would get the presumed-abort answer, and a lagging participant would
+    abort or keep a transaction the others decided otherwise. Only entries no
+    node waits for are evicted past max_age seconds or max_entries. When
+    unacknowledged entries exceed those limits, a warning names the nodes
+    holding them back.
+    """
+
+    def __init__(self, max_entries=100000, max_age=24 * 3600, trace=None):
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.trace = trace # Tracer for the limit warning; None stays quiet
+        self.lock = threading.Lock()
+        self.entries = OrderedDict() # {txn ID: [outcome, decided at, set of nodes yet to acknowledge, sequence]}
+        self.next_seq = 1 # Sequence number of the next decision
+        self.acknowledged = 0 # Entries dropped because every node acknowledged them
+        self.evicted_age = 0 # Entries dropped by age
+        self.evicted_size = 0 # Entries dropped because the store was full
+        self.over_limit = False # Unacknowledged entries exceed max_entries or max_age
+
+    def record(self, transaction_id, outcome, nodes, decided_at=None):
+        """Store an outcome that nodes must acknowledge."""
+        with self.lock:
+            self.entries.pop(transaction_id, None) # A replaced decision moves to the end
+            self.entries[transaction_id] = [outcome, decided_at or time.time(), set(nodes), self.next_seq]
+            self.next_seq += 1
+            warning = self._evict(time.time())
+        if warning and self.trace:
+            self.trace.warning(warning, phase="recovery")
+
+    def get(self, transaction_id, default=None):
+        """Return the outcome of a transaction, or default if none is stored."""
+        with self.lock:
+            entry = self.entries.get(transaction_id)
+        return entry[0] if entry else default
+
+    def acknowledge(self, node, outcomes):
+        """Record that node knows the outcomes {txn ID: outcome}.
+
+        Returns {txn ID: outcome} for the transactions whose stored outcome differs
+        from the node's; those stay unacknowledged until the node corrects itself.
+        Transactions with no stored outcome are presumed aborted and not reported.
+        """
+        corrections = {}
+        with self.lock:
+            for transaction_id, outcome in outcomes.items():
+                entry = self.entries.get(transaction_id)
+                if entry is None:
+                    continue
+                if entry[0] != outcome:
+                    corrections[transaction_id] = entry[0]
+                    continue
+                entry[2].discard(node)
+                if not entry[2]:
+                    del self.entries[transaction_id]
+                    self.acknowledged += 1
+        return corrections
+
+    def unacknowledged(self, outcome):
+        """Return {node: [txn ID]} of the stored outcomes equal to outcome that node has not acknowledged."""
+        pending = {}
+        with self.lock:
+            for transaction_id, entry in self.entries.items():
+                if entry[0] == outcome:
+                    for node in entry[2]:
+                        pending.setdefault(node, []).append(transaction_id)
+        return pending
+
+    def evict(self):
+        """Drop entries no node waits for past their age or beyond the size limit."""
+        with self.lock:
+            warning = self._evict(time.time())
+        if warning and self.trace:
+            self.trace.warning(warning, phase="recovery")
+
+    def _evict(self, now):
+        """Evict from the oldest entry until one is within the limits or still unacknowledged.
+
+        Returns a warning the first time unacknowledged entries exceed the limits.
+        Caller holds self.lock.
+        """
+        while self.entries:
+            transaction_id, entry = next(iter(self.entries.items()))
+            expired = now - entry[1] > self.max_age
+            if entry[2] or not (expired or len(self.entries) > self.max_entries):
+                break
+            if expired:
+                self.evicted_age += 1
+            else:
+                self.evicted_size += 1
+            del self.entries[transaction_id]
+        oldest = next(iter(self.entries.items()), None)
+        over_limit = oldest is not None and (now - oldest[1][1] > self.max_age or len(self.entries) > self.max_entries)
+        warning = None
+        if over_limit and not self.over_limit:
+            warning = f"Keeping {len(self.entries)} outcomes past the limits until {sorted(oldest[1][2])} acknowledge {oldest[0]}."
+        self.over_limit = over_limit
+        return warning
+
+    def snapshot(self):
+        """Return the entries in a form that can be checkpointed as JSON."""
+        with self.lock:
+            return {txn_id: [outcome, decided_at, sorted(nodes)] for txn_id, (outcome, decided_at, nodes, _) in self.entries.items()}
+
+    def restore(self, entries):
+        """Replace the entries with a snapshot()."""
+        with self.lock:
+            self.entries.clear()
+        for transaction_id, (outcome, decided_at, nodes) in entries.items():
+            self.record(transaction_id, outcome, nodes, decided_at)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def stats(self):
+        """Return the retained-entry metrics."""
+        with self.lock:
+            oldest = next(iter(self.entries.values()), None)
+            return {
+                "retained": len(self.entries),
+                "unacknowledged": sum(1 for entry in self.entries.values() if entry[2]),
+                "low_watermark": oldest[3] if oldest else self.next_seq, # Sequence of the oldest retained decision
+                "oldest_age": round(time.time() - oldest[1], 3) if oldest else 0,
+                "acknowledged": self.acknowledged,
+                "evicted_age": self.evicted_age,
+                "evicted_size": self.evicted_size,
+                "over_limit": self.over_limit,
+                "max_entries": self.max_entries,
+                "max_age": self.max_age,
+            }
@@ -0,0 +1,97 @@
+from concurrent.futures import ThreadPoolExecutor
+from KL_rpc_server import make_proxy
+import bisect
+import hashlib
+import time
+
+def _hash(key):
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+class HashRing:
+    """Consistent-hash ring that maps account IDs to participant nodes.
+
+    Every node is placed on the ring at vnodes pseudo-random points, and an account
+    belongs to the first node point at or after the account's hash. Adding a node
+    therefore moves only the accounts that fall just before its points, about
+    1/N of the keyspace. pins places individual accounts on a fixed node.
+    """
+
+    def __init__(self, nodes=(), vnodes=64, pins=None):
+        self.vnodes = vnodes
+        self.pins = dict(pins or {}) # Accounts with a fixed node: {account: node}
+        self.nodes = set()
+        self.points = [] # Sorted hashes of every virtual node
+        self.owners = {} # Hash -> node name
+        for node in nodes:
+            self.add_node(node)
+
+    def add_node(self, node):
+        """Place a node on the ring."""
+        self.nodes.add(node)
+        for i in range(self.vnodes):
+            point = _hash(f"{node}#{i}")
+            self.owners[point] = node
+            bisect.insort(self.points, point)
+
+    def remove_node(self, node):
+        """Take a node off the ring."""
+        self.nodes.discard(node)
+        for i in range(self.vnodes):
+            point = _hash(f"{node}#{i}")
+            if self.owners.pop(point, None) is not None:
+                self.points.remove(point)
+
+    def node_for(self, account):
+        """Return the node that owns an account."""
+        if account in self.pins:
+            return self.pins[account]
+        if not self.points:
+            return None
+        index = bisect.bisect_left(self.points, _hash(account)) % len(self.points)
+        return self.owners[self.points[index]]
+
+    def group_by_node(self, legs):
+        """Split {account: amount} legs into {node: {account: amount}}."""
+        grouped = {}
+        for account, amount in legs.items():
+            grouped.setdefault(self.node_for(account), {})[account] = amount
+        return grouped
+
+def partition_for(transaction_id, partitions):
+    """Return the coordinator partition that owns a transaction ID."""
+    return _hash(transaction_id) % partitions
+
+class CoordinatorRouter:
+    """Client-side proxy for coordinators that each own a partition of the transaction IDs.
+
+    Transactions go to the coordinator of their ID, and a batch is split by
+    partition and run on every coordinator at once. Other calls go to the
+    first coordinator. Each endpoint may be a list of a primary and its
+    standbys.
+    """
+
+    def __init__(self, endpoints, max_size=8):
+        self.coordinators = [make_proxy(endpoint, max_size) for endpoint in endpoints]
+        self.executor = ThreadPoolExecutor(max_workers=len(self.coordinators), thread_name_prefix="router")
+
+    def coordinator_for(self, transaction_id):
+        return self.coordinators[partition_for(transaction_id, len(self.coordinators))]
+
+    def execute_transaction(self, transaction_id, transactions, timeout=5, deadline=None):
+        return self.coordinator_for(transaction_id).execute_transaction(transaction_id, transactions, timeout, deadline or time.time() + timeout)
+
+    def execute_batch(self, transactions, timeout=5, deadline=None):
+        deadline = deadline or time.time() + timeout # One deadline for every partition's share
+        batches = {}
+        for transaction_id, legs in transactions:
+            batches.setdefault(partition_for(transaction_id, len(self.coordinators)), []).append([transaction_id, legs])
+        futures = [self.executor.submit(self.coordinators[partition].execute_batch, batch, timeout, deadline) for partition, batch in batches.items()]
+        results = {}
+        for future in futures:
+            results.update(future.result())
+        return results
+
+    def __getattr__(self, method):
+        if method.startswith("__"):
+            raise AttributeError(method)
+        return getattr(self.coordinators[0], method)
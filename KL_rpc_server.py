@@ -0,0 +1,296 @@
+from xmlrpc.server import SimpleXMLRPCServer, SimpleXMLRPCRequestHandler
+from xmlrpc.client import ServerProxy, Fault
+from KL_binary_rpc import BinaryRPCServer, BinaryProxy
+import threading
+import time
+
+class KeepAliveRequestHandler(SimpleXMLRPCRequestHandler):
+    """Request handler that keeps the HTTP connection open between requests."""
+    protocol_version = "HTTP/1.1"
+    timeout = 5  # Close connections idle this long so they stop holding a thread
+    disable_nagle_algorithm = True
+    wbufsize = -1  # Send headers and body of a reply in one segment
+
+    def do_POST(self):
+        """Run one XML-RPC request once a worker slot is free."""
+        queued_at = time.perf_counter()
+        with self.server.slots: # Bounds the requests in flight, not the open connections
+            if self.server.metrics:
+                self.server.metrics.observe("kl_rpc_queue_wait_seconds", time.perf_counter() - queued_at)
+            super().do_POST()
+
+    def log_error(self, format, *args):
+        if not format.startswith("Request timed out"): # An idle keep-alive connection closing
+            super().log_error(format, *args)
+
+    def do_GET(self):
+        """Serve GET /metrics in the Prometheus text format."""
+        if self.path != "/metrics" or self.server.metrics is None:
+            self.report_404()
+            return
+        body = self.server.metrics.prometheus_text().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+class PooledXMLRPCServer(SimpleXMLRPCServer):
+    """XML-RPC server that runs at most max_workers requests at once.
+
+    Each connection is read on its own thread, like the binary server, and a
+    request takes one of max_workers slots only while it runs. An idle
+    keep-alive connection then never holds a slot, and accepting never waits
+    for one, however many pooled connections the clients keep open.
+    """
+    request_queue_size = 128  # Listen backlog
+    daemon_threads = True
+
+    def __init__(self, addr, max_workers=16, metrics=None):
+        super().__init__(addr, requestHandler=KeepAliveRequestHandler, allow_none=True, logRequests=False)
+        self.metrics = metrics # Records the time requests wait for a worker slot
+        self.max_workers = max_workers
+        self.slots = threading.BoundedSemaphore(max_workers)  # Free worker slots
+
+    def process_request(self, request, client_address):
+        """Serve the connection on a background thread."""
+        threading.Thread(target=self._serve_connection, args=(request, client_address), daemon=True).start()
+
+    def _serve_connection(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+LOCAL_SERVERS = {} # Servers of local:// endpoints in this process: {"host:port": LocalServer}
+
+class LocalServer:
+    """In-process server for local://host:port endpoints, with no sockets and no serialization.
+
+    A LocalProxy call runs the method on the caller's thread, after waiting for
+    one of max_workers slots like a request on the other servers. Arguments and
+    replies are passed by reference, so neither side may change them after the
+    call, and errors are raised as Fault. Mirrors the parts of
+    SimpleXMLRPCServer the nodes use.
+    """
+
+    def __init__(self, addr, max_workers=16, metrics=None):
+        self.name = f"{addr[0]}:{addr[1]}"
+        if self.name in LOCAL_SERVERS:
+            raise OSError(f"local://{self.name} is already served")
+        self.metrics = metrics # Records the time calls wait for a slot
+        self.timeout = None # Seconds handle_request() waits
+        self.instance = None
+        self.max_workers = max_workers
+        self.slots = threading.BoundedSemaphore(max_workers) # Free worker slots
+        self.closed = threading.Event()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.server_close()
+
+    def register_instance(self, instance):
+        self.instance = instance
+        LOCAL_SERVERS[self.name] = self
+
+    def handle_request(self):
+        """Calls run on their callers' threads, so there is nothing to accept: wait up to timeout."""
+        self.closed.wait(self.timeout)
+
+    def call(self, method, args):
+        queued_at = time.perf_counter()
+        with self.slots:
+            if self.metrics:
+                self.metrics.observe("kl_rpc_queue_wait_seconds", time.perf_counter() - queued_at)
+            try:
+                if method.startswith("_"):
+                    raise AttributeError(f"Method {method} is not supported")
+                return getattr(self.instance, method)(*args)
+            except Exception as e:
+                raise Fault(1, f"{type(e).__name__}: {e}")
+
+    def server_close(self):
+        if LOCAL_SERVERS.get(self.name) is self:
+            del LOCAL_SERVERS[self.name]
+        self.closed.set()
+
+class LocalProxy:
+    """Proxy for a local://host:port endpoint served in this process.
+
+    Calling an endpoint nobody serves raises ConnectionRefusedError, like a
+    closed port.
+    """
+
+    def __init__(self, endpoint, max_size=8):
+        self.endpoint = endpoint
+        self.name = endpoint[len("local://"):]
+        self.pool = self # Has the stats() of a connection pool
+        self.calls = 0
+
+    def call(self, method, *args):
+        server = LOCAL_SERVERS.get(self.name)
+        if server is None:
+            raise ConnectionRefusedError(f"Nothing serves {self.endpoint}")
+        self.calls += 1
+        return server.call(method, args)
+
+    def stats(self):
+        return {"endpoint": self.endpoint, "calls": self.calls}
+
+    def __getattr__(self, method):
+        if method.startswith("__"):
+            raise AttributeError(method)
+        return lambda *args: self.call(method, *args)
+
+class ConnectionPool:
+    """Bounded pool of keep-alive XML-RPC connections to one endpoint.
+
+    Each pooled ServerProxy keeps its HTTP connection open between calls and is
+    used by one thread at a time. When every connection is busy and the pool is
+    full, callers wait for one to be returned. A connection that fails is
+    discarded and replaced by a new one on the next call.
+    """
+
+    def __init__(self, endpoint, max_size=8):
+        self.endpoint = endpoint
+        self.max_size = max_size
+        self.cond = threading.Condition()
+        self.idle = [] # Connections ready for use, most recently used last
+        self.size = 0 # Open connections, idle or in use
+        self.calls = 0 # Calls made through the pool
+        self.waits = 0 # Calls that waited for a free connection
+        self.reconnects = 0 # Connections replaced after a failure
+        self.broken = 0 # Failed connections not yet replaced
+
+    def _acquire(self):
+        with self.cond:
+            self.calls += 1
+            if not self.idle and self.size >= self.max_size:
+                self.waits += 1
+                while not self.idle and self.size >= self.max_size:
+                    self.cond.wait()
+            if self.idle:
+                return self.idle.pop()
+            self.size += 1
+            if self.broken:
+                self.broken -= 1
+                self.reconnects += 1
+        return ServerProxy(self.endpoint, allow_none=True)
+
+    def _release(self, proxy, broken=False):
+        with self.cond:
+            if broken:
+                self.size -= 1
+                self.broken += 1
+            else:
+                self.idle.append(proxy)
+            self.cond.notify()
+        if broken:
+            proxy("close")()
+
+    def call(self, method, *args):
+        """Call a remote method on a pooled connection."""
+        proxy = self._acquire()
+        try:
+            result = getattr(proxy, method)(*args)
+        except Fault: # The server raised; the connection itself is fine
+            self._release(proxy)
+            raise
+        except Exception:
+            self._release(proxy, broken=True)
+            raise
+        self._release(proxy)
+        return result
+
+    def stats(self):
+        """Return the pool counters."""
+        with self.cond:
+            return {
+                "endpoint": self.endpoint,
+                "size": self.size,
+                "idle": len(self.idle),
+                "in_use": self.size - len(self.idle),
+                "max_size": self.max_size,
+                "calls": self.calls,
+                "waits": self.waits,
+                "reconnects": self.reconnects,
+            }
+
+class PooledProxy:
+    """Drop-in replacement for ServerProxy that is safe to share between threads.
+
+    proxy.method(*args) runs the call on a connection from the endpoint's pool.
+    """
+
+    def __init__(self, endpoint, max_size=8):
+        self.pool = ConnectionPool(endpoint, max_size)
+
+    def __getattr__(self, method):
+        if method.startswith("__"):
+            raise AttributeError(method)
+        return lambda *args: self.pool.call(method, *args)
+
+class FailoverProxy:
+    """Proxy for a primary endpoint and its standbys, of which one serves at a time.
+
+    Calls go to the endpoint that last answered. When it refuses the connection
+    the next one is tried, so a request is only resent if it never arrived.
+    Other errors are raised: the call may have run before the endpoint failed.
+    """
+
+    def __init__(self, endpoints, max_size=8):
+        self.proxies = [make_proxy(endpoint, max_size) for endpoint in endpoints]
+        self.current = 0 # Index of the endpoint that last answered
+
+    @property
+    def pool(self):
+        return self.proxies[self.current].pool
+
+    def call(self, method, *args):
+        start = self.current
+        for offset in range(len(self.proxies)):
+            index = (start + offset) % len(self.proxies)
+            try:
+                result = getattr(self.proxies[index], method)(*args)
+            except ConnectionRefusedError:
+                if offset == len(self.proxies) - 1:
+                    raise
+                continue
+            self.current = index
+            return result
+
+    def __getattr__(self, method):
+        if method.startswith("__"):
+            raise AttributeError(method)
+        return lambda *args: self.call(method, *args)
+
+def make_proxy(endpoint, max_size=8):
+    """Return a thread-safe proxy for an endpoint, choosing the transport by URL scheme.
+
+    tcp://host:port uses the binary protocol; http:// endpoints use XML-RPC;
+    local://host:port calls a server in this process. A list of endpoints is a
+    primary with its standbys (see FailoverProxy).
+    """
+    if isinstance(endpoint, list):
+        return FailoverProxy(endpoint, max_size)
+    if endpoint.startswith("local://"):
+        return LocalProxy(endpoint, max_size)
+    if endpoint.startswith("tcp://"):
+        return BinaryProxy(endpoint, max_size)
+    return PooledProxy(endpoint, max_size)
+
+SCHEMES = {"xmlrpc": "http", "binary": "tcp", "local": "local"} # Endpoint URL scheme of each protocol
+
+def make_server(addr, protocol="xmlrpc", max_workers=16, metrics=None):
+    """Return an RPC server for protocol: "xmlrpc" (default), "binary" or "local"."""
+    if protocol == "local":
+        return LocalServer(addr, max_workers=max_workers, metrics=metrics)
+    if protocol == "binary":
+        return BinaryRPCServer(addr, max_workers=max_workers, metrics=metrics)
+    if protocol == "xmlrpc":
+        return PooledXMLRPCServer(addr, max_workers=max_workers, metrics=metrics)
+    raise ValueError(f"Unknown RPC protocol {protocol!r}")
@@ -0,0 +1,114 @@
+from collections import deque
+from contextlib import contextmanager
+import threading
+import time
+
+class _Ticket:
+    __slots__ = ("name", "accounts", "blocked_on", "ready", "queued_at")
+
+    def __init__(self, name, accounts):
+        self.name = name
+        self.accounts = accounts
+        self.blocked_on = 0 # Account queues where an earlier ticket is ahead of this one
+        self.ready = threading.Event()
+        self.queued_at = time.time()
+
+class ConflictScheduler:
+    """Orders transactions that touch the same accounts before they reach the participants.
+
+    Every account a transaction writes has a FIFO queue. A transaction joins the
+    queue of each of its accounts at once, under one lock, so all queues agree
+    on the arrival order; it runs when it heads every one of them. Transactions
+    with disjoint accounts run in parallel, conflicting ones run one after the
+    other in arrival order, and since no transaction ever waits while holding
+    part of its accounts, there are no deadlocks.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queues = {} # {account: deque of tickets}; the head is running or about to
+        self.running = 0
+        self.waiting = 0
+        self.admitted = 0 # Transactions that ran
+        self.conflicts = 0 # Transactions that had to wait for an earlier one
+        self.timeouts = 0 # Transactions that gave up waiting
+        self.max_queue_depth = 0
+        self.wait_time = 0.0 # Total seconds spent waiting
+
+    @contextmanager
+    def schedule(self, name, accounts, timeout=None):
+        """Wait until no earlier transaction on accounts is running, then run the with body.
+
+        Yields True once the transaction may run, or False if it waited longer
+        than timeout seconds; the accounts are released when the body ends.
+        """
+        ticket = self._enqueue(name, sorted(set(accounts)))
+        if not ticket.ready.wait(timeout):
+            with self.lock:
+                timed_out = not ticket.ready.is_set() # Not released while we were timing out
+                if timed_out:
+                    self._remove(ticket)
+                    self.waiting -= 1
+                    self.timeouts += 1
+            if timed_out:
+                yield False
+                return
+        with self.lock:
+            self.waiting -= 1
+            self.running += 1
+            self.admitted += 1
+            self.wait_time += time.time() - ticket.queued_at
+        try:
+            yield True
+        finally:
+            with self.lock:
+                self.running -= 1
+                self._remove(ticket)
+
+    def _enqueue(self, name, accounts):
+        ticket = _Ticket(name, accounts)
+        with self.lock:
+            for account in accounts:
+                queue = self.queues.setdefault(account, deque())
+                if queue:
+                    ticket.blocked_on += 1
+                queue.append(ticket)
+                self.max_queue_depth = max(self.max_queue_depth, len(queue))
+            self.waiting += 1
+            if ticket.blocked_on:
+                self.conflicts += 1
+            else:
+                ticket.ready.set()
+        return ticket
+
+    def _remove(self, ticket):
+        """Take a ticket out of its queues and wake the tickets that now head all of theirs. Caller holds self.lock."""
+        for account in ticket.accounts:
+            queue = self.queues[account]
+            if queue[0] is ticket:
+                queue.popleft()
+                if queue:
+                    successor = queue[0]
+                    successor.blocked_on -= 1
+                    if not successor.blocked_on:
+                        successor.ready.set()
+            else:
+                queue.remove(ticket)
+            if not queue:
+                del self.queues[account]
+
+    def stats(self, hot=5):
+        """Return the queue depth and conflict counters, with the most contended accounts."""
+        with self.lock:
+            depths = sorted(((len(queue), account) for account, queue in self.queues.items()), reverse=True)
+            return {
+                "running": self.running,
+                "waiting": self.waiting,
+                "admitted": self.admitted,
+                "conflicts": self.conflicts,
+                "conflict_rate": round(self.conflicts / max(self.admitted + self.timeouts, 1), 4),
+                "timeouts": self.timeouts,
+                "mean_wait_ms": round(self.wait_time / max(self.admitted, 1) * 1000, 3),
+                "max_queue_depth": self.max_queue_depth,
+                "hot_accounts": {account: depth for depth, account in depths[:hot] if depth > 1},
+            }
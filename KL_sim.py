@@ -0,0 +1,477 @@
+from concurrent.futures import Future
+from xmlrpc.client import Fault
+from KL_clock import VirtualClock
+from KL_rpc_server import LOCAL_SERVERS, LocalProxy
+from KL_account_store import from_cents
+from KL_admission import UNKNOWN
+import argparse
+import hashlib
+import itertools
+import os
+import random
+import re
+import shutil
+import tempfile
+import time
+
+# The lab cluster: account -> (node, initial balance)
+LAB_ACCOUNTS = {"A": ("Node-2", 200), "B": ("Node-3", 300)}
+
+# Call faults, armed for the next call of a method on a member
+FAULTS = (
+    "crash", # The callee crashes before handling the call
+    "crash_after", # The callee handles the call, then crashes before replying
+    "crash_caller", # The caller crashes just before sending the call
+    "crash_caller_after", # The callee handles the call, then the caller crashes before reading the reply
+    "drop_request", # The call is lost: the caller times out
+    "drop_reply", # The callee handles the call, but the reply is lost
+    "delay", # The caller times out now; the callee gets the call at the next tick
+)
+FAULT_METHODS = ("prepare_legs", "commit", "commit_one_phase", "abort", "apply_outcomes", "query_outcomes", "acknowledge_outcomes")
+
+class _SimEndpoint:
+    """local:// server for the calls of one member generation to another member, routed through the simulation."""
+
+    def __init__(self, sim, caller, generation, callee):
+        self.sim = sim
+        self.caller = caller
+        self.generation = generation
+        self.callee = callee
+
+    def call(self, method, args):
+        return self.sim.deliver(self, method, args)
+
+class _SimFuture(Future):
+    """Future that hashes by submission order, so as_completed() yields finished calls in the same order every run."""
+
+    def __init__(self, seq):
+        super().__init__()
+        self.seq = seq
+
+    def __hash__(self):
+        return self.seq
+
+class _InlineExecutor:
+    """Runs submitted calls at once on the caller's thread, so a fan-out reaches the participants in a fixed order."""
+
+    def __init__(self):
+        self.seq = itertools.count()
+
+    def submit(self, fn, *args):
+        future = _SimFuture(next(self.seq))
+        try:
+            future.set_result(fn(*args))
+        except BaseException as e:
+            future.set_exception(e)
+        return future
+
+    def shutdown(self, wait=True):
+        pass
+
+class Simulation:
+    """Deterministic 2PC cluster on a virtual clock, for replaying failures.
+
+    The coordinator and the participants run in this process with no background
+    threads: step() advances the VirtualClock by one tick and runs their
+    heartbeats, pushes, recovery and inactivity checks itself, and every RPC
+    goes through deliver(), where armed faults, partitions and crashes apply.
+    Nothing sleeps, so a timeout costs a tick instead of seconds, and a seed
+    replays the same schedule, faults and outcomes every time.
+
+        sim = Simulation()
+        sim.arm("Node-2", "prepare_legs", "drop_reply")
+        sim.transfer("A", "B", 10)
+        sim.settle()
+        assert not sim.check()
+
+    A crashed member loses its memory and is rebuilt from its files after
+    down_for virtual seconds; a node that shuts itself down because no
+    coordinator answers counts as crashed too.
+    """
+
+    ids = itertools.count(1)
+
+    def __init__(self, accounts=None, seed=0, tick=0.2, phase2_timeout=5, restart_delay=1.0, log_level="WARNING", workdir=None):
+        self.name = f"sim-{next(self.ids)}" # Prefix of this simulation's endpoints in LOCAL_SERVERS
+        self.accounts = dict(accounts or LAB_ACCOUNTS)
+        self.seed = seed
+        self.rng = random.Random(seed) # Used on the driving thread only
+        self.clock = VirtualClock()
+        self.start = self.clock.time()
+        self.tick = tick # Virtual seconds per step; also the heartbeat and push interval
+        self.phase2_timeout = phase2_timeout
+        self.restart_delay = restart_delay # Virtual seconds before a node that shut itself down is restarted
+        self.log_level = log_level
+        self.workdir = workdir or tempfile.mkdtemp(prefix="kl_sim_", dir="/dev/shm" if os.path.isdir("/dev/shm") else None)
+        self.scratch = workdir is None # Removed on close
+        self.nodes = sorted({node for node, _ in self.accounts.values()})
+        self.members = {} # Running members: {name: Coordinator or NodeBase}
+        self.generations = {} # Incremented on every crash, so a crashed member's calls fail: {name: int}
+        self.restarts = {} # Crashed members: {name: virtual time of the restart}
+        self.crashed = [] # Crashed members not yet discarded
+        self.faults = {} # Armed faults: {(callee, method): [kind]}
+        self.partitions = {} # Nodes cut off from the coordinator: {node: virtual time the partition heals}
+        self.late = [] # Delayed calls, delivered at the next tick: [(endpoint, method, args)]
+        self.wal_images = {} # The coordinator's log as it was on disk when it crashed
+        self.results = {} # Client outcomes: {txn ID: "COMMITTED", "ABORTED" or "FAILED"}
+        self.history = [] # What the simulation did: [(virtual seconds since the start, event)]
+        self.retired = [] # Tracers of crashed members, for explain()
+        self.ticks = 0
+        self.stats = {"transactions": 0, "committed": 0, "aborted": 0, "failed": 0, "faults": 0, "crashes": 0, "partitions": 0}
+        self.txn_ids = itertools.count(1)
+        self.client = LocalProxy(self._endpoint("client", "coordinator"))
+        for name in self.nodes:
+            self._start(name)
+        for account, (node, balance) in self.accounts.items():
+            self.members[node].initialize_account(balance, account)
+        self._start("coordinator")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _endpoint(self, caller, callee):
+        """Register an endpoint for caller's current generation and return its local:// URL."""
+        generation = self.generations.get(caller, 0)
+        name = f"{self.name}/{caller}.{generation}/{callee}"
+        LOCAL_SERVERS[name] = _SimEndpoint(self, caller, generation, callee)
+        return f"local://{name}"
+
+    def _start(self, name):
+        """Build a member from its files, as a restart would."""
+        from KL_node1 import Coordinator
+        from KL_node_base import NodeBase
+        if name == "coordinator":
+            path = os.path.join(self.workdir, "coordinator.wal")
+            if name in self.wal_images: # Writes the crashed coordinator made afterwards never happened
+                with open(path, "wb") as f:
+                    f.write(self.wal_images.pop(name))
+            member = Coordinator({node: self._endpoint(name, node) for node in self.nodes}, log_file=path,
+                                 pins={account: node for account, (node, _) in self.accounts.items()},
+                                 heartbeat_interval=self.tick, push_interval=self.tick, log_level=self.log_level,
+                                 inactivity_threshold=None, clock=self.clock, background=False)
+            member.executor.shutdown()
+            member.executor = _InlineExecutor()
+        else:
+            account = next(account for account, (node, _) in self.accounts.items() if node == name)
+            member = NodeBase(os.path.join(self.workdir, f"account_{name}.db"), self.accounts[account][1], name, 0, account=account,
+                              coordinator_endpoint=self._endpoint(name, "coordinator"), protocol="local", phase2_timeout=self.phase2_timeout,
+                              log_level=self.log_level, clock=self.clock, background=False)
+            member.lock_timeout = 0 # Nothing else runs while a prepare waits, so a locked account stays locked
+        self.members[name] = member
+        return member
+
+    def crash(self, name, down_for=None):
+        """Crash a member now; it restarts down_for virtual seconds later (restart_delay by default)."""
+        if name not in self.members:
+            return
+        member = self.members.pop(name)
+        self.generations[name] = self.generations.get(name, 0) + 1
+        self.restarts[name] = self.clock.time() + (self.restart_delay if down_for is None else down_for)
+        self.stats["crashes"] += 1
+        self._note(f"{name} crashed")
+        if name == "coordinator": # A crash can interrupt it mid-transaction; keep the log it had on disk
+            with open(member.wal.path, "rb") as f:
+                self.wal_images[name] = f.read()
+        self.crashed.append(member)
+
+    def _discard_crashed(self):
+        """Release the files of crashed members once the calls they were making have returned.
+
+        As in a kill -9, log records not yet synced are lost and the account
+        store is not flushed: only what already reached the files survives.
+        """
+        while self.crashed:
+            member = self.crashed.pop()
+            member.wal.close(sync=False)
+            if hasattr(member, "shutdown_event"):
+                member.shutdown_event.set()
+                member.log_owner.close()
+            else:
+                member.server_running = False
+                member.store.close(flush=False)
+            member.trace.close()
+            self.retired.append(member.trace)
+
+    def _note(self, event):
+        self.history.append((round(self.clock.time() - self.start, 3), event))
+
+    def _restart(self, name):
+        self._note(f"{name} restarted")
+        member = self._start(name)
+        if name != "coordinator":
+            member.recover(overdue_only=False) # What the recovery thread does on startup
+
+    def arm(self, callee, method, kind):
+        """Inject fault kind (see FAULTS) into the next call of method on callee."""
+        if kind not in FAULTS:
+            raise ValueError(f"Unknown fault {kind!r}")
+        self.faults.setdefault((callee, method), []).append(kind)
+        self.stats["faults"] += 1
+        self._note(f"Armed {kind} on {callee}.{method}")
+
+    def partition(self, node, duration):
+        """Cut node off from the coordinator, both ways, for duration virtual seconds."""
+        self.partitions[node] = max(self.partitions.get(node, 0), self.clock.time() + duration)
+        self.stats["partitions"] += 1
+        self._note(f"{node} cut off from the coordinator for {duration:.1f}s")
+
+    def _cut_off(self, caller, callee):
+        node = caller if callee == "coordinator" else callee if caller == "coordinator" else None
+        return self.partitions.get(node, 0) > self.clock.time()
+
+    def deliver(self, endpoint, method, args):
+        """Carry one RPC from endpoint.caller to endpoint.callee, applying faults."""
+        caller, callee = endpoint.caller, endpoint.callee
+        if self.generations.get(caller, 0) != endpoint.generation:
+            raise ConnectionRefusedError(f"{caller} crashed")
+        if callee not in self.members:
+            raise ConnectionRefusedError(f"{callee} is down")
+        if self._cut_off(caller, callee):
+            raise TimeoutError(f"{caller} cannot reach {callee}")
+        kinds = self.faults.get((callee, method))
+        kind = kinds.pop(0) if kinds else None
+        if kind:
+            self._note(f"{kind}: {caller} -> {callee}.{method}{tuple(args)[:1]}")
+        if kind == "crash":
+            self.crash(callee)
+            raise ConnectionResetError(f"{callee} crashed")
+        if kind == "crash_caller":
+            self.crash(caller)
+            raise ConnectionResetError(f"{caller} crashed")
+        if kind == "drop_request":
+            raise TimeoutError(f"{method} to {callee} was lost")
+        if kind == "delay":
+            self.late.append((endpoint, method, args))
+            raise TimeoutError(f"{method} to {callee} is late")
+        generation = self.generations.get(callee, 0)
+        reply = self._invoke(callee, method, args)
+        if self.generations.get(callee, 0) != generation: # Crashed while handling the call
+            raise ConnectionResetError(f"{callee} crashed")
+        if kind == "drop_reply":
+            raise TimeoutError(f"Reply of {callee} to {method} was lost")
+        if kind in ("crash_after", "crash_caller_after"):
+            crashed = callee if kind == "crash_after" else caller
+            self.crash(crashed)
+            raise ConnectionResetError(f"{crashed} crashed")
+        return reply
+
+    def _invoke(self, callee, method, args):
+        try:
+            return getattr(self.members[callee], method)(*args)
+        except Exception as e: # Errors cross the wire as a Fault, as on LocalServer
+            raise Fault(1, f"{type(e).__name__}: {e}")
+
+    def transfer(self, source, target, amount, transaction_id=None):
+        """Move amount from source to target through the coordinator. Returns COMMITTED, ABORTED or FAILED."""
+        transaction_id = transaction_id or f"{self.seed}-{next(self.txn_ids)}"
+        self.stats["transactions"] += 1
+        try:
+            reply = self.client.call("execute_transaction", transaction_id, {source: -amount, target: amount})
+            result = {"Transaction Committed": "COMMITTED", UNKNOWN: "FAILED"}.get(reply, "ABORTED") # FAILED: outcome unknown to the client
+        except Exception: # The coordinator crashed or was down
+            result = "FAILED"
+        self._discard_crashed()
+        self.results[transaction_id] = result
+        if result == "FAILED":
+            self._note(f"Transaction {transaction_id} failed")
+        self.stats[result.lower()] += 1
+        return result
+
+    def step(self):
+        """Advance the clock by one tick and run one round of every member's periodic work."""
+        now = self.clock.advance(self.tick)
+        self.ticks += 1
+        for node, heals_at in list(self.partitions.items()):
+            if heals_at <= now:
+                del self.partitions[node]
+        for name, restart_at in sorted(self.restarts.items()):
+            if restart_at <= now:
+                del self.restarts[name]
+                self._restart(name)
+        late, self.late = self.late, []
+        for endpoint, method, args in late:
+            if endpoint.callee in self.members and not self._cut_off(endpoint.caller, endpoint.callee):
+                try:
+                    self._invoke(endpoint.callee, method, args) # Nobody waits for the reply any more
+                except Fault:
+                    pass
+        coordinator = self.members.get("coordinator")
+        if coordinator:
+            for node in self.nodes:
+                coordinator._heartbeat(node)
+            if coordinator.missed:
+                coordinator._push_missed_outcomes()
+        for name in self.nodes:
+            node = self.members.get(name)
+            if node is None:
+                continue
+            reporting = self.ticks % round(node.ack_interval / self.tick) == 0
+            for work in ("recover", "report_outcomes" if reporting else None, "_check_inactivity"):
+                if work and self.members.get(name) is node: # Stop once a fault crashed it
+                    getattr(node, work)()
+            if self.members.get(name) is node and not node.server_running: # Shut itself down: an operator restarts it
+                self.crash(name)
+        self._discard_crashed()
+
+    def run(self, ticks, transactions_per_tick=4, fault_rate=0.05):
+        """Run a random schedule: transfers between random accounts, with faults drawn from the seed."""
+        accounts = sorted(self.accounts)
+        for _ in range(ticks):
+            if self.rng.random() < fault_rate:
+                self._random_fault()
+            for _ in range(transactions_per_tick):
+                source, target = self.rng.sample(accounts, 2)
+                self.transfer(source, target, self.rng.randint(1, 50))
+            self.step()
+
+    def _random_fault(self):
+        roll = self.rng.random()
+        if roll < 0.7:
+            callee = self.rng.choice(self.nodes + ["coordinator"])
+            methods = [m for m in FAULT_METHODS if (m in ("query_outcomes", "acknowledge_outcomes")) == (callee == "coordinator")]
+            self.arm(callee, self.rng.choice(methods), self.rng.choice(FAULTS))
+        elif roll < 0.85:
+            self.partition(self.rng.choice(self.nodes), self.rng.uniform(self.tick, 3 * self.phase2_timeout))
+        else:
+            self.crash(self.rng.choice(self.nodes + ["coordinator"]), self.rng.uniform(0, 2 * self.phase2_timeout))
+            self._discard_crashed()
+
+    def in_doubt(self):
+        """Return {node: [txn ID]} of the transactions still prepared."""
+        in_doubt = {}
+        for name in self.nodes:
+            node = self.members.get(name)
+            prepared = [txn_id for txn_id, txn in node.transactions.items() if txn["state"] == "PREPARED"] if node else []
+            if prepared:
+                in_doubt[name] = sorted(prepared)
+        return in_doubt
+
+    def _unreported(self):
+        """Return True while some node has outcomes the coordinator has not confirmed yet."""
+        return any(not checked for name in self.nodes for _, checked in self.members[name].log.values())
+
+    def settle(self, max_ticks=None):
+        """Stop injecting faults and run until every member is up, nothing is in doubt and every outcome is reported.
+
+        Returns the ticks it took.
+        """
+        self.faults.clear()
+        self.partitions.clear()
+        for name in list(self.restarts):
+            self.restarts[name] = self.clock.time()
+        max_ticks = max_ticks or int(10 * self.phase2_timeout / self.tick)
+        for ticks in range(1, max_ticks + 1):
+            self.step()
+            coordinator = self.members.get("coordinator")
+            if not self.restarts and not self.late and coordinator and not coordinator.missed and not self.in_doubt() and not self._unreported():
+                return ticks
+        return max_ticks
+
+    def balances(self):
+        """Return the committed balance of every account, in cents."""
+        return {account: self.members[node].store.get(account) for account, (node, _) in sorted(self.accounts.items()) if node in self.members}
+
+    def check(self):
+        """Return the invariant violations: lost or created money, overdrafts, undecided or split transactions."""
+        violations = []
+        balances = self.balances()
+        expected = sum(round(balance * 100) for _, balance in self.accounts.values())
+        if len(balances) == len(self.accounts) and sum(balances.values()) != expected:
+            violations.append(f"Total is {from_cents(sum(balances.values()))}, expected {from_cents(expected)}: {balances}")
+        violations += [f"{account} is overdrawn: {from_cents(cents)}" for account, cents in balances.items() if cents < 0]
+        violations += [f"{node} still has prepared transactions {txn_ids}" for node, txn_ids in self.in_doubt().items()]
+        states = {} # {txn ID: {node: final state}}
+        for name in self.nodes:
+            for txn_id, txn in self.members[name].transactions.items() if name in self.members else ():
+                if txn.get("legs"): # Legs-less entries only remember an abort that came before the prepare
+                    states.setdefault(txn_id, {})[name] = txn["state"]
+        for txn_id, by_node in sorted(states.items()):
+            outcomes = set(by_node.values())
+            if len(outcomes) > 1:
+                violations.append(f"Transaction {txn_id} is split: {by_node}")
+            elif self.results.get(txn_id) == "COMMITTED" and outcomes != {"COMMITTED"}:
+                violations.append(f"Transaction {txn_id} was reported committed but is {by_node}")
+            elif self.results.get(txn_id) == "ABORTED" and "COMMITTED" in outcomes:
+                violations.append(f"Transaction {txn_id} was reported aborted but is {by_node}")
+        return violations
+
+    def explain(self, transaction_id):
+        """Return the simulation events and every member's trace events for one transaction, as lines."""
+        mentions = re.compile(rf"(?<![\w-]){re.escape(transaction_id)}(?![\w-])")
+        lines = [f"{at:8.3f} sim: {event}" for at, event in self.history if mentions.search(event)]
+        tracers = self.retired + [member.trace for member in self.members.values()]
+        events = sorted((event for tracer in tracers for event in tracer.trace(transaction_id)), key=lambda event: event["time"])
+        return lines + [f"{event['node']}: [{event['phase']}] {event['message']}" for event in events]
+
+    def digest(self):
+        """Return a short hash of the client outcomes and balances; equal for two runs of one seed."""
+        return hashlib.sha256(repr((sorted(self.results.items()), self.balances())).encode()).hexdigest()[:12]
+
+    def close(self):
+        for name in list(self.members):
+            self.crash(name)
+        self._discard_crashed()
+        for name in [name for name, server in LOCAL_SERVERS.items() if isinstance(server, _SimEndpoint) and server.sim is self]:
+            del LOCAL_SERVERS[name]
+        if self.scratch:
+            shutil.rmtree(self.workdir, ignore_errors=True)
+
+def lab_case(case, amount=10):
+    """Replay a lab simulation case in virtual time and return the simulation, settled.
+
+    Case 1: Node-2 prepares but its vote never reaches the coordinator.
+    Case 2: The commit reaches Node-2 only after the coordinator gave up on it.
+    """
+    sim = Simulation()
+    if case == 1:
+        sim.arm("Node-2", "prepare_legs", "drop_reply")
+    elif case == 2:
+        sim.arm("Node-2", "commit", "delay")
+    sim.transfer("A", "B", amount)
+    sim.settle()
+    return sim
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run 2PC fault schedules on a virtual clock and check the invariants.")
+    parser.add_argument("--case", type=int, choices=[1, 2], help="Replay a lab simulation case instead of random schedules")
+    parser.add_argument("--schedules", type=int, default=20, help="Random schedules to run")
+    parser.add_argument("--seed", type=int, default=1, help="Seed of the first schedule; schedule i uses seed + i")
+    parser.add_argument("--ticks", type=int, default=200, help="Ticks per schedule")
+    parser.add_argument("--nodes", type=int, default=3, help="Participants, with two accounts each")
+    parser.add_argument("--rate", type=float, default=0.05, help="Chance of a fault per tick")
+    parser.add_argument("--log-level", default="ERROR", help="Member log output; injected faults make WARNING noisy")
+    args = parser.parse_args(argv)
+
+    if args.case:
+        with lab_case(args.case) as sim:
+            print(f"Case {args.case}: {sim.results}, balances {sim.balances()}, violations {sim.check() or 'none'}")
+        return 0
+    accounts = {f"{chr(ord('A') + i)}{j}": (f"Node-{i + 2}", 100) for i in range(args.nodes) for j in range(2)}
+    failures = 0
+    start = time.perf_counter()
+    totals = {}
+    for seed in range(args.seed, args.seed + args.schedules):
+        with Simulation(accounts, seed=seed, log_level=args.log_level) as sim:
+            sim.run(args.ticks, fault_rate=args.rate)
+            settle_ticks = sim.settle()
+            violations = sim.check()
+            for key, value in sim.stats.items():
+                totals[key] = totals.get(key, 0) + value
+            totals["ticks"] = totals.get("ticks", 0) + sim.ticks
+            print(f"seed {seed}: {sim.stats['committed']}/{sim.stats['transactions']} committed, {sim.stats['faults']} faults, "
+                  f"{sim.stats['crashes']} crashes, {sim.stats['partitions']} partitions, settled in {settle_ticks} ticks, "
+                  f"digest {sim.digest()}{'' if not violations else ', VIOLATIONS:'}")
+            for violation in violations:
+                print(f"  {violation}")
+            failures += bool(violations)
+    elapsed = time.perf_counter() - start
+    print(f"{args.schedules} schedules, {failures} with violations, {totals['transactions']} transactions and "
+          f"{totals['ticks'] * sim.tick:.0f} virtual seconds in {elapsed:.1f}s: "
+          f"{totals['transactions'] / elapsed:.0f} txn/s, {args.schedules / elapsed:.1f} schedules/s")
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
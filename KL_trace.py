@@ -0,0 +1,105 @@
+from collections import deque
+import atexit
+import itertools
+import sys
+import threading
+import time
+
+LEVELS = {"DEBUG": 10, "INFO": 20, "WARNING": 30, "ERROR": 40}
+
+class Tracer:
+    """Structured event log that keeps request threads off stdout.
+
+    Every event is appended to an in-memory ring buffer of the last capacity
+    events, tagged with the node, transaction ID, phase, level and a monotonic
+    timestamp, so the history of a recent transaction can be read back with
+    trace(). Events at or above the output level are also queued for a
+    background thread that writes them in batches; when the output falls
+    behind, the oldest queued lines are dropped rather than blocking callers.
+    """
+
+    def __init__(self, node, level="INFO", capacity=10000, flush_interval=0.1, stream=None, max_pending=10000):
+        self.node = node
+        self.level = LEVELS[level] # Lowest level written to the stream; every level goes to the ring buffer
+        self.events = deque(maxlen=capacity) # Ring buffer: (seq, monotonic, time, level, txn, phase, message)
+        self.pending = deque() # Events waiting for the flusher
+        self.max_pending = max_pending
+        self.stream = stream or sys.stdout
+        self.flush_interval = flush_interval
+        self.seq = itertools.count(1)
+        self.write_lock = threading.Lock() # Keeps the flusher and flush() from interleaving lines
+        self.dropped = 0 # Lines not written because the output fell behind
+        self.closed = threading.Event()
+        threading.Thread(target=self._flush_loop, daemon=True).start()
+        atexit.register(self.flush)
+
+    def log(self, level, message, txn=None, phase=None):
+        """Record an event. Cheap enough to call on every request."""
+        event = (next(self.seq), time.monotonic(), time.time(), level, txn, phase, message)
+        self.events.append(event)
+        if LEVELS[level] >= self.level:
+            if len(self.pending) >= self.max_pending:
+                self.dropped += 1
+            else:
+                self.pending.append(event)
+
+    def debug(self, message, txn=None, phase=None):
+        self.log("DEBUG", message, txn, phase)
+
+    def info(self, message, txn=None, phase=None):
+        self.log("INFO", message, txn, phase)
+
+    def warning(self, message, txn=None, phase=None):
+        self.log("WARNING", message, txn, phase)
+
+    def error(self, message, txn=None, phase=None):
+        self.log("ERROR", message, txn, phase)
+
+    def set_level(self, level):
+        """Change the lowest level written to the stream."""
+        self.level = LEVELS[level]
+
+    def trace(self, txn):
+        """Return the buffered events of one transaction, oldest first."""
+        return [self._as_dict(event) for event in list(self.events) if event[4] == txn]
+
+    def recent(self, limit=100):
+        """Return the last limit buffered events."""
+        return [self._as_dict(event) for event in list(self.events)[-limit:]]
+
+    def _as_dict(self, event):
+        seq, monotonic, wall, level, txn, phase, message = event
+        return {"node": self.node, "seq": seq, "monotonic": monotonic, "time": wall, "level": level, "txn": txn, "phase": phase, "message": message}
+
+    def flush(self):
+        """Write every queued event now."""
+        with self.write_lock:
+            lines = []
+            while self.pending:
+                lines.append(f"{self.node}: {self.pending.popleft()[6]}\n")
+            if lines:
+                try:
+                    self.stream.write("".join(lines))
+                    self.stream.flush()
+                except (OSError, ValueError):
+                    pass # Stream closed at exit
+
+    def _flush_loop(self):
+        while not self.closed.wait(self.flush_interval):
+            self.flush()
+
+    def close(self):
+        """Stop the flusher and write what is left; for tracers of members discarded before exit."""
+        self.closed.set()
+        self.flush()
+        atexit.unregister(self.flush)
+
+    def stats(self):
+        """Return the buffer counters."""
+        return {
+            "buffered": len(self.events),
+            "capacity": self.events.maxlen,
+            "pending": len(self.pending),
+            "dropped": self.dropped,
+            "level": next(name for name, value in LEVELS.items() if value == self.level),
+        }
@@ -0,0 +1,164 @@
+import fcntl
+import json
+import os
+import struct
+import threading
+import zlib
+
+HEADER = struct.Struct("<II") # Record length, CRC-32 of the record
+
+class WriteAheadLog:
+    """Append-only, checksummed log file with group commit.
+
+    Records are JSON objects framed by a length and a CRC-32. append() only queues a
+    record; a background thread writes everything queued since its last pass and
+    covers it with a single fsync, so concurrent transactions share one disk flush.
+    Callers wait for durability with sync(). checkpoint() replaces the whole log
+    with a single checkpoint record, so a restart replays only from there.
+    """
+
+    def __init__(self, path, trace=None):
+        self.path = path
+        self.trace = trace # Tracer for the torn-tail warning; None stays quiet
+        self.cond = threading.Condition() # Guards the queue and LSN counters
+        self.io_lock = threading.Lock() # Serializes writes to the log file
+        self.pending = [] # Queued records: [(LSN, encoded record)]
+        self.records = self._read_records() # Records found on disk when the log was opened
+        self.next_lsn = len(self.records) + 1 # Log sequence number of the next record
+        self.durable_lsn = len(self.records) # Highest LSN known to be on disk
+        self.records_since_checkpoint = len(self.records)
+        self.file = open(self.path, "ab")
+        self.running = True
+        self.flusher = threading.Thread(target=self._flush_loop, daemon=True)
+        self.flusher.start()
+
+    def _encode(self, record):
+        payload = json.dumps(record, separators=(",", ":")).encode()
+        return HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+    def _read_records(self):
+        """Read every intact record and cut off a torn or corrupt tail."""
+        records = []
+        if not os.path.exists(self.path):
+            return records
+        with open(self.path, "rb") as f:
+            data = f.read()
+        offset = 0
+        while offset + HEADER.size <= len(data):
+            length, checksum = HEADER.unpack_from(data, offset)
+            payload = data[offset + HEADER.size:offset + HEADER.size + length]
+            if len(payload) < length or zlib.crc32(payload) != checksum:
+                break # Partially written record from a crash
+            records.append(json.loads(payload))
+            offset += HEADER.size + length
+        if offset < len(data):
+            if self.trace:
+                self.trace.warning(f"Discarding {len(data) - offset} bytes of torn log tail from {self.path}.", phase="recovery")
+            with open(self.path, "r+b") as f:
+                f.truncate(offset)
+        return records
+
+    def append(self, record):
+        """Queue a record and return its LSN. The record is durable once sync() covers it."""
+        data = self._encode(record)
+        with self.cond:
+            lsn = self.next_lsn
+            self.next_lsn += 1
+            self.records_since_checkpoint += 1
+            self.pending.append((lsn, data))
+            self.cond.notify_all()
+        return lsn
+
+    def sync(self, lsn=None):
+        """Wait until the record with this LSN (default: every record queued so far) is on disk."""
+        with self.cond:
+            lsn = self.next_lsn - 1 if lsn is None else lsn
+            while self.durable_lsn < lsn and self.running:
+                self.cond.wait()
+        return lsn
+
+    def _flush_loop(self):
+        """Write queued records in groups, with one fsync per group."""
+        while self.running:
+            with self.cond:
+                while not self.pending and self.running:
+                    self.cond.wait()
+            with self.io_lock:
+                with self.cond:
+                    batch, self.pending = self.pending, []
+                if not batch: # Taken by a checkpoint
+                    continue
+                self.file.write(b"".join(data for _, data in batch))
+                self.file.flush()
+                os.fsync(self.file.fileno())
+            with self.cond:
+                self.durable_lsn = max(self.durable_lsn, batch[-1][0])
+                self.cond.notify_all()
+
+    def checkpoint(self, state):
+        """Atomically replace the log with one checkpoint record holding state.
+
+        The caller must hold the lock that orders its appends, so state already
+        includes the effect of every record queued so far.
+        """
+        with self.io_lock:
+            with self.cond:
+                covered = self.next_lsn - 1
+                self.pending = [] # Covered by the checkpoint
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(self._encode({"type": "checkpoint", "state": state}))
+                f.flush()
+                os.fsync(f.fileno())
+            self.file.close()
+            os.replace(tmp_path, self.path)
+            fsync_directory(self.path)
+            self.file = open(self.path, "ab")
+            with self.cond:
+                self.durable_lsn = max(self.durable_lsn, covered)
+                self.records_since_checkpoint = 0
+                self.cond.notify_all()
+
+    def close(self, sync=True):
+        """Flush queued records and stop the background writer. With sync False, as in a crash, queued records are lost."""
+        if sync:
+            self.sync()
+        with self.cond:
+            if not sync:
+                self.pending = []
+            self.running = False
+            self.cond.notify_all()
+        self.flusher.join()
+        self.file.close()
+
+def fsync_directory(path):
+    """Make a rename inside path's directory durable."""
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def write_file_atomically(path, text):
+    """Replace a file's contents so a crash leaves either the old or the new version."""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    fsync_directory(path)
+
+def lock_file(path, wait=False):
+    """Take an exclusive lock on path, creating it, and return the open file.
+
+    Returns None if another process holds the lock, unless wait is set, in which
+    case this blocks until that process releases it or exits.
+    """
+    f = open(path, "a")
+    try:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX if wait else fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        f.close()
+        return None
+    return f